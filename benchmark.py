@@ -0,0 +1,572 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import tempfile
+import threading
+import subprocess
+import statistics
+
+# Runs the engine headless against local stand-ins: yt_dlp serves generated
+# files from a temp directory with a set latency and throughput, search
+# answers from a fake backend, and pygame.mixer only records when playback
+# would have started. Nothing touches the network or a sound device.
+BENCH_RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.json')
+BENCH_MODES = ('download', 'streaming')
+BENCH_RUNS = 5
+BENCH_EXTRACT_LATENCY = 0.05
+BENCH_SEARCH_LATENCY = 0.1
+BENCH_THROUGHPUT = 20 * 1024 * 1024
+BENCH_TRACK_BYTES = 1024 * 1024
+BENCH_QUEUE_SIZES = (10, 1000, 100000)
+BENCH_QUEUE_OPS = 200
+BENCH_SUGGEST_WORDS = ('love', 'night', 'bench', 'heart', 'dance', 'blue', 'fire', 'rain', 'home', 'light',
+                       'never', 'gonna', 'sky', 'road', 'summer', 'dream')
+BENCH_SUGGEST_PREFIXES = ('b', 'be', 'bench', 'n', 'love n', 'zz')
+BENCH_TIMEOUT = 30.0
+BENCH_REGRESSION_TOLERANCE = 0.2
+BENCH_NOISE_FLOOR = {'ms': 1.0, 'us': 2.0}
+
+class NullMixer:
+    def __init__(self):
+        self.started = threading.Event()
+        self.started_at = None
+        self.busy = False
+
+    def sound_started(self):
+        self.started_at = time.perf_counter()
+        self.busy = True
+        self.started.set()
+
+    def reset(self):
+        self.started.clear()
+        self.started_at = None
+
+    def module(self):
+        mixer = self
+        channels = {}
+
+        class ChannelState:
+            # Plays PCM chunks in real time (without output), so a streamed
+            # track lasts as long as it would on a sound card rather than
+            # draining the moment it is decoded.
+            def __init__(self, index):
+                self.index = index
+                self.ends_at = 0.0
+                self.current = None
+                self.queued = None
+
+            def duration(self, sound):
+                return len(sound.buffer or b'') / (44100 * 4)
+
+            def play(self, sound, *args, **kwargs):
+                self.ends_at = time.monotonic() + self.duration(sound)
+                self.current = sound
+                self.queued = None
+                mixer.sound_started()
+
+            def queue(self, sound):
+                self.queued = sound
+
+            def get_busy(self):
+                now = time.monotonic()
+                if now >= self.ends_at and self.queued is not None:
+                    self.ends_at = max(self.ends_at, now - 0.05) + self.duration(self.queued)
+                    self.current, self.queued = self.queued, None
+                return now < self.ends_at
+
+            def get_sound(self):
+                return self.current if self.get_busy() else None
+
+            def get_queue(self):
+                self.get_busy()
+                return self.queued
+
+            def set_volume(self, *args):
+                pass
+
+            def pause(self):
+                pass
+
+            def unpause(self):
+                pass
+
+            def stop(self):
+                self.ends_at = 0.0
+                self.current = None
+                self.queued = None
+
+        def Channel(index):
+            # Like pygame, every Channel(n) refers to the same channel.
+            if index not in channels:
+                channels[index] = ChannelState(index)
+            return channels[index]
+
+        def play(loops=0, start=0.0, fade_ms=0):
+            mixer.sound_started()
+
+        def stop():
+            mixer.busy = False
+
+        class Sound:
+            def __init__(self, buffer=None):
+                self.buffer = buffer
+
+            def set_volume(self, value):
+                pass
+
+        music = types.SimpleNamespace(
+            load=lambda path, *args: None, unload=lambda: None, play=play, stop=stop,
+            pause=lambda: None, unpause=lambda: None, queue=lambda path, *args: None,
+            set_volume=lambda value: None, get_busy=lambda: mixer.busy, get_pos=lambda: 0,
+            set_endevent=lambda event=0: None)
+        pygame = types.ModuleType('pygame')
+        pygame.USEREVENT = 24
+        pygame.mixer = types.SimpleNamespace(
+            init=lambda *args, **kwargs: None, quit=lambda: None, get_init=lambda: (44100, -16, 2),
+            set_reserved=lambda count: count, Channel=Channel, Sound=Sound,
+            music=music)
+        pygame.display = types.SimpleNamespace(init=lambda: None)
+        pygame.event = types.SimpleNamespace(
+            set_blocked=lambda kinds: None, set_allowed=lambda kinds: None,
+            get=lambda kind=None: [], clear=lambda kind=None: None, post=lambda event: None,
+            wait=lambda *args: threading.Event().wait())
+        return pygame
+
+class FakeExtractor:
+    # Stands in for yt_dlp: every video id resolves to the same generated
+    # audio file, after `latency` seconds, and downloads are copied out at
+    # `throughput` bytes per second with the usual progress hooks.
+    def __init__(self, directory, latency, throughput, track_bytes, audio_path=None, decodable=False):
+        self.latency = latency
+        self.throughput = throughput
+        self.extractions = 0
+        self.lock = threading.Lock()
+        if audio_path:
+            self.source = audio_path
+        elif decodable:
+            # Streaming hands the source to FFmpeg, so it has to be real audio:
+            # a 128 kbit/s tone of about track_bytes.
+            self.source = os.path.join(directory, 'source.mp3')
+            subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                            '-i', f'sine=frequency=440:duration={max(1, track_bytes * 8 // 128000)}',
+                            '-b:a', '128k', self.source], check=True, stdin=subprocess.DEVNULL)
+        else:
+            self.source = os.path.join(directory, 'source.mp3')
+            with open(self.source, 'wb') as f:
+                f.write(os.urandom(track_bytes))
+        self.ext = os.path.splitext(self.source)[1].lstrip('.') or 'mp3'
+        # A reduced format is a prefix of the file, sized by its bitrate.
+        self.formats = [{'format_id': 'low', 'abr': 48}, {'format_id': 'best', 'abr': 160}]
+        self.downloads = []
+
+    def info(self, video_id):
+        return {
+            'id': video_id,
+            'title': f'Benchmark track {video_id}',
+            'channel': 'Benchmark',
+            'duration': 180,
+            'ext': self.ext,
+            'url': self.source,
+            'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+            'acodec': 'mp3',
+            'vcodec': 'none',
+            'formats': [dict(format, url=self.source, ext=self.ext, acodec='mp3', vcodec='none')
+                        for format in self.formats],
+        }
+
+    def extract(self, target):
+        time.sleep(self.latency)
+        with self.lock:
+            self.extractions += 1
+        if target.startswith('ytsearch1:'):
+            return {'_type': 'playlist', 'entries': [self.info(bench_video_id(target[10:]))]}
+        video_id = target.split('v=')[-1].split('&')[0].split('/')[-1]
+        return self.info(video_id)
+
+    def select(self, info, spec):
+        # Any spec that does not name one of our format ids means best, as the
+        # engine's default 'bestaudio[ext=m4a]/bestaudio/best' would.
+        formats = {format['format_id']: format for format in info.get('formats') or []}
+        return formats.get(spec) or formats.get('best') or {'format_id': 'best', 'abr': 160}
+
+    def download(self, info, fmt, path, hooks):
+        total = os.path.getsize(self.source) * fmt['abr'] // 160
+        with self.lock:
+            self.downloads.append(fmt['format_id'])
+        started = time.perf_counter()
+        chunk = max(1, int(self.throughput / 20))
+        done = 0
+        with open(self.source, 'rb') as src, open(path + '.part', 'wb') as dst:
+            while done < total:
+                data = src.read(min(chunk, total - done))
+                if not data:
+                    break
+                dst.write(data)
+                done += len(data)
+                delay = done / self.throughput - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                status = {'status': 'downloading', 'downloaded_bytes': done, 'total_bytes': total,
+                          'elapsed': time.perf_counter() - started, 'filename': path}
+                for hook in hooks:
+                    hook(status)
+        os.replace(path + '.part', path)
+        status = {'status': 'finished', 'downloaded_bytes': total, 'total_bytes': total,
+                  'elapsed': time.perf_counter() - started, 'filename': path}
+        for hook in hooks:
+            hook(status)
+
+    def module(self):
+        extractor = self
+
+        class DownloadCancelled(Exception):
+            pass
+
+        class YoutubeDL:
+            def __init__(self, params=None):
+                self.params = dict(params or {})
+                outtmpl = self.params.get('outtmpl')
+                if not isinstance(outtmpl, dict):
+                    self.params['outtmpl'] = {'default': outtmpl or '%(id)s.%(ext)s'}
+                self.cookiejar = None
+                self._request_director = None
+                self.format_selector = self.build_format_selector(self.params.get('format'))
+
+            def build_format_selector(self, spec):
+                return spec
+
+            def extract_info(self, url, download=False, process=True, ie_key=None):
+                return extractor.extract(url)
+
+            def process_ie_result(self, info, download=True):
+                # Like yt_dlp, the format comes from the selector built at
+                # construction, not from params['format'].
+                fmt = extractor.select(info, self.format_selector)
+                path = self.params['outtmpl']['default'] % dict(info, format_id=fmt['format_id'])
+                extractor.download(info, fmt, path, self.params.get('progress_hooks', []))
+                return dict(info, requested_downloads=[{'filepath': path}])
+
+            def get_info_extractor(self, key):
+                return None
+
+        yt_dlp = types.ModuleType('yt_dlp')
+        yt_dlp.YoutubeDL = YoutubeDL
+        yt_dlp.utils = types.SimpleNamespace(DownloadCancelled=DownloadCancelled)
+        return yt_dlp
+
+def bench_title(i):
+    words = BENCH_SUGGEST_WORDS
+    count = len(words)
+    return (f'{words[i % count].title()} {words[i // count % count]} '
+            f'{words[i // count // count % count]} {i}')
+
+def bench_video_id(query):
+    return 'bench' + ''.join(ch for ch in query.casefold() if ch.isalnum())[:20]
+
+def install_fakes(directory, options):
+    # The engine reads its paths from the home directory at import time, so
+    # HOME is pointed at the scratch directory before it is imported.
+    os.environ['HOME'] = directory
+    os.environ['USERPROFILE'] = directory
+    mixer = NullMixer()
+    extractor = FakeExtractor(directory, options['latency'], options['throughput'],
+                              options['track_bytes'], options['audio'], 'streaming' in options['modes'])
+    sys.modules['pygame'] = mixer.module()
+    sys.modules['yt_dlp'] = extractor.module()
+    sys.modules['youtubesearchpython'] = types.ModuleType('youtubesearchpython')
+    import playerengine
+    return playerengine, mixer, extractor
+
+def make_search_backend(engine_module, latency):
+    class FakeSearchBackend(engine_module.SearchBackend):
+        name = 'fake-search'
+
+        def search(self, query):
+            time.sleep(latency)
+            video_id = bench_video_id(query)
+            return {'url': f'https://www.youtube.com/watch?v={video_id}',
+                    'title': f'Benchmark track {video_id}', 'id': video_id}
+
+    return FakeSearchBackend()
+
+class Bench:
+    def __init__(self, engine_module, mixer, extractor, options):
+        self.pe = engine_module
+        self.mixer = mixer
+        self.extractor = extractor
+        self.options = options
+        self.results = {}
+        self.engines = 0
+
+    def new_engine(self, prefetch=True, streaming=False):
+        # A fresh engine per measurement, on an empty cache and library so
+        # every run starts cold.
+        pe = self.pe
+        self.engines += 1
+        home = os.path.join(os.environ['HOME'], f'engine{self.engines}')
+        pe.CACHE_DIR = os.path.join(home, 'cache')
+        pe.LIBRARY_PATH = os.path.join(home, 'library.db')
+        pe.SESSION_DIR = os.path.join(home, 'session')
+        engine = pe.PlayerEngine()
+        engine.streaming_mode = streaming
+        engine.search_backends = pe.HedgedSearch([make_search_backend(pe, self.options['search_latency'])],
+                                                 tracer=engine.tracer)
+        if not prefetch:
+            engine.prefetch_count = 0
+            engine.cache_warm_count = 0
+        threading.Thread(target=engine.run_forever, daemon=True).start()
+        return engine
+
+    def record(self, name, samples, unit='ms', **details):
+        self.results[name] = {
+            'unit': unit,
+            'median': round(statistics.median(samples), 3),
+            'min': round(min(samples), 3),
+            'max': round(max(samples), 3),
+            'runs': len(samples),
+            **details,
+        }
+        print(f"  {name:<32} {self.results[name]['median']:>10.3f} {unit} "
+              f"(min {self.results[name]['min']:.3f}, max {self.results[name]['max']:.3f})")
+
+    def wait_for_sound(self, started):
+        if not self.mixer.started.wait(BENCH_TIMEOUT):
+            raise RuntimeError("Playback did not start")
+        return (self.mixer.started_at - started) * 1000
+
+    def modes(self):
+        # Download mode keeps the original metric names; streaming ones get a
+        # suffix. In streaming mode FFmpeg reads the source straight from
+        # disk, so only the extraction latency is simulated.
+        for mode in self.options['modes']:
+            yield mode == 'streaming', '_streaming' if mode == 'streaming' else ''
+
+    def first_sound(self):
+        for streaming, suffix in self.modes():
+            samples = []
+            for run in range(self.options['runs']):
+                engine = self.new_engine(streaming=streaming)
+                self.mixer.reset()
+                started = time.perf_counter()
+                engine.post(engine.enqueue, f'first sound {suffix} {run}')
+                samples.append(self.wait_for_sound(started))
+                engine.call(engine.close)
+            self.record('time_to_first_sound' + suffix, samples)
+
+    def track_switch(self):
+        # Cached switches wait for the prefetch of the next track to land;
+        # uncached ones run with prefetching off, so every skip resolves and
+        # downloads (or starts streaming) from scratch.
+        for streaming, suffix in self.modes():
+            cached = self.switches(True, streaming)
+            uncached = self.switches(False, streaming)
+            self.record('track_switch_cached' + suffix, cached)
+            self.record('track_switch_uncached' + suffix, uncached)
+
+    def switches(self, prefetch, streaming):
+        engine = self.new_engine(prefetch, streaming)
+        label = ('warm' if prefetch else 'cold') + ('s' if streaming else '')
+        urls = [f'https://www.youtube.com/watch?v={label}{index}' for index in range(self.options['runs'] + 1)]
+        self.mixer.reset()
+        for index, url in enumerate(urls):
+            engine.post(engine.add_song, {'url': url, 'title': f'Switch {index}', 'id': f'{label}{index}'})
+        self.wait_for_sound(time.perf_counter())
+        samples = []
+        for url in urls[1:]:
+            if prefetch:
+                deadline = time.monotonic() + BENCH_TIMEOUT
+                while not engine.call(engine.is_fetched, url) and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            self.mixer.reset()
+            started = time.perf_counter()
+            engine.post(engine.play_next)
+            samples.append(self.wait_for_sound(started))
+        engine.call(engine.close)
+        return samples
+
+    def search(self):
+        engine = self.new_engine(prefetch=False)
+        cold, repeat, library = [], [], []
+        for run in range(self.options['runs']):
+            query = f'search latency {run}'
+            started = time.perf_counter()
+            engine.search_service.lookup(query)
+            cold.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            engine.search_service.lookup(query)
+            repeat.append((time.perf_counter() - started) * 1000)
+            if engine.library is not None:
+                # Recorded by the resolver, as if the track had been played.
+                engine.resolver.search(query)
+                started = time.perf_counter()
+                engine.find_song(f'benchmark track {bench_video_id(query)}')
+                library.append((time.perf_counter() - started) * 1000)
+        engine.call(engine.close)
+        self.record('search_network', cold)
+        self.record('search_repeat', repeat)
+        if library:
+            self.record('search_library', library)
+
+    def suggestions(self):
+        # The index is filled with as many made-up titles as the queue
+        # sizes, built from a small vocabulary so short prefixes match a
+        # large share of them, as they would in a big library.
+        for size in self.options['queue_sizes']:
+            engine = self.new_engine(prefetch=False)
+            engine.suggestions.add_many(
+                (bench_title(i), 1 + i % 7) for i in range(size))
+            samples = []
+            for run in range(self.options['runs'] * 20):
+                prefix = BENCH_SUGGEST_PREFIXES[run % len(BENCH_SUGGEST_PREFIXES)]
+                started = time.perf_counter()
+                engine.suggest(prefix)
+                samples.append((time.perf_counter() - started) * 1e6)
+            self.record(f'suggest_{size}', samples, unit='us', entries=len(engine.suggestions))
+            engine.call(engine.close)
+
+    def queue_ops(self):
+        pe = self.pe
+        ops = self.options['queue_ops']
+        for size in self.options['queue_sizes']:
+            engine = self.new_engine(prefetch=False)
+            tracks = [pe.Track(f'https://www.youtube.com/watch?v=q{i}', f'Queue {i}') for i in range(size)]
+            engine.call(engine.queue.reset, tracks)
+            results = engine.call(self.time_queue_ops, engine, ops)
+            engine.call(engine.close)
+            for name, samples in results.items():
+                self.record(f'queue_{name}_{size}', samples, unit='us')
+
+    def time_queue_ops(self, engine, ops):
+        # Runs on the engine thread; per-operation times include the journal
+        # write and the UI event, as they would in the player.
+        results = {'add': [], 'remove': [], 'move': []}
+        for op in range(ops):
+            song = {'url': f'https://www.youtube.com/watch?v=add{op}', 'title': f'Added {op}', 'id': f'add{op}'}
+            started = time.perf_counter()
+            engine.add_song(song)
+            results['add'].append((time.perf_counter() - started) * 1e6)
+        for op in range(ops):
+            middle = len(engine.queue) // 2
+            started = time.perf_counter()
+            engine.move(middle, 1)
+            results['move'].append((time.perf_counter() - started) * 1e6)
+        for op in range(ops):
+            started = time.perf_counter()
+            engine.remove(len(engine.queue) // 2)
+            results['remove'].append((time.perf_counter() - started) * 1e6)
+        return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_runs(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('runs', [])
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        print(f"Could not read {path}: {str(e)}")
+        return []
+
+def save_runs(path, runs):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'runs': runs}, f, indent=2)
+    os.replace(tmp_path, path)
+
+def compare(baseline, results, tolerance):
+    # Lower is better for every metric; a median more than `tolerance` above
+    # the baseline's counts as a regression, unless the difference is within
+    # timer noise for sub-millisecond metrics.
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'previous run'} ({baseline.get('time')}):")
+    for name, result in results.items():
+        before = baseline['metrics'].get(name)
+        if not before or not before['median']:
+            continue
+        change = (result['median'] - before['median']) / before['median']
+        flag = ''
+        if change > tolerance and result['median'] - before['median'] > BENCH_NOISE_FLOOR[result['unit']]:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"  {name:<32} {before['median']:>10.3f} -> {result['median']:>10.3f} {result['unit']} "
+              f"({change:+.0%}){flag}")
+    return regressions
+
+def option(argv, name, default, kind=str):
+    if name in argv:
+        i = argv.index(name)
+        value = argv[i + 1]
+        del argv[i:i + 2]
+        return kind(value)
+    return default
+
+def main(argv):
+    argv = list(argv)
+    options = {
+        'runs': option(argv, '--runs', BENCH_RUNS, int),
+        'latency': option(argv, '--latency', BENCH_EXTRACT_LATENCY, float),
+        'search_latency': option(argv, '--search-latency', BENCH_SEARCH_LATENCY, float),
+        'throughput': option(argv, '--throughput', BENCH_THROUGHPUT, float),
+        'track_bytes': option(argv, '--track-bytes', BENCH_TRACK_BYTES, int),
+        'audio': option(argv, '--audio', None),
+        'queue_sizes': option(argv, '--queue-sizes', BENCH_QUEUE_SIZES,
+                              lambda value: tuple(int(size) for size in value.split(','))),
+        'queue_ops': option(argv, '--queue-ops', BENCH_QUEUE_OPS, int),
+        'modes': option(argv, '--mode', None, lambda value: BENCH_MODES if value == 'both' else (value,)),
+    }
+    if options['modes'] is None:
+        options['modes'] = BENCH_MODES if shutil.which('ffmpeg') else ('download',)
+        if not shutil.which('ffmpeg'):
+            print("FFmpeg not found; benchmarking download mode only")
+    elif not set(options['modes']) <= set(BENCH_MODES):
+        print(f"Unknown mode; use {', '.join(BENCH_MODES)} or both")
+        return 2
+    elif 'streaming' in options['modes'] and not shutil.which('ffmpeg'):
+        print("Streaming mode needs FFmpeg on the PATH")
+        return 2
+    output = option(argv, '--output', BENCH_RESULTS_PATH)
+    baseline_path = option(argv, '--baseline', None)
+    tolerance = option(argv, '--tolerance', BENCH_REGRESSION_TOLERANCE, float)
+    only = set(argv)
+
+    directory = tempfile.mkdtemp(prefix='audivine-bench-')
+    try:
+        engine_module, mixer, extractor = install_fakes(directory, options)
+        bench = Bench(engine_module, mixer, extractor, options)
+        print(f"Benchmarking (extract {options['latency'] * 1000:.0f} ms, search "
+              f"{options['search_latency'] * 1000:.0f} ms, {options['throughput'] / 1024 / 1024:.1f} MB/s):")
+        for name in ('first_sound', 'track_switch', 'search', 'suggestions', 'queue_ops'):
+            if not only or name in only:
+                getattr(bench, name)()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    runs = load_runs(output)
+    baseline = load_runs(baseline_path)[-1:] if baseline_path else runs[-1:]
+    regressions = compare(baseline[0], bench.results, tolerance) if baseline else []
+
+    config = {key: value for key, value in options.items() if key != 'audio'}
+    config['queue_sizes'] = list(config['queue_sizes'])
+    config['modes'] = list(config['modes'])
+    runs.append({
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'config': config,
+        'metrics': bench.results,
+    })
+    save_runs(output, runs)
+    print(f"\nResults saved to {output}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,22 +1,26 @@
+import time
+STARTED = time.perf_counter()
 import tkinter as tk
 from tkinter import ttk
-import threading
-import pygame
 import os
-import tempfile
-import yt_dlp
-from youtubesearchpython import VideosSearch
-from ctypes import cast, POINTER
-from comtypes import CLSCTX_ALL
-from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
 import sys
-import subprocess
-import speech_recognition as sr
-from PIL import Image, ImageTk
-import base64
-import io
+import threading
+import importlib.util
+from collections import deque, OrderedDict
+from playerengine import (PlayerEngine, ControlServer, IMPORT_TIMES, WARM_UP_ON_START,
+                          lazy_import, optional_import, parse_import_text, read_import_file,
+                          format_latency_stats, format_storage_stats, SESSION_POSITION_INTERVAL,
+                          ONLINE_SEARCH_PREFIX)
 
-pygame.mixer.init()
+SUGGEST_DEBOUNCE_MS = 120
+VOLUME_LOG_DELAY_MS = 500
+QUEUE_ROW_HEIGHT = 24
+QUEUE_REMOVE_WIDTH = 28
+STATS_REFRESH_MS = 1000
+# Run with --profile-startup (or AUDIVINE_PROFILE_STARTUP=1) to print how long
+# each startup stage and backend import takes, then exit.
+PROFILE_STARTUP = '--profile-startup' in sys.argv or bool(os.environ.get('AUDIVINE_PROFILE_STARTUP'))
+PROFILED_IMPORTS = ('yt_dlp', 'youtubesearchpython', 'speech_recognition', 'numpy')
 
 def resource_path(relative_path):
     try:
@@ -27,37 +31,269 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 def check_dependencies():
-    try:
-        import pygame
-        import yt_dlp
-        from youtubesearchpython import VideosSearch
-        from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-    except ImportError as e:
-        import tkinter as tk
+    # find_spec only locates the packages, so this does not pay for importing them.
+    missing = [name for name in ('pygame', 'yt_dlp', 'youtubesearchpython')
+               if importlib.util.find_spec(name) is None]
+    if missing:
         from tkinter import messagebox
         root = tk.Tk()
         root.withdraw()
         messagebox.showerror("Missing Dependencies", 
-            f"Error: {str(e)}\nPlease ensure all required packages are installed.")
+            f"Error: missing {', '.join(missing)}\nPlease ensure all required packages are installed.")
         sys.exit(1)
 
+class UiDispatcher:
+    # Widget updates from any thread are queued here and applied on the Tk
+    # thread on its next wake-up. Updates are keyed by widget and option (or
+    # by an explicit key for calls), and only the latest value for each key
+    # is applied, so a burst of progress reports costs one redraw.
+    def __init__(self, on_wakeup=None):
+        self.lock = threading.Lock()
+        self.options = OrderedDict()
+        self.calls = OrderedDict()
+        self.unkeyed = deque()
+        self.on_wakeup = on_wakeup
+    
+    def set(self, widget, **options):
+        with self.lock:
+            for name, value in options.items():
+                self.options.pop((widget, name), None)
+                self.options[(widget, name)] = value
+        if self.on_wakeup is not None:
+            self.on_wakeup()
+    
+    def call(self, func, *args, key=None):
+        with self.lock:
+            if key is None:
+                self.unkeyed.append((func, args))
+            else:
+                self.calls.pop(key, None)
+                self.calls[key] = (func, args)
+        if self.on_wakeup is not None:
+            self.on_wakeup()
+    
+    def drain(self):
+        with self.lock:
+            options, self.options = self.options, OrderedDict()
+            calls = list(self.calls.values()) + list(self.unkeyed)
+            self.calls = OrderedDict()
+            self.unkeyed.clear()
+        
+        widgets = OrderedDict()
+        for (widget, name), value in options.items():
+            widgets.setdefault(widget, {})[name] = value
+        for widget, values in widgets.items():
+            try:
+                widget.config(**values)
+            except tk.TclError:
+                pass
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"UI update error: {str(e)}")
+
+class QueueView:
+    # Only the rows on screen exist as canvas items; they are reused as the
+    # view scrolls, so scrolling and edits cost the same for ten entries or
+    # fifty thousand. Clicks are mapped back to rows by their coordinates.
+    def __init__(self, parent, on_play, on_remove, on_move):
+        self.on_play = on_play
+        self.on_remove = on_remove
+        self.on_move = on_move
+        self.titles = []
+        self.colors = []
+        self.selected = -1
+        self.top = 0
+        self.rows = []
+        self.drag_index = None
+        self.redraw_pending = False
+        
+        self.canvas = tk.Canvas(parent, bg='#333333', highlightthickness=0, bd=0)
+        self.scrollbar = tk.Scrollbar(parent, orient="vertical", command=self.yview)
+        
+        self.canvas.bind('<Configure>', lambda e: self.redraw())
+        self.canvas.bind('<Button-1>', self.on_press)
+        self.canvas.bind('<B1-Motion>', self.on_drag)
+        self.canvas.bind('<ButtonRelease-1>', self.on_release)
+        self.canvas.bind('<MouseWheel>', self.on_wheel)
+        self.canvas.bind('<Button-4>', self.on_wheel)
+        self.canvas.bind('<Button-5>', self.on_wheel)
+    
+    def pack(self):
+        self.canvas.pack(side=tk.LEFT, fill='both', expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill='y')
+    
+    def size(self):
+        return len(self.titles)
+    
+    def get(self, index):
+        return self.titles[index]
+    
+    def page_size(self):
+        return max(1, self.canvas.winfo_height() // QUEUE_ROW_HEIGHT)
+    
+    def insert(self, index, titles):
+        if index == tk.END:
+            index = len(self.titles)
+        self.titles[index:index] = titles
+        self.colors[index:index] = [None] * len(titles)
+        if self.selected >= index:
+            self.selected += len(titles)
+        self.schedule_redraw()
+    
+    def delete(self, index):
+        del self.titles[index]
+        del self.colors[index]
+        if self.selected > index:
+            self.selected -= 1
+        elif self.selected == index:
+            self.selected = -1
+        self.schedule_redraw()
+    
+    def move(self, source, target):
+        self.titles.insert(target, self.titles.pop(source))
+        self.colors.insert(target, self.colors.pop(source))
+        self.schedule_redraw()
+    
+    def reset(self, titles):
+        self.titles = list(titles)
+        self.colors = [None] * len(self.titles)
+        self.selected = -1
+        self.schedule_redraw()
+    
+    def select(self, index):
+        self.selected = index
+        if index >= 0 and not self.top <= index < self.top + self.page_size():
+            self.top = index - self.page_size() // 2
+        self.schedule_redraw()
+    
+    def set_color(self, index, color):
+        if 0 <= index < len(self.colors) and self.colors[index] != color:
+            self.colors[index] = color
+            if self.top <= index <= self.top + self.page_size():
+                self.schedule_redraw()
+    
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self.top = int(float(args[1]) * len(self.titles))
+        elif args[0] == 'scroll':
+            amount = int(args[1])
+            if args[2] == 'pages':
+                amount *= self.page_size()
+            self.top += amount
+        self.redraw()
+    
+    def on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.top -= 3
+        else:
+            self.top += 3
+        self.redraw()
+    
+    def row_at(self, y):
+        index = self.top + int(y) // QUEUE_ROW_HEIGHT
+        return min(max(index, 0), len(self.titles) - 1)
+    
+    def on_press(self, event):
+        self.drag_index = None
+        if not self.titles or event.y >= (len(self.titles) - self.top) * QUEUE_ROW_HEIGHT:
+            return
+        index = self.row_at(event.y)
+        if event.x >= self.canvas.winfo_width() - QUEUE_REMOVE_WIDTH:
+            self.on_remove(index)
+        else:
+            self.drag_index = index
+    
+    def on_drag(self, event):
+        if self.drag_index is not None:
+            self.canvas.config(cursor='fleur')
+    
+    def on_release(self, event):
+        # Releasing on the pressed row plays it; releasing on another row
+        # moves the pressed track there.
+        self.canvas.config(cursor='')
+        source, self.drag_index = self.drag_index, None
+        if source is None or source >= len(self.titles):
+            return
+        target = self.row_at(event.y)
+        if target != source:
+            self.on_move(source, target)
+        else:
+            self.on_play(source)
+    
+    def schedule_redraw(self):
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.canvas.after_idle(self.redraw)
+    
+    def redraw(self):
+        self.redraw_pending = False
+        canvas = self.canvas
+        width = canvas.winfo_width()
+        count = self.page_size() + 1
+        self.top = max(0, min(self.top, len(self.titles) - self.page_size()))
+        
+        while len(self.rows) < count:
+            self.rows.append((
+                canvas.create_rectangle(0, 0, 0, 0, width=0),
+                canvas.create_text(0, 0, anchor='w', font=('Arial', 11)),
+                canvas.create_rectangle(0, 0, 0, 0, width=0, fill='#FF5252'),
+                canvas.create_text(0, 0, text="✕", font=('Arial', 10), fill='white'),
+            ))
+        
+        for position, (row, text, remove_row, remove_text) in enumerate(self.rows):
+            index = self.top + position
+            if position >= count or index >= len(self.titles):
+                for item in (row, text, remove_row, remove_text):
+                    canvas.itemconfigure(item, state='hidden')
+                continue
+            y = position * QUEUE_ROW_HEIGHT
+            selected = index == self.selected
+            canvas.coords(row, 0, y, width, y + QUEUE_ROW_HEIGHT)
+            canvas.itemconfigure(row, state='normal', fill='#4CAF50' if selected else '#333333')
+            canvas.coords(text, 6, y + QUEUE_ROW_HEIGHT // 2)
+            canvas.itemconfigure(text, state='normal', text=self.titles[index],
+                                 fill='white' if selected else self.colors[index] or 'white')
+            canvas.coords(remove_row, width - QUEUE_REMOVE_WIDTH, y + 1, width, y + QUEUE_ROW_HEIGHT - 1)
+            canvas.itemconfigure(remove_row, state='normal')
+            canvas.coords(remove_text, width - QUEUE_REMOVE_WIDTH // 2, y + QUEUE_ROW_HEIGHT // 2)
+            canvas.itemconfigure(remove_text, state='normal')
+        
+        total = len(self.titles)
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.page_size()) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
 class MusicPlayer:
     def __init__(self):
         self.window = tk.Tk()
         self.window.title("Audivine Music Player")
         self.window.configure(bg='#1E1E1E')
         
-        self.window.attributes('-toolwindow', False)
+        # -toolwindow only exists on Windows; X11 and macOS reject it.
+        if sys.platform == 'win32':
+            self.window.attributes('-toolwindow', False)
         self.window.wm_attributes('-topmost', False)
         self.window.resizable(True, True)
         
         self.window.minsize(800, 600)
         
-        self.is_playing = False
-        self.current_url = None
-        self.temp_dir = tempfile.gettempdir()
-        self.queue = []
-        self.current_song_index = -1
+        self.wake_lock = threading.Lock()
+        self.wake_pending = False
+        self.poll_job = None
+        self.window.bind('<<EngineWakeup>>', self.process_engine_calls)
+        self.ui = UiDispatcher(on_wakeup=self.wake)
+        self.voice_thread = None
+        self.startup_marks = [('imports', time.perf_counter())]
+        self.engine = PlayerEngine()
+        self.engine.on_wakeup = self.wake
+        self.engine.subscribe(self.on_engine_event)
+        self.control_server = None
+        self.volume_controller = None
+        self.volume_job = None
+        self.startup_marks.append(('audio engine', time.perf_counter()))
         
         screen_width = self.window.winfo_screenwidth()
         screen_height = self.window.winfo_screenheight()
@@ -130,8 +366,27 @@ class MusicPlayer:
         self.search_entry.bind('<FocusIn>', self.on_entry_click)
         self.search_entry.bind('<FocusOut>', self.on_focus_out)
         self.search_entry.bind('<Return>', self.search_and_add)
+        self.search_entry.bind('<Shift-Return>', lambda e: self.search_and_add(online=True))
+        self.search_entry.bind('<KeyRelease>', self.on_search_key)
+        self.search_entry.bind('<Down>', lambda e: self.move_suggestion(1))
+        self.search_entry.bind('<Up>', lambda e: self.move_suggestion(-1))
+        self.search_entry.bind('<Escape>', lambda e: self.hide_suggestions())
         self.search_entry.config(fg='grey')
         
+        self.suggest_job = None
+        self.search_container = search_container
+        self.suggestion_list = tk.Listbox(self.window,
+                                          font=('Arial', 11),
+                                          bg='#2D2D2D', fg='white',
+                                          selectmode=tk.SINGLE,
+                                          relief='flat',
+                                          activestyle='none',
+                                          highlightthickness=1,
+                                          highlightbackground='#4CAF50',
+                                          selectbackground='#4CAF50',
+                                          selectforeground='white')
+        self.suggestion_list.bind('<ButtonRelease-1>', self.pick_suggestion)
+        
         self.add_button = tk.Button(search_center, text="Search & Add",
                                    command=self.search_and_add,
                                    font=('Arial', 11, 'bold'),
@@ -150,7 +405,18 @@ class MusicPlayer:
                                     command=self.voice_search)
         self.voice_button.pack(side=tk.LEFT, padx=5)
         
-        for button in [self.add_button, self.voice_button]:
+        self.import_button = tk.Button(search_center, text="📋",
+                                     font=('Arial', 14, 'bold'),
+                                     bg='#4CAF50', fg='white',
+                                     relief='flat',
+                                     padx=10, pady=6,
+                                     cursor='hand2',
+                                     command=self.open_import_dialog)
+        self.import_button.pack(side=tk.LEFT, padx=5)
+        self.import_dialog = None
+        self.stats_dialog = None
+        
+        for button in [self.add_button, self.voice_button, self.import_button]:
             def on_enter(e, btn=button):
                 btn['background'] = '#45a049'
 
@@ -181,7 +447,6 @@ class MusicPlayer:
                 font=('Arial', 14, 'bold'),
                 bg='#2D2D2D', fg='white').grid(row=0, column=0, sticky='w')
         
-        self.replay_queue = False
         self.replay_button = tk.Button(queue_header,
                                       text="🔁",
                                       font=('Arial', 14),
@@ -190,33 +455,38 @@ class MusicPlayer:
                                       relief='flat',
                                       command=self.toggle_replay,
                                       cursor='hand2')
-        self.replay_button.grid(row=0, column=2, sticky='e')
+        self.replay_button.grid(row=0, column=4, sticky='e')
+        
+        self.shuffle_button = tk.Button(queue_header,
+                                       text="🔀",
+                                       font=('Arial', 14),
+                                       bg='#2D2D2D',
+                                       fg='white',
+                                       relief='flat',
+                                       command=self.shuffle_queue,
+                                       cursor='hand2')
+        self.shuffle_button.grid(row=0, column=2, sticky='e')
+        
+        self.undo_button = tk.Button(queue_header,
+                                    text="↶",
+                                    font=('Arial', 14),
+                                    bg='#2D2D2D',
+                                    fg='white',
+                                    relief='flat',
+                                    command=self.undo_queue_edit,
+                                    cursor='hand2')
+        self.undo_button.grid(row=0, column=3, sticky='e')
         
         listbox_frame = tk.Frame(self.queue_frame, bg='#2D2D2D')
         listbox_frame.grid(row=1, column=0, sticky='nsew', padx=10, pady=(0, 10))
         listbox_frame.grid_columnconfigure(0, weight=1)
         listbox_frame.grid_rowconfigure(0, weight=1)
         
-        self.queue_container = tk.Frame(listbox_frame, bg='#2D2D2D')
-        self.queue_container.pack(side=tk.LEFT, fill='both', expand=True)
-        
-        self.queue_listbox = tk.Listbox(self.queue_container, 
-                                       font=('Arial', 11),
-                                       bg='#333333', fg='white',
-                                       selectmode=tk.SINGLE,
-                                       relief='flat',
-                                       activestyle='none',
-                                       selectbackground='#4CAF50',
-                                       selectforeground='white')
-        self.queue_listbox.pack(side=tk.LEFT, fill='both', expand=True)
-        
-        self.remove_buttons_frame = tk.Frame(self.queue_container, bg='#333333')
-        self.remove_buttons_frame.pack(side=tk.RIGHT, fill='y')
-        
-        scrollbar = tk.Scrollbar(listbox_frame, orient="vertical",
-                                 command=self.queue_listbox.yview)
-        scrollbar.pack(side=tk.RIGHT, fill='y')
-        self.queue_listbox.config(yscrollcommand=scrollbar.set)
+        self.queue_view = QueueView(listbox_frame,
+                                    on_play=self.engine.play_index,
+                                    on_remove=self.remove_song,
+                                    on_move=self.engine.move)
+        self.queue_view.pack()
         
         now_playing_frame = tk.Frame(self.container, bg='#2D2D2D')
         now_playing_frame.grid(row=3, column=0, sticky='ew', pady=(0, 20))
@@ -279,15 +549,7 @@ class MusicPlayer:
         volume_container = tk.Frame(volume_frame, bg='#2D2D2D', padx=20, pady=15)
         volume_container.grid(row=0, column=0)
         
-        try:
-            devices = AudioUtilities.GetSpeakers()
-            interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-            self.volume_controller = cast(interface, POINTER(IAudioEndpointVolume))
-            current_vol = round((self.volume_controller.GetMasterVolumeLevelScalar() * 100))
-        except Exception as e:
-            print(f"Could not initialize system volume control: {e}")
-            self.volume_controller = None
-            current_vol = 50
+        current_vol = self.engine.volume
         
         self.last_volume = current_vol
         self.is_muted = False
@@ -333,201 +595,100 @@ class MusicPlayer:
         self.volume_slider.bind('<Button-4>', self.on_mouse_wheel)
         self.volume_slider.bind('<Button-5>', self.on_mouse_wheel)
         
-        self.check_music_end()
-        
-        self.queue_listbox.bind('<Button-1>', self.play_selected)
+        self.window.after_idle(self.process_engine_calls)
         
         self.window.bind('<space>', self.toggle_play_keyboard)
         self.window.bind('<Left>', self.play_previous_keyboard)
         self.window.bind('<Right>', self.play_next_keyboard)
         self.window.bind('<Up>', self.volume_up)
         self.window.bind('<Down>', self.volume_down)
+        self.window.bind('<Control-z>', self.undo_queue_edit)
+        self.window.bind('<Control-l>', self.open_stats_dialog)
         
         self.volume_slider.config(length=min(200, self.window.winfo_width() // 4))
         
         self.window.bind('<Configure>', self.on_window_resize)
         
+        self.window.protocol('WM_DELETE_WINDOW', self.on_close)
+        self.startup_marks.append(('window built', time.perf_counter()))
+        # Backends start once Tk has drawn the window, not before.
+        self.window.after_idle(self.window.after, 0, self.start_backends)
         self.window.mainloop()
     
-    def center_window(self, width, height):
-        self.window.lift()
-        self.window.attributes('-topmost', True)
-        self.window.attributes('-topmost', False)
+    def start_backends(self):
+        self.startup_marks.append(('first paint', time.perf_counter()))
+        if WARM_UP_ON_START and not PROFILE_STARTUP:
+            self.engine.warm_up()
+        self.init_system_volume()
+        try:
+            self.control_server = ControlServer(self.engine)
+            self.control_server.start()
+        except Exception as e:
+            print(f"Could not start control socket: {str(e)}")
+            self.control_server = None
+        self.startup_marks.append(('backends', time.perf_counter()))
+        
+        if PROFILE_STARTUP:
+            for name in PROFILED_IMPORTS:
+                optional_import(name)
+            self.print_startup_report()
+            self.on_close()
     
-    def play_selected(self, event=None):
-        selection = self.queue_listbox.curselection()
-        if selection:
-            index = selection[0]
-            if index != self.current_song_index:
-                self.current_song_index = index - 1
-                self.play_next()
-    
-    def add_to_queue(self):
-        url = self.url_var.get().strip()
-        if url:
-            try:
-                with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    title = info.get('title', 'Unknown Title')
-                
-                self.queue.append({'url': url, 'title': title})
-                self.queue_listbox.insert(tk.END, title)
-                self.url_var.set("")
-                
-                if not self.is_playing and len(self.queue) == 1:
-                    self.current_song_index = -1
-                    self.play_next()
-                    
-            except Exception as e:
-                self.now_playing_label.config(text=f"Error: {str(e)}")
-                print(f"Error adding to queue: {str(e)}")
+    def print_startup_report(self):
+        print("Startup:")
+        previous = STARTED
+        for name, mark in self.startup_marks:
+            print(f"  {name:<24}{(mark - previous) * 1000:8.1f} ms  (at {(mark - STARTED) * 1000:.1f} ms)")
+            previous = mark
+        print("Deferred imports:")
+        for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda item: -item[1]):
+            print(f"  {name:<24}{seconds * 1000:8.1f} ms")
     
-    def play_music(self, url, title):
+    def init_system_volume(self):
+        # pycaw drives the Windows endpoint volume; elsewhere the slider only
+        # sets the player's own volume.
+        if sys.platform != 'win32':
+            return
         try:
-            ydl_opts = {
-                'format': 'bestaudio[ext=m4a]/bestaudio/best',
-                'outtmpl': os.path.join(self.temp_dir, '%(id)s.%(ext)s'),
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                    'nopostoverwrites': False,
-                }],
-                'prefer_ffmpeg': True,
-                'keepvideo': False,
-                'extract_audio': True,
-                'audio_quality': 0,
-                'quiet': True,
-                'no_warnings': True,
-                'nocheckcertificate': True,
-                'buffersize': 1024*8,
-                'concurrent_fragments': 4,
-            }
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                video_id = info['id']
-                temp_file = os.path.join(self.temp_dir, f'{video_id}.mp3')
-                
-                if not os.path.exists(temp_file):
-                    ydl.download([url])
-
-                pygame.mixer.music.stop()
-                pygame.mixer.music.unload()
-                pygame.mixer.music.load(temp_file)
-                pygame.mixer.music.set_volume(self.volume_slider.get() / 100.0)
-                pygame.mixer.music.play()
-                
-                self.is_playing = True
-                self.play_button.config(text="⏸")
-                self.current_url = url
-                self.now_playing_label.config(text=f"Now Playing: {title}")
-                
+            ctypes = lazy_import('ctypes')
+            CLSCTX_ALL = lazy_import('comtypes').CLSCTX_ALL
+            pycaw = lazy_import('pycaw.pycaw')
+            devices = pycaw.AudioUtilities.GetSpeakers()
+            interface = devices.Activate(pycaw.IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
+            self.volume_controller = ctypes.cast(interface, ctypes.POINTER(pycaw.IAudioEndpointVolume))
+            current_vol = round((self.volume_controller.GetMasterVolumeLevelScalar() * 100))
         except Exception as e:
-            print(f"Playback error: {str(e)}")
-            self.play_button.config(text="▶")
-            self.is_playing = False
-            if self.current_song_index < len(self.queue) - 1:
-                self.window.after(1000, self.play_next)
+            print(f"Could not initialize system volume control: {e}")
+            self.volume_controller = None
+            return
+        self.last_volume = current_vol
+        self.volume_slider.set(current_vol)
+        self.set_volume(current_vol)
+    
+    def center_window(self, width, height):
+        self.window.lift()
+        self.window.attributes('-topmost', True)
+        self.window.attributes('-topmost', False)
     
     def toggle_play(self):
-        if self.is_playing:
-            pygame.mixer.music.pause()
-            self.is_playing = False
-            self.play_button.config(text="▶")
-            self.play_button.config(bg='#2D2D2D')
-            self.now_playing_label.config(text=f"Paused: {self.queue[self.current_song_index]['title']}")
-        else:
-            if self.current_url:
-                pygame.mixer.music.unpause()
-                self.is_playing = True
-                self.play_button.config(text="⏸")
-                self.play_button.config(bg='#4CAF50')
-                self.now_playing_label.config(text=f"Now Playing: {self.queue[self.current_song_index]['title']}")
-            elif self.queue:
-                if self.current_song_index == -1:
-                    self.current_song_index = 0
-                song = self.queue[self.current_song_index]
-                threading.Thread(target=self.play_music, 
-                               args=(song['url'], song['title']), 
-                               daemon=True).start()
+        self.engine.toggle_play()
     
     def stop_music(self):
-        pygame.mixer.music.stop()
-        pygame.mixer.music.unload()
-        self.is_playing = False
-        self.play_button.config(text="▶")
-        self.now_playing_label.config(text="Not Playing")
-        self.current_url = None
+        self.engine.stop_music()
     
     def play_next(self):
-        if self.current_song_index < len(self.queue) - 1:
-            self.current_song_index += 1
-            song = self.queue[self.current_song_index]
-            threading.Thread(target=self.play_music, 
-                           args=(song['url'], song['title']), 
-                           daemon=True).start()
-            self.queue_listbox.selection_clear(0, tk.END)
-            self.queue_listbox.selection_set(self.current_song_index)
-            self.queue_listbox.see(self.current_song_index)
-        else:
-            if self.replay_queue and self.queue:
-                self.current_song_index = 0
-                song = self.queue[0]
-                threading.Thread(target=self.play_music, 
-                               args=(song['url'], song['title']), 
-                               daemon=True).start()
-                self.queue_listbox.selection_clear(0, tk.END)
-                self.queue_listbox.selection_set(0)
-                self.queue_listbox.see(0)
-            else:
-                self.stop_music()
-                self.now_playing_label.config(text="End of Queue")
+        self.engine.play_next()
     
     def play_previous(self):
-        if self.current_url and self.current_song_index >= 0:
-            if pygame.mixer.music.get_pos() > 3000:
-                pygame.mixer.music.rewind()
-                pygame.mixer.music.play()
-                self.is_playing = True
-                self.play_button.config(text="⏸")
-                return
-            
-            if self.current_song_index > 0:
-                self.current_song_index -= 1
-                song = self.queue[self.current_song_index]
-                threading.Thread(target=self.play_music, 
-                               args=(song['url'], song['title']), 
-                               daemon=True).start()
-                self.queue_listbox.selection_clear(0, tk.END)
-                self.queue_listbox.selection_set(self.current_song_index)
-                self.queue_listbox.see(self.current_song_index)
-            else:
-                pygame.mixer.music.rewind()
-                pygame.mixer.music.play()
-                self.is_playing = True
-                self.play_button.config(text="⏸")
-    
-    def remove_selected(self):
-        selection = self.queue_listbox.curselection()
-        if selection:
-            index = selection[0]
-            self.queue_listbox.delete(index)
-            removed_song = self.queue.pop(index)
-            
-            if index == self.current_song_index:
-                self.stop_music()
-                if index < len(self.queue):
-                    self.play_next()
-                elif self.queue:
-                    self.current_song_index = len(self.queue) - 1
-                    self.play_next()
-            elif index < self.current_song_index:
-                self.current_song_index -= 1
+        self.engine.play_previous()
     
     def set_volume(self, value):
         volume = float(value) / 100.0
-        pygame.mixer.music.set_volume(volume)
+        self.engine.set_volume(value, log=False)
+        # Journal the volume once the slider (or wheel) stops moving.
+        if self.volume_job is not None:
+            self.window.after_cancel(self.volume_job)
+        self.volume_job = self.window.after(VOLUME_LOG_DELAY_MS, self.log_volume)
         self.volume_label.config(text=f"{int(float(value))}%")
         self.update_volume_icon(value)
         self.is_muted = (float(value) == 0)
@@ -537,27 +698,111 @@ class MusicPlayer:
             except Exception as e:
                 print(f"Could not set system volume: {e}")
     
-    def check_music_end(self):
-        if self.is_playing:
-            if not pygame.mixer.music.get_busy() and not pygame.mixer.get_init() is None:
-                self.window.after(500, self.confirm_song_end)
-        
-        self.window.after(1000, self.check_music_end)
-
-    def confirm_song_end(self):
-        if self.is_playing and not pygame.mixer.music.get_busy():
-            if self.current_song_index < len(self.queue) - 1:
-                self.play_next()
-            else:
-                if self.replay_queue and self.queue:
-                    self.current_song_index = -1
-                    self.play_next()
-                    self.queue_listbox.selection_clear(0, tk.END)
-                    self.queue_listbox.selection_set(0)
-                    self.queue_listbox.see(0)
-                else:
-                    self.stop_music()
-                    self.now_playing_label.config(text="End of Queue")
+    def log_volume(self):
+        self.volume_job = None
+        self.engine.log_volume()
+    
+    def on_engine_event(self, event, data):
+        if event == 'queue_added':
+            self.queue_view.insert(tk.END, [data['title']])
+            query = data.get('query')
+            if query and self.search_var.get().strip() == query:
+                self.search_var.set("")
+                self.search_entry.focus_set()
+                self.search_entry.config(fg='white')
+        elif event == 'queue_removed':
+            self.queue_view.delete(data['index'])
+        elif event == 'queue_inserted':
+            self.queue_view.insert(data['index'], data['titles'])
+        elif event == 'queue_moved':
+            self.queue_view.move(data['source'], data['target'])
+            self.queue_view.select(data['index'])
+        elif event == 'queue_reset':
+            self.queue_view.reset(data['titles'])
+            self.queue_view.select(data['index'])
+        elif event == 'track':
+            self.queue_view.select(data['index'])
+        elif event == 'state':
+            self.show_state(data['state'], data.get('title'))
+        elif event == 'message':
+            self.ui.set(self.now_playing_label, text=data['text'])
+        elif event == 'replay':
+            self.ui.set(self.replay_button, fg='#4CAF50' if data['enabled'] else 'grey')
+        elif event == 'download':
+            self.show_download(data['index'], data['state'], data['progress'])
+        elif event == 'import':
+            self.show_import_progress(data)
+        elif event == 'import_entry':
+            self.show_import_entry(data)
+        elif event == 'volume':
+            self.ui.call(self.show_volume, data['value'], key='volume')
+    
+    def show_volume(self, value):
+        if int(self.volume_slider.get()) != value:
+            self.volume_slider.set(value)
+    
+    def show_state(self, state, title):
+        if state == 'playing':
+            self.ui.set(self.play_button, text="⏸", bg='#4CAF50')
+            self.ui.set(self.now_playing_label, text=f"Now Playing: {title}")
+        elif state == 'paused':
+            self.ui.set(self.play_button, text="▶", bg='#2D2D2D')
+            self.ui.set(self.now_playing_label, text=f"Paused: {title}")
+        else:
+            self.ui.set(self.play_button, text="▶")
+            if state == 'stopped':
+                self.ui.set(self.now_playing_label, text="Not Playing")
+            elif state == 'loading':
+                self.ui.set(self.now_playing_label, text=f"Loading: {title}")
+            elif state == 'ended':
+                self.ui.set(self.now_playing_label, text="End of Queue")
+    
+    def show_download(self, index, state, progress):
+        colors = {'queued': 'grey', 'paused': 'grey', 'downloading': '#FFC107', 'failed': '#FF5252'}
+        self.queue_view.set_color(index, colors.get(state))
+        if state == 'downloading' and index == self.engine.queue.position() and not self.engine.is_playing:
+            text = f"Buffering: {self.engine.current_title()}"
+            if progress is not None:
+                text += f" ({int(progress * 100)}%)"
+            self.ui.set(self.now_playing_label, text=text)
+    
+    def wake(self):
+        # May run on any thread. One wake-up is queued at a time; anything
+        # posted while it is being handled queues the next one.
+        with self.wake_lock:
+            if self.wake_pending:
+                return
+            self.wake_pending = True
+        try:
+            self.window.event_generate('<<EngineWakeup>>', when='tail')
+        except (RuntimeError, tk.TclError):
+            # Before the main loop starts or after the window is gone; the
+            # first pass of the main loop picks up anything left.
+            with self.wake_lock:
+                self.wake_pending = False
+    
+    def process_engine_calls(self, event=None):
+        with self.wake_lock:
+            self.wake_pending = False
+        if self.poll_job is not None:
+            self.window.after_cancel(self.poll_job)
+            self.poll_job = None
+        self.engine.process_pending()
+        self.ui.drain()
+        # The play position is saved now and then while playing; otherwise
+        # the window sleeps until the engine, the track end watcher or a
+        # worker thread wakes it.
+        if self.engine.is_playing:
+            self.poll_job = self.window.after(int(SESSION_POSITION_INTERVAL * 1000), self.process_engine_calls)
+    
+    def on_close(self):
+        if self.control_server:
+            self.control_server.close()
+        if self.volume_job is not None:
+            self.window.after_cancel(self.volume_job)
+            self.log_volume()
+        self.engine.close()
+        self.window.destroy()
     
     def toggle_play_keyboard(self, event=None):
         self.toggle_play()
@@ -586,128 +831,195 @@ class MusicPlayer:
             self.search_entry.config(fg='white')
     
     def on_focus_out(self, event):
+        # Clicking a suggestion moves focus away first, so the list stays up
+        # long enough for the click to land.
+        self.window.after(200, self.hide_suggestions)
         if not self.search_entry.get():
             self.search_entry.insert(0, "Search for a song...")
             self.search_entry.config(fg='grey')
     
-    def search_and_add(self, event=None):
+    def on_search_key(self, event):
+        if event.keysym in ('Up', 'Down', 'Return', 'KP_Enter', 'Escape'):
+            return
+        if self.suggest_job is not None:
+            self.window.after_cancel(self.suggest_job)
+        self.suggest_job = self.window.after(SUGGEST_DEBOUNCE_MS, self.update_suggestions)
+    
+    def update_suggestions(self):
+        self.suggest_job = None
+        text = self.search_var.get().strip()
+        if not text or text == "Search for a song..." or self.window.focus_get() is not self.search_entry:
+            self.hide_suggestions()
+            return
+        items = [item for item in self.engine.suggest(text) if item.casefold() != text.casefold()]
+        if not items:
+            self.hide_suggestions()
+            return
+        self.suggestion_list.delete(0, tk.END)
+        self.suggestion_list.insert(tk.END, *items)
+        self.suggestion_list.config(height=len(items))
+        self.suggestion_list.place(in_=self.search_container, relx=0, rely=1.0, relwidth=1.0)
+        self.suggestion_list.lift()
+    
+    def suggestions_visible(self):
+        return bool(self.suggestion_list.winfo_manager())
+    
+    def hide_suggestions(self):
+        if self.suggest_job is not None:
+            self.window.after_cancel(self.suggest_job)
+            self.suggest_job = None
+        if self.suggestions_visible():
+            self.suggestion_list.place_forget()
+    
+    def move_suggestion(self, step):
+        if not self.suggestions_visible():
+            return None
+        selection = self.suggestion_list.curselection()
+        index = selection[0] + step if selection else (0 if step > 0 else self.suggestion_list.size() - 1)
+        self.suggestion_list.selection_clear(0, tk.END)
+        if 0 <= index < self.suggestion_list.size():
+            self.suggestion_list.selection_set(index)
+            self.suggestion_list.see(index)
+        return 'break'
+    
+    def pick_suggestion(self, event=None):
+        selection = self.suggestion_list.curselection()
+        if selection:
+            self.search_var.set(self.suggestion_list.get(selection[0]))
+            self.search_entry.config(fg='white')
+            self.search_and_add()
+    
+    def search_and_add(self, event=None, online=False):
+        if self.suggestions_visible():
+            selection = self.suggestion_list.curselection()
+            if selection:
+                self.search_var.set(self.suggestion_list.get(selection[0]))
+            self.hide_suggestions()
         query = self.search_var.get().strip()
         if query and query != "Search for a song...":
-            try:
-                search = VideosSearch(query, limit=1, region='US')
-                results = search.result()
-                
-                if results and results['result']:
-                    video = results['result'][0]
-                    url = video['link']
-                    title = video['title']
-                    duration = video.get('duration', 'Unknown')
-                    
-                    self.queue.append({
-                        'url': url, 
-                        'title': f"{title} ({duration})"
-                    })
-                    self.queue_listbox.insert(tk.END, f"{title} ({duration})")
-                    
-                    self.search_var.set("")
-                    self.search_entry.focus_set()
-                    self.search_entry.config(fg='white')
-                    
-                    if len(self.queue) == 1:
-                        self.current_song_index = 0
-                        threading.Thread(target=self.play_music, 
-                                      args=(url, f"{title} ({duration})"), 
-                                      daemon=True).start()
-                        self.queue_listbox.selection_clear(0, tk.END)
-                        self.queue_listbox.selection_set(0)
-                        self.queue_listbox.see(0)
-                else:
-                    self.now_playing_label.config(text="No results found")
-                    
-            except Exception as e:
-                try:
-                    with yt_dlp.YoutubeDL({
-                        'quiet': True,
-                        'format': 'bestaudio/best',
-                        'default_search': 'ytsearch',
-                        'noplaylist': True
-                    }) as ydl:
-                        search_query = f"ytsearch1:{query}"
-                        result = ydl.extract_info(search_query, download=False)
-                        
-                        if 'entries' in result and result['entries']:
-                            video = result['entries'][0]
-                            url = video['webpage_url']
-                            title = video['title']
-                            duration = str(video.get('duration', 'Unknown'))
-                            
-                            self.queue.append({
-                                'url': url, 
-                                'title': f"{title} ({duration}s)"
-                            })
-                            self.queue_listbox.insert(tk.END, f"{title} ({duration}s)")
-                            
-                            self.search_var.set("")
-                            self.search_entry.focus_set()
-                            self.search_entry.config(fg='white')
-                            
-                            if len(self.queue) == 1:
-                                self.current_song_index = 0
-                                threading.Thread(target=self.play_music, 
-                                              args=(url, f"{title} ({duration}s)"), 
-                                              daemon=True).start()
-                                self.queue_listbox.selection_clear(0, tk.END)
-                                self.queue_listbox.selection_set(0)
-                                self.queue_listbox.see(0)
-                        else:
-                            self.now_playing_label.config(text="No results found")
-                            
-                except Exception as e2:
-                    self.now_playing_label.config(text="Could not find song")
-
-        remove_btn = tk.Button(self.remove_buttons_frame,
-                              text="✕",
-                              font=('Arial', 10),
-                              bg='#FF5252',
-                              fg='white',
-                              relief='flat',
-                              command=lambda idx=len(self.queue)-1: self.remove_song(idx))
-        remove_btn.pack(pady=1)
-
+            if online and not query.lower().startswith(ONLINE_SEARCH_PREFIX):
+                query = f"{ONLINE_SEARCH_PREFIX} {query}"
+            self.engine.enqueue(query)
+    
+    def open_import_dialog(self):
+        if self.import_dialog is not None and self.import_dialog.winfo_exists():
+            self.import_dialog.lift()
+            return
+        dialog = tk.Toplevel(self.window, bg='#1E1E1E', padx=20, pady=20)
+        dialog.title("Import Songs")
+        dialog.geometry('600x560')
+        self.import_dialog = dialog
+        self.import_id = None
+        
+        tk.Label(dialog, text="Paste one song or URL per line, or load a text/CSV file",
+                font=('Arial', 11), bg='#1E1E1E', fg='white').pack(anchor='w')
+        self.import_text = tk.Text(dialog, height=10, font=('Arial', 11),
+                                   bg='#2D2D2D', fg='white', insertbackground='white',
+                                   relief='flat')
+        self.import_text.pack(fill='x', pady=10)
+        
+        buttons = tk.Frame(dialog, bg='#1E1E1E')
+        buttons.pack(fill='x')
+        button_style = {'font': ('Arial', 11, 'bold'), 'bg': '#4CAF50', 'fg': 'white',
+                        'relief': 'flat', 'padx': 15, 'pady': 5, 'cursor': 'hand2'}
+        tk.Button(buttons, text="Load File...", command=self.load_import_file,
+                  **button_style).pack(side=tk.LEFT)
+        tk.Button(buttons, text="Import", command=self.start_import,
+                  **button_style).pack(side=tk.RIGHT)
+        
+        self.import_status = tk.Label(dialog, text="", font=('Arial', 10),
+                                      bg='#1E1E1E', fg='grey')
+        self.import_status.pack(anchor='w', pady=(10, 5))
+        self.import_list = tk.Listbox(dialog, font=('Arial', 10),
+                                      bg='#333333', fg='white', relief='flat',
+                                      activestyle='none')
+        self.import_list.pack(fill='both', expand=True)
+    
+    def load_import_file(self):
+        from tkinter import filedialog
+        path = filedialog.askopenfilename(parent=self.import_dialog,
+                                          filetypes=[("Song lists", "*.txt *.csv"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            queries = read_import_file(path)
+        except Exception as e:
+            self.import_status.config(text=f"Could not read file: {str(e)}", fg='#FF5252')
+            return
+        self.import_text.delete('1.0', tk.END)
+        self.import_text.insert('1.0', '\n'.join(queries))
+    
+    def start_import(self):
+        queries = parse_import_text(self.import_text.get('1.0', tk.END))
+        if not queries:
+            return
+        if self.import_id is not None:
+            self.engine.cancel_import(self.import_id)
+        self.import_list.delete(0, tk.END)
+        for query in queries:
+            self.import_list.insert(tk.END, f"…  {query}")
+            self.import_list.itemconfig(tk.END, fg='grey')
+        self.import_id = self.engine.import_queries(queries)
+    
+    def import_dialog_open(self, import_id):
+        return (self.import_dialog is not None and self.import_dialog.winfo_exists()
+                and import_id == self.import_id)
+    
+    def show_import_progress(self, data):
+        if not self.import_dialog_open(data['id']):
+            return
+        done = data['resolved'] + data['failed']
+        text = f"Resolved {done} of {data['total']}, added {data['added']} to the queue"
+        if data['failed']:
+            text += f", {data['failed']} not found"
+        if data['cancelled']:
+            text += " (cancelled)"
+        self.ui.set(self.import_status, text=text, fg='#FF5252' if data['failed'] else 'grey')
+    
+    def show_import_entry(self, data):
+        if not self.import_dialog_open(data['id']):
+            return
+        position = data['position']
+        if data['state'] == 'resolved':
+            text, color = f"✓  {data['title']}", '#4CAF50'
+        else:
+            text, color = f"✕  {data['query']} ({data['error']})", '#FF5252'
+        self.import_list.delete(position)
+        self.import_list.insert(position, text)
+        self.import_list.itemconfig(position, fg=color)
+    
+    def open_stats_dialog(self, event=None):
+        if self.stats_dialog is not None and self.stats_dialog.winfo_exists():
+            self.stats_dialog.lift()
+            return
+        dialog = tk.Toplevel(self.window, bg='#1E1E1E', padx=20, pady=20)
+        dialog.title("Latency and storage")
+        dialog.geometry('680x420')
+        self.stats_dialog = dialog
+        self.stats_label = tk.Label(dialog, text="", font=('Courier', 10), justify='left',
+                                    anchor='nw', bg='#1E1E1E', fg='white')
+        self.stats_label.pack(fill='both', expand=True)
+        self.refresh_stats()
+    
+    def refresh_stats(self):
+        if self.stats_dialog is None or not self.stats_dialog.winfo_exists():
+            return
+        storage = self.engine.storage_stats()
+        self.stats_label.config(text=format_latency_stats(self.engine.tracer.summary()) + '\n\n' +
+                                format_storage_stats(storage['cache'], storage['library']))
+        self.window.after(STATS_REFRESH_MS, self.refresh_stats)
+    
     def remove_song(self, index):
-        if 0 <= index < len(self.queue):
-            self.queue_listbox.delete(index)
-            self.queue.pop(index)
-            
-            for widget in self.remove_buttons_frame.winfo_children():
-                widget.destroy()
-            
-            for i in range(len(self.queue)):
-                remove_btn = tk.Button(self.remove_buttons_frame,
-                                     text="✕",
-                                     font=('Arial', 10),
-                                     bg='#FF5252',
-                                     fg='white',
-                                     relief='flat',
-                                     command=lambda idx=i: self.remove_song(idx))
-                remove_btn.pack(pady=1)
-            
-            if index == self.current_song_index:
-                self.stop_music()
-                if index < len(self.queue):
-                    self.play_next()
-                elif self.queue:
-                    self.current_song_index = len(self.queue) - 1
-                    self.play_next()
-            elif index < self.current_song_index:
-                self.current_song_index -= 1
+        self.engine.remove(index)
 
     def toggle_replay(self):
-        self.replay_queue = not self.replay_queue
-        if self.replay_queue:
-            self.replay_button.config(fg='#4CAF50')
-        else:
-            self.replay_button.config(fg='grey')
+        self.engine.toggle_replay()
+
+    def shuffle_queue(self):
+        self.engine.shuffle()
+
+    def undo_queue_edit(self, event=None):
+        self.engine.undo()
 
     def add_button_hover_effect(self, button):
         def on_enter(e):
@@ -724,38 +1036,51 @@ class MusicPlayer:
         button.bind("<Button-1>", on_click)
 
     def voice_search(self):
+        if self.voice_thread and self.voice_thread.is_alive():
+            return
+        try:
+            sr = lazy_import('speech_recognition')
+        except ImportError:
+            self.ui.set(self.now_playing_label, text="Voice search needs the SpeechRecognition package.")
+            return
+        self.voice_button.config(bg='#FF5252')
+        # Listening blocks for several seconds, so it runs off the Tk thread
+        # and reports back through the dispatcher.
+        self.voice_thread = threading.Thread(target=self.listen_for_query, args=(sr,), daemon=True)
+        self.voice_thread.start()
+    
+    def listen_for_query(self, sr):
         try:
             r = sr.Recognizer()
             
-            self.voice_button.config(bg='#FF5252')
-            self.voice_button.update()
-            
             with sr.Microphone() as source:
-                self.now_playing_label.config(text="Listening... Speak now")
+                self.ui.set(self.now_playing_label, text="Listening... Speak now")
                 
                 r.adjust_for_ambient_noise(source, duration=0.5)
                 
                 audio = r.listen(source, timeout=5, phrase_time_limit=5)
                 
-                self.now_playing_label.config(text="Processing speech...")
+                self.ui.set(self.now_playing_label, text="Processing speech...")
                 
                 query = r.recognize_google(audio)
                 
-                self.search_var.set(query)
-                self.search_entry.config(fg='white')
-                
-                self.search_and_add()
+                self.ui.call(self.search_spoken_query, query)
                 
         except sr.WaitTimeoutError:
-            self.now_playing_label.config(text="No speech detected. Please try again.")
+            self.ui.set(self.now_playing_label, text="No speech detected. Please try again.")
         except sr.RequestError:
-            self.now_playing_label.config(text="Could not connect to speech recognition service.")
+            self.ui.set(self.now_playing_label, text="Could not connect to speech recognition service.")
         except sr.UnknownValueError:
-            self.now_playing_label.config(text="Could not understand audio. Please try again.")
+            self.ui.set(self.now_playing_label, text="Could not understand audio. Please try again.")
         except Exception as e:
-            self.now_playing_label.config(text=f"Error: {str(e)}")
+            self.ui.set(self.now_playing_label, text=f"Error: {str(e)}")
         finally:
-            self.voice_button.config(bg='#4CAF50')
+            self.ui.set(self.voice_button, bg='#4CAF50')
+    
+    def search_spoken_query(self, query):
+        self.search_var.set(query)
+        self.search_entry.config(fg='white')
+        self.search_and_add()
 
     def on_mouse_wheel(self, event):
         current_volume = self.volume_slider.get()
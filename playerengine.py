@@ -0,0 +1,3875 @@
+import os
+import sys
+import threading
+import subprocess
+import json
+import time
+import shutil
+import queue
+import socket
+import sqlite3
+import math
+import importlib
+import heapq
+import csv
+import itertools
+import random
+import bisect
+import hmac
+import secrets
+import functools
+import re
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, parse_qs
+
+# pygame, yt_dlp and the search client are imported on first use; yt_dlp
+# alone takes longer to import than the window takes to appear.
+IMPORT_TIMES = OrderedDict()
+pygame = None
+TRACK_END_EVENT = None
+
+def lazy_import(name):
+    if name in sys.modules:
+        return importlib.import_module(name)
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.setdefault(name, time.perf_counter() - started)
+    return module
+
+def optional_import(name):
+    try:
+        return lazy_import(name)
+    except ImportError:
+        return None
+
+def init_audio():
+    global pygame, TRACK_END_EVENT
+    if pygame is not None:
+        return
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    module = lazy_import('pygame')
+    module.mixer.init()
+    module.display.init()
+    
+    TRACK_END_EVENT = module.USEREVENT + 1
+    module.event.set_blocked(None)
+    module.event.set_allowed([TRACK_END_EVENT])
+    module.mixer.music.set_endevent(TRACK_END_EVENT)
+    pygame = module
+
+PREFETCH_COUNT = 2
+CACHE_WARM_COUNT = 3
+
+DOWNLOAD_WORKERS = 2
+DOWNLOAD_RATE_LIMIT = None
+DOWNLOAD_FRAGMENTS = 4
+DOWNLOAD_BUFFER_SIZE = 1024 * 8
+DOWNLOAD_PROGRESS_INTERVAL = 0.25
+PRIORITY_CURRENT, PRIORITY_NEXT, PRIORITY_PREFETCH, PRIORITY_BACKGROUND = range(4)
+
+ADAPTIVE_FORMAT = True
+ADAPTIVE_TARGET_SECONDS = 3.0
+ADAPTIVE_UPGRADE = True
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.audivine', 'cache')
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+CACHE_POLICY = 'lru'
+
+STREAMING_MODE = True
+STREAM_PREBUFFER_SECONDS = 2.0
+STREAM_MAX_BUFFER_SECONDS = 60.0
+
+RESOLVE_TTL_SECONDS = 4 * 60 * 60
+RESOLVE_CACHE_SIZE = 500
+RESOLVER_POOL_SIZE = 3
+
+SEARCH_WORKERS = 4
+SEARCH_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.audivine', 'search_cache.json')
+SEARCH_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+SEARCH_CACHE_MAX_ENTRIES = 5000
+SEARCH_CACHE_SAVE_DELAY = 2.0
+SEARCH_HEDGE_DELAY_SECONDS = 0.8
+LIBRARY_PATH = os.path.join(os.path.expanduser('~'), '.audivine', 'library.db')
+LIBRARY_SEARCH = True
+# A library song answers a search only if the query is its whole title or
+# covers at least this share of the title's words (noise words aside).
+LIBRARY_MIN_SCORE = 0.5
+LIBRARY_FIND_CANDIDATES = 5
+LIBRARY_TITLE_NOISE = frozenset({'official', 'video', 'audio', 'music', 'lyrics', 'lyric', 'hd',
+                                 'hq', '4k', 'remastered', 'remaster', 'visualizer', 'ft', 'feat'})
+# Queries starting with this skip the library and always search online.
+ONLINE_SEARCH_PREFIX = 'web:'
+SUGGEST_LIMIT = 8
+SUGGEST_WORD_STARTS = 4
+SUGGEST_BLOCK_SIZE = 64
+SUGGEST_BULK_SIZE = 256
+SUGGEST_SORT_CHUNK = 4096
+IMPORT_WORKERS = 4
+# CSV header names that are read as (or alongside) url, query, artist, title.
+IMPORT_COLUMNS = {'url': 'url', 'link': 'url', 'query': 'query', 'search': 'query',
+                  'artist': 'artist', 'artists': 'artist', 'title': 'title', 'song': 'title',
+                  'track': 'title', 'track name': 'title', 'name': 'title', 'album': 'album'}
+PLAYLIST_PAGE_SIZE = 100
+PLAYLIST_LOOKAHEAD = 5
+QUEUE_BLOCK_SIZE = 512
+QUEUE_UNDO_DEPTH = 50
+WARM_UP_ON_START = True
+WARM_UP_URL = 'https://www.youtube.com/'
+
+CROSSFADE_SECONDS = 0.0
+
+TRANSCODE_FALLBACK = False
+MIXER_NATIVE_EXTENSIONS = ('mp3', 'ogg', 'wav', 'flac')
+CONTAINER_FORMATS = {'m4a': 'mp4', 'mp4': 'mp4', 'webm': 'webm', 'ogg': 'ogg', 'opus': 'ogg', 'mp3': 'mp3'}
+
+SESSION_DIR = os.path.join(os.path.expanduser('~'), '.audivine', 'session')
+SESSION_RESTORE = True
+SESSION_COMPACT_EVENTS = 1000
+SESSION_POSITION_INTERVAL = 5.0
+
+# Every search and every track start is timed stage by stage; the last
+# TRACE_WINDOW timings per stage give the percentiles in the stats view, and
+# each finished search or start is appended to the trace log as a JSON line.
+TRACE_WINDOW = 1000
+TRACE_LOG_PATH = os.path.join(os.path.expanduser('~'), '.audivine', 'trace.log')
+TRACE_LOG_MAX_BYTES = 1024 * 1024
+TRACE_OPEN_LIMIT = 100
+
+CONTROL_SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.audivine', 'control.sock')
+CONTROL_PORT = 47800
+# Every command must carry the token the running player wrote here; the file
+# is readable by the current user only.
+CONTROL_TOKEN_PATH = os.path.join(os.path.expanduser('~'), '.audivine', 'control.token')
+
+def video_id_from_url(url):
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+    host = parsed.netloc.lower()
+    if host.endswith('youtu.be'):
+        return parsed.path.strip('/') or None
+    if 'youtube.com' in host:
+        if parsed.path == '/watch':
+            return parse_qs(parsed.query).get('v', [None])[0]
+        for prefix in ('/shorts/', '/embed/', '/live/'):
+            if parsed.path.startswith(prefix):
+                return parsed.path[len(prefix):].split('/')[0] or None
+    return None
+
+def playlist_id_from_url(url):
+    # Only explicit playlist pages and mixes expand; a plain watch link that
+    # happens to carry a list= still queues just that video.
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+    if 'youtube.com' not in parsed.netloc.lower():
+        return None
+    list_id = parse_qs(parsed.query).get('list', [None])[0]
+    if list_id and (parsed.path == '/playlist' or list_id.startswith('RD')):
+        return list_id
+    return None
+
+def playlist_entry_song(entry):
+    video_id = entry.get('id')
+    url = entry.get('url') or ''
+    if not url.startswith(('http://', 'https://')):
+        if not video_id:
+            return None
+        url = f'https://www.youtube.com/watch?v={video_id}'
+    title = entry.get('title') or video_id or url
+    duration = entry.get('duration')
+    if duration:
+        title = f"{title} ({int(duration) // 60}:{int(duration) % 60:02d})"
+    return {'url': url, 'title': title, 'id': video_id}
+
+def audio_codec(info):
+    acodec = (info.get('acodec') or '').lower()
+    if acodec.startswith('mp4a'):
+        return 'aac'
+    for codec in ('opus', 'vorbis', 'mp3', 'flac'):
+        if acodec.startswith(codec):
+            return codec
+    return info.get('ext') or 'unknown'
+
+def format_bitrate(fmt):
+    return fmt.get('abr') or fmt.get('tbr') or 0
+
+def default_audio_format(formats):
+    # The format the default selector, 'bestaudio[ext=m4a]/bestaudio/best',
+    # downloads, by the same bitrate ordering choose_audio_format uses.
+    audio = [fmt for fmt in formats or []
+             if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+    preferred = [fmt for fmt in audio if fmt.get('ext') == 'm4a'] or audio
+    return max(preferred, key=format_bitrate, default=None)
+
+def choose_audio_format(formats, throughput, target_seconds, buffer_seconds):
+    # Picks the richest audio-only format whose first buffer_seconds arrive
+    # within target_seconds at the measured throughput (bytes per second).
+    # None means there is no reason to go below the default format: the pick
+    # is what the default selector would take anyway, or better than it.
+    if not throughput:
+        return None
+    candidates = sorted((fmt for fmt in formats or []
+                         if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')
+                         and fmt.get('url') and fmt.get('ext') in CONTAINER_FORMATS
+                         and format_bitrate(fmt)),
+                        key=format_bitrate)
+    if not candidates:
+        return None
+    chosen = candidates[0]
+    for fmt in candidates:
+        needed = format_bitrate(fmt) * 1000 / 8 * buffer_seconds
+        if needed / throughput <= target_seconds:
+            chosen = fmt
+    default = default_audio_format(formats) or candidates[-1]
+    if chosen is default or format_bitrate(chosen) >= format_bitrate(default):
+        return None
+    return chosen
+
+def file_extension(path):
+    return os.path.splitext(path)[1].lstrip('.').lower()
+
+def stream_expiry(stream_url):
+    try:
+        expire = parse_qs(urlparse(stream_url).query).get('expire', [None])[0]
+        return float(expire) if expire else None
+    except (ValueError, TypeError):
+        return None
+
+class LatencyTracer:
+    # A span times one stage and always feeds that stage's rolling window.
+    # When its key (a search query or a track URL) has an open trace, the span
+    # is also added to that trace, so the log line for a slow start shows
+    # every stage it waited on, including ones that ran on download threads.
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, log_path=TRACE_LOG_PATH, window=TRACE_WINDOW, max_log_bytes=TRACE_LOG_MAX_BYTES):
+        self.log_path = log_path
+        self.window = window
+        self.max_log_bytes = max_log_bytes
+        self.samples = {}
+        self.flags = {}
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+        self.log_lock = threading.Lock()
+
+    def begin(self, kind, key, **fields):
+        trace = dict({'kind': kind, 'key': key, 'time': round(time.time(), 3)}, **fields)
+        trace['spans'] = []
+        with self.lock:
+            self.traces.pop(key, None)
+            self.traces[key] = (time.perf_counter(), trace)
+            # A start that never reaches the speaker (stopped while buffering)
+            # is dropped here rather than kept forever.
+            while len(self.traces) > TRACE_OPEN_LIMIT:
+                self.traces.popitem(last=False)
+
+    def flag(self, key, name, value):
+        with self.lock:
+            counts = self.flags.setdefault(name, {})
+            counts[value] = counts.get(value, 0) + 1
+            entry = self.traces.get(key)
+            if entry is not None:
+                entry[1][name] = value
+
+    @contextmanager
+    def span(self, stage, key=None):
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - started, key, error)
+
+    def record(self, stage, seconds, key=None, error=None):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            entry = self.traces.get(key) if key is not None else None
+            if entry is not None:
+                span = {'stage': stage, 'ms': round(seconds * 1000, 1)}
+                if error:
+                    span['error'] = error
+                entry[1]['spans'].append(span)
+
+    def end(self, key, outcome='ok'):
+        with self.lock:
+            entry = self.traces.pop(key, None)
+        if entry is None:
+            return
+        started, trace = entry
+        seconds = time.perf_counter() - started
+        trace['outcome'] = outcome
+        trace['ms'] = round(seconds * 1000, 1)
+        # Only completed runs count towards the total, so skips and stops
+        # do not pull the percentiles down.
+        if outcome == 'ok':
+            self.record(trace['kind'], seconds)
+        self.write(trace)
+
+    def write(self, trace):
+        if not self.log_path:
+            return
+        line = json.dumps(trace) + '\n'
+        with self.log_lock:
+            try:
+                os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                try:
+                    if os.path.getsize(self.log_path) + len(line) > self.max_log_bytes:
+                        os.replace(self.log_path, self.log_path + '.1')
+                except FileNotFoundError:
+                    pass
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Could not write trace log: {str(e)}")
+
+    def summary(self):
+        with self.lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+            flags = {name: dict(counts) for name, counts in self.flags.items()}
+        stages = {}
+        for stage, values in sorted(samples.items()):
+            row = {'count': len(values)}
+            for percentile in self.PERCENTILES:
+                rank = max(0, math.ceil(percentile / 100 * len(values)) - 1)
+                row[f'p{percentile}'] = round(values[rank] * 1000, 1)
+            row['max'] = round(values[-1] * 1000, 1)
+            stages[stage] = row
+        return {'stages': stages, 'flags': flags}
+
+def format_latency_stats(summary):
+    lines = [f"{'stage':<22}{'count':>7}{'p50':>11}{'p95':>11}{'p99':>11}{'max':>11}"]
+    for stage, row in summary['stages'].items():
+        lines.append(f"{stage:<22}{row['count']:>7}" +
+                     ''.join(f"{row[column]:>9.1f}ms" for column in ('p50', 'p95', 'p99', 'max')))
+    if not summary['stages']:
+        lines.append("(nothing timed yet)")
+    for name, counts in sorted(summary['flags'].items()):
+        lines.append(f"{name}: " + ', '.join(f"{value} {count}" for value, count in sorted(counts.items())))
+    return '\n'.join(lines)
+
+def format_storage_stats(cache, library):
+    lines = [f"cache: {cache['entries']} files, {cache['bytes'] / 1e6:.1f} of {cache['max_bytes'] / 1e6:.0f} MB, "
+             f"{cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%} hit rate), "
+             f"{cache['evictions']} evictions"]
+    if library is not None:
+        lines.append(f"library: {library['tracks']} tracks, {library['cached']} cached")
+    return '\n'.join(lines)
+
+class TrackResolver:
+    EXPIRY_MARGIN = 5 * 60
+
+    def __init__(self, options, ttl=RESOLVE_TTL_SECONDS, max_entries=RESOLVE_CACHE_SIZE,
+                 pool_size=RESOLVER_POOL_SIZE):
+        self.options = options
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.pool_size = pool_size
+        self.pool = queue.Queue()
+        self.created = 0
+        self.entries = OrderedDict()
+        self.aliases = {}
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.session = None
+        self.sharing = None
+        self.on_resolved = None
+
+    def _acquire(self):
+        with self.lock:
+            if self.pool.empty() and self.created < self.pool_size:
+                self.created += 1
+                options = dict(self.options)
+                # yt_dlp calls hooks from its fragment threads too, so the
+                # running download's callbacks are kept per instance (one
+                # download at a time each), not per thread.
+                job = {}
+                options['progress_hooks'] = (list(options.get('progress_hooks', []))
+                                             + [functools.partial(self._progress, job)])
+                ydl = self._share_session(lazy_import('yt_dlp').YoutubeDL(options))
+                self.jobs[ydl] = job
+                return ydl
+        return self.pool.get()
+
+    def _share_session(self, ydl):
+        # Every pooled instance sends requests through the first instance's
+        # request director and cookie jar, so searches, extraction and
+        # downloads reuse one set of keep-alive connections. Both are yt_dlp
+        # internals (cached properties), so if a release drops or changes
+        # them each instance simply keeps its own session.
+        if self.sharing is None:
+            self.sharing = all(isinstance(getattr(type(ydl), name, None), functools.cached_property)
+                               for name in ('cookiejar', '_request_director'))
+            if not self.sharing:
+                print("yt_dlp session sharing unavailable; each extractor uses its own connections")
+        if not self.sharing:
+            return ydl
+        if self.session is None:
+            self.session = (ydl.cookiejar, ydl._request_director)
+        else:
+            ydl.__dict__['cookiejar'], ydl.__dict__['_request_director'] = self.session
+        return ydl
+
+    def open_playlist(self, url):
+        # Each playlist gets its own instance, kept for as long as the
+        # playlist is being paged through: the extractor's entry generator
+        # holds the continuation token, so a later page picks up where the
+        # last one stopped instead of walking the playlist from the start.
+        options = dict(self.options, noplaylist=False)
+        with self.lock:
+            ydl = self._share_session(lazy_import('yt_dlp').YoutubeDL(options))
+        info = ydl.extract_info(url, download=False, process=False)
+        while info.get('_type') in ('url', 'url_transparent'):
+            info = ydl.extract_info(info['url'], download=False, process=False,
+                                    ie_key=info.get('ie_key'))
+        return ydl, info
+
+    def warm_up(self):
+        # Pays for loading the YouTube extractors and for the first DNS lookup
+        # and TLS handshake before the first track is requested.
+        ydl = self._acquire()
+        try:
+            ydl.get_info_extractor('Youtube')
+            ydl.get_info_extractor('YoutubeSearch')
+            head = lazy_import('yt_dlp.networking').HEADRequest
+            ydl.urlopen(head(WARM_UP_URL)).close()
+        finally:
+            self._release(ydl)
+
+    def _release(self, ydl):
+        self.pool.put(ydl)
+
+    def _expires_at(self, info):
+        expires = time.time() + self.ttl
+        stream_expires = stream_expiry(info.get('url'))
+        if stream_expires:
+            expires = min(expires, stream_expires - self.EXPIRY_MARGIN)
+        return expires
+
+    def _store(self, info, *keys):
+        with self.lock:
+            video_id = info['id']
+            self.entries[video_id] = (self._expires_at(info), info)
+            self.entries.move_to_end(video_id)
+            for key in keys:
+                if key and key != video_id:
+                    self.aliases[key] = video_id
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.on_resolved is not None:
+            try:
+                self.on_resolved(info)
+            except Exception as e:
+                print(f"Could not record resolved track: {str(e)}")
+
+    def lookup(self, key):
+        with self.lock:
+            video_id = self.aliases.get(key, key)
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return None
+            expires, info = entry
+            if expires <= time.time():
+                del self.entries[video_id]
+                return None
+            self.entries.move_to_end(video_id)
+            return info
+
+    def _extract(self, target):
+        ydl = self._acquire()
+        try:
+            return ydl.extract_info(target, download=False)
+        finally:
+            self._release(ydl)
+
+    def resolve(self, url):
+        info = self.lookup(url) or self.lookup(video_id_from_url(url))
+        if info is None:
+            info = self._extract(url)
+            self._store(info, url)
+        return info
+
+    def search(self, query):
+        key = f"ytsearch1:{query}"
+        info = self.lookup(key)
+        if info is None:
+            result = self._extract(key)
+            entries = [entry for entry in result.get('entries') or [] if entry]
+            if not entries:
+                return None
+            info = entries[0]
+            self._store(info, key, info.get('webpage_url'))
+        return info
+
+    def _progress(self, job, status):
+        progress = job.get('progress')
+        if progress is not None:
+            progress(status)
+        cancelled = job.get('cancelled')
+        if cancelled is not None and cancelled():
+            raise lazy_import('yt_dlp').utils.DownloadCancelled()
+
+    def download(self, info, cancelled=None, progress=None, rate_limit=None,
+                 format_id=None, outtmpl=None):
+        # Downloads straight from the extracted info dict, so the page and
+        # player are never fetched a second time for the same track.
+        # yt_dlp builds its format selector once, from the options it was
+        # created with, so a pooled instance only picks another format if the
+        # selector itself is swapped for the call.
+        ydl = self._acquire()
+        job = self.jobs[ydl]
+        job.update(cancelled=cancelled, progress=progress)
+        selector = ydl.format_selector
+        ydl.params['ratelimit'] = rate_limit
+        ydl.params['outtmpl']['default'] = outtmpl or self.options['outtmpl']
+        try:
+            if format_id:
+                ydl.params['format'] = format_id
+                ydl.format_selector = ydl.build_format_selector(format_id)
+            result = ydl.process_ie_result(dict(info), download=True)
+        finally:
+            ydl.params['format'] = self.options['format']
+            ydl.format_selector = selector
+            job.clear()
+            self._release(ydl)
+        downloads = result.get('requested_downloads') or []
+        if downloads and downloads[0].get('filepath'):
+            return downloads[0]['filepath']
+        return None
+
+def normalize_query(query):
+    return ' '.join(query.casefold().split())
+
+class SearchBackend:
+    name = 'backend'
+
+    def search(self, query):
+        raise NotImplementedError
+
+    def warm_up(self):
+        pass
+
+class VideosSearchBackend(SearchBackend):
+    name = 'youtube-search-python'
+
+    def search(self, query):
+        VideosSearch = lazy_import('youtubesearchpython').VideosSearch
+        results = VideosSearch(query, limit=1, region='US').result()
+        if results and results['result']:
+            video = results['result'][0]
+            duration = video.get('duration', 'Unknown')
+            return {
+                'url': video['link'],
+                'title': f"{video['title']} ({duration})",
+                'id': video.get('id'),
+            }
+        return None
+
+    def warm_up(self):
+        # The library opens its own connections per search, so only the
+        # import and the DNS lookup can be done ahead of time.
+        lazy_import('youtubesearchpython')
+        host = urlparse(WARM_UP_URL).hostname
+        socket.getaddrinfo(host, 443, type=socket.SOCK_STREAM)
+
+class YtDlpSearchBackend(SearchBackend):
+    name = 'yt-dlp'
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    def search(self, query):
+        video = self.resolver.search(query)
+        if video:
+            duration = str(video.get('duration', 'Unknown'))
+            return {
+                'url': video['webpage_url'],
+                'title': f"{video['title']} ({duration}s)",
+                'id': video['id'],
+            }
+        return None
+
+class BackendStats:
+    ALPHA = 0.3
+    INITIAL_LATENCY = 1.0
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, latency, failed):
+        self.requests += 1
+        self.errors += int(failed)
+        self.error_rate += self.ALPHA * (float(failed) - self.error_rate)
+        if not failed:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.ALPHA * (latency - self.latency)
+
+    def score(self):
+        latency = self.INITIAL_LATENCY if self.latency is None else self.latency
+        return latency / max(0.05, 1.0 - self.error_rate)
+
+class HedgedSearch:
+    # The best-scoring backend is asked first; if it has not answered within
+    # hedge_delay seconds (or fails, or finds nothing) the next one is started
+    # too, and the first real result wins.
+    def __init__(self, backends, hedge_delay=SEARCH_HEDGE_DELAY_SECONDS, tracer=None):
+        self.backends = list(backends)
+        self.hedge_delay = hedge_delay
+        self.tracer = tracer
+        self.stats = {backend.name: BackendStats() for backend in self.backends}
+        self.executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS * len(self.backends),
+                                           thread_name_prefix='search-backend')
+        self.lock = threading.Lock()
+
+    def ordered_backends(self):
+        with self.lock:
+            return sorted(self.backends, key=lambda backend: self.stats[backend.name].score())
+
+    def _timed(self, backend, query):
+        start = time.monotonic()
+        failed = True
+        try:
+            result = backend.search(query)
+            failed = False
+            return result
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.stats[backend.name].record(elapsed, failed)
+            if self.tracer is not None:
+                self.tracer.record(f'search.{backend.name}', elapsed, query, 'failed' if failed else None)
+
+    def __call__(self, query):
+        backends = self.ordered_backends()
+        pending = {}
+        errors = []
+        next_backend = 0
+
+        def launch():
+            nonlocal next_backend
+            backend = backends[next_backend]
+            next_backend += 1
+            pending[self.executor.submit(self._timed, backend, query)] = backend
+
+        launch()
+        while pending:
+            hedge = next_backend < len(backends)
+            done, _ = wait(pending, timeout=self.hedge_delay if hedge else None,
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                launch()
+                continue
+            for future in done:
+                pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if result is not None:
+                    for loser in pending:
+                        loser.cancel()
+                    return result
+            if not pending and next_backend < len(backends):
+                launch()
+
+        if errors and len(errors) == len(backends):
+            raise errors[-1]
+        return None
+
+    def warm_up(self):
+        for backend in self.backends:
+            try:
+                backend.warm_up()
+            except Exception as e:
+                print(f"Could not warm up {backend.name}: {str(e)}")
+
+    def report(self):
+        with self.lock:
+            return {name: {'latency': stats.latency,
+                           'error_rate': round(stats.error_rate, 3),
+                           'requests': stats.requests,
+                           'errors': stats.errors}
+                    for name, stats in self.stats.items()}
+
+class SearchService:
+    # Results are kept oldest first and capped at max_entries. New results
+    # are written out together by one timer a couple of seconds later, so a
+    # burst of searches (or a bulk import) costs one write, not one each.
+    def __init__(self, search, cache_path=SEARCH_CACHE_PATH, ttl=SEARCH_CACHE_TTL_SECONDS,
+                 workers=SEARCH_WORKERS, max_entries=SEARCH_CACHE_MAX_ENTRIES,
+                 save_delay=SEARCH_CACHE_SAVE_DELAY):
+        self.search = search
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_delay = save_delay
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='search')
+        self.results = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.save_timer = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            entries = sorted(((key, entry) for key, entry in data.items() if entry['expires'] > now),
+                             key=lambda item: item[1]['expires'])
+            self.results = dict(entries[-self.max_entries:])
+        except FileNotFoundError:
+            self.results = {}
+        except Exception as e:
+            print(f"Search cache unreadable, starting empty: {str(e)}")
+            self.results = {}
+
+    def _store(self, key, result):
+        # Called with self.lock held.
+        self.results.pop(key, None)
+        self.results[key] = {'result': result, 'expires': time.time() + self.ttl}
+        while len(self.results) > self.max_entries:
+            del self.results[next(iter(self.results))]
+        if self.save_timer is None:
+            self.save_timer = threading.Timer(self.save_delay, self.save)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    def save(self):
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            data = dict(self.results)
+        tmp_path = self.cache_path + '.tmp'
+        with self.save_lock:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.cache_path)
+            except Exception as e:
+                print(f"Could not save search cache: {str(e)}")
+
+    def flush(self):
+        with self.lock:
+            pending = self.save_timer is not None
+        if pending:
+            self.save()
+
+    def cached(self, query):
+        key = normalize_query(query)
+        with self.lock:
+            entry = self.results.get(key)
+            if entry and entry['expires'] > time.time():
+                return entry['result']
+            self.results.pop(key, None)
+            return None
+
+    def submit(self, query, callback):
+        # callback(result, error) runs on a worker thread; identical queries
+        # that are already in flight share a single backend request.
+        key = normalize_query(query)
+        result = self.cached(query)
+        if result is not None:
+            callback(result, None)
+            return
+
+        with self.lock:
+            callbacks = self.inflight.get(key)
+            if callbacks is not None:
+                callbacks.append(callback)
+                return
+            self.inflight[key] = [callback]
+        self.executor.submit(self._run, key, query)
+
+    def lookup(self, query):
+        # Synchronous search for callers that bring their own threads (bulk
+        # import); shares the result cache but not the in-flight coalescing.
+        result = self.cached(query)
+        if result is None:
+            result = self.search(query)
+            if result is not None:
+                with self.lock:
+                    self._store(normalize_query(query), result)
+        return result
+
+    def _run(self, key, query):
+        result, error = None, None
+        try:
+            result = self.search(query)
+        except Exception as e:
+            error = e
+
+        with self.lock:
+            callbacks = self.inflight.pop(key, [])
+            if result is not None:
+                self._store(key, result)
+
+        for callback in callbacks:
+            try:
+                callback(result, error)
+            except Exception as e:
+                print(f"Search callback error: {str(e)}")
+
+class SuggestionIndex:
+    # Sorted (text, key) pairs searched with bisect. Each entry is indexed
+    # under its full text and under the text from each of its first few words
+    # on, so "give" also finds "Never Gonna Give You Up". The pairs live in
+    # blocks of up to 2 * block_size that each remember the best rank in
+    # them, so a short prefix matching thousands of pairs is ranked by opening
+    # only the blocks that can still beat the current top few.
+    #
+    # Small additions go straight into their block on the adding thread; a
+    # bulk load is sorted and built off the lock on its own (background)
+    # thread and swapped in whole, so lookups never sort anything.
+    def __init__(self, limit=SUGGEST_LIMIT, block_size=SUGGEST_BLOCK_SIZE):
+        self.limit = limit
+        self.block_size = block_size
+        self.blocks = []
+        self.firsts = []
+        self.best = []
+        self.entries = {}
+        self.recent = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def _rank(self, item):
+        # Lower is better. Entries that start with the text rank above ones
+        # that only contain it, then the most used ones first; equal scores
+        # are ordered by key, so results are stable.
+        text, key = item
+        return (text != key, -self.entries[key][1], key)
+
+    def _items(self, key):
+        words = key.split(' ')
+        return [(' '.join(words[start:]), key) for start in range(min(len(words), SUGGEST_WORD_STARTS))]
+
+    def _insert(self, item):
+        rank = self._rank(item)
+        if not self.blocks:
+            self.blocks, self.firsts, self.best = [[item]], [item], [rank]
+            return
+        index = max(0, bisect.bisect_right(self.firsts, item) - 1)
+        # Blocks are replaced rather than changed in place, so a bulk build
+        # can work from a snapshot of the block list.
+        block = list(self.blocks[index])
+        bisect.insort(block, item)
+        if len(block) > 2 * self.block_size:
+            halves = [block[:self.block_size], block[self.block_size:]]
+            self.blocks[index:index + 1] = halves
+            self.firsts[index:index + 1] = [half[0] for half in halves]
+            self.best[index:index + 1] = [min(map(self._rank, half)) for half in halves]
+        else:
+            self.blocks[index] = block
+            self.firsts[index] = block[0]
+            self.best[index] = min(self.best[index], rank)
+
+    def _raise(self, key):
+        for item in self._items(key):
+            index = max(0, bisect.bisect_right(self.firsts, item) - 1)
+            if index < len(self.best):
+                self.best[index] = min(self.best[index], self._rank(item))
+
+    def add(self, text, weight=1.0):
+        self.add_many([(text, weight)])
+
+    def add_many(self, items):
+        new = []
+        raised = []
+        with self.lock:
+            for text, weight in items:
+                key = normalize_query(text or '')
+                if not key:
+                    continue
+                entry = self.entries.get(key)
+                if entry is not None:
+                    entry[1] += weight
+                    raised.append(key)
+                    continue
+                self.entries[key] = [' '.join(text.split()), weight]
+                new.extend(self._items(key))
+            if len(new) <= SUGGEST_BULK_SIZE:
+                for item in new:
+                    self._insert(item)
+                for key in raised:
+                    self._raise(key)
+                if self.recent is not None:
+                    self.recent.extend(('insert', item) for item in new)
+                    self.recent.extend(('raise', key) for key in raised)
+                return
+        self._build(new, raised)
+
+    def _build(self, new, raised):
+        # Sorted in chunks and merged lazily so this thread gives up the GIL
+        # every few milliseconds instead of holding it for one long sort.
+        with self.build_lock:
+            with self.lock:
+                blocks = list(self.blocks)
+                self.recent = []
+            chunks = [sorted(new[i:i + SUGGEST_SORT_CHUNK]) for i in range(0, len(new), SUGGEST_SORT_CHUNK)]
+            merged = list(heapq.merge(*blocks, *chunks))
+            size = self.block_size
+            new_blocks = [merged[i:i + size] for i in range(0, len(merged), size)]
+            firsts = [block[0] for block in new_blocks]
+            best = [min(map(self._rank, block)) for block in new_blocks]
+            with self.lock:
+                self.blocks, self.firsts, self.best = new_blocks, firsts, best
+                for key in raised:
+                    self._raise(key)
+                for change, value in self.recent:
+                    if change == 'insert':
+                        self._insert(value)
+                    else:
+                        self._raise(value)
+                self.recent = None
+
+    def lookup(self, text, limit=None):
+        prefix = normalize_query(text)
+        if not prefix:
+            return []
+        limit = limit or self.limit
+        with self.lock:
+            first = max(0, bisect.bisect_right(self.firsts, (prefix,)) - 1)
+            last = bisect.bisect_left(self.firsts, (prefix + '\U0010ffff',))
+            # Best-first over the blocks in range: stop once the limit-th
+            # best match so far ranks no lower than any unopened block. The
+            # bound includes the key, so a block that only ties on score is
+            # still opened when it may hold a key that sorts first.
+            heap = [(rank, index) for index, rank in enumerate(self.best[first:last], first)]
+            heapq.heapify(heap)
+            found = {}
+            while heap:
+                bound, index = heap[0]
+                if len(found) >= limit and heapq.nsmallest(limit, found.values())[-1] <= bound:
+                    break
+                heapq.heappop(heap)
+                block = self.blocks[index]
+                for item in block[bisect.bisect_left(block, (prefix,)):]:
+                    if not item[0].startswith(prefix):
+                        break
+                    rank = self._rank(item)
+                    if rank < found.get(item[1], (True, 0.0, '\U0010ffff')):
+                        found[item[1]] = rank
+            best = heapq.nsmallest(limit, found.values())
+            return [self.entries[rank[2]][0] for rank in best]
+
+    def __len__(self):
+        return len(self.entries)
+
+class AudioCache:
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, directory, max_bytes, policy='lru', on_change=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_change = on_change
+        self.entries = {}
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+        self.verify()
+        self.evict()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, self.INDEX_NAME)
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.entries = data.get('entries', {})
+            stats = data.get('stats', {})
+            self.hits = stats.get('hits', 0)
+            self.misses = stats.get('misses', 0)
+            self.evictions = stats.get('evictions', 0)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            print(f"Cache index unreadable, rebuilding: {str(e)}")
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            data = {'entries': self.entries, 'stats': self.stats()}
+            tmp_path = self.index_path + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.index_path)
+            except Exception as e:
+                print(f"Could not save cache index: {str(e)}")
+
+    def verify(self):
+        # Only files recorded in the index are complete: the index entry is
+        # written after the download and post-processing finish, so anything
+        # else in the directory was left behind by an interrupted download.
+        with self.lock:
+            for video_id, entry in list(self.entries.items()):
+                path = os.path.join(self.directory, entry['file'])
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = None
+                if size is None or size != entry['size'] or size == 0:
+                    self._remove(video_id)
+
+            known = {entry['file'] for entry in self.entries.values()}
+            known.add(self.INDEX_NAME)
+            for name in os.listdir(self.directory):
+                if name in known:
+                    continue
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as e:
+                    print(f"Could not remove stale cache file {name}: {e}")
+            self.save()
+
+    def path_for(self, video_id, ext, variant=None):
+        if variant:
+            return os.path.join(self.directory, f'{video_id}.{variant}.{ext}')
+        return os.path.join(self.directory, f'{video_id}.{ext}')
+
+    def is_reduced(self, video_id):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            return bool(entry and entry.get('reduced'))
+
+    def codec(self, video_id):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            return entry['codec'] if entry else None
+
+    def contains(self, video_id):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            return entry is not None and os.path.exists(os.path.join(self.directory, entry['file']))
+
+    def path(self, video_id):
+        with self.lock:
+            if self.contains(video_id):
+                return os.path.join(self.directory, self.entries[video_id]['file'])
+            return None
+
+    def note_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def get(self, video_id):
+        with self.lock:
+            if self.contains(video_id):
+                self.hits += 1
+                return os.path.join(self.directory, self.entries[video_id]['file'])
+            self.entries.pop(video_id, None)
+            self.misses += 1
+            return None
+
+    def add(self, video_id, path, codec, duration=None, reduced=False):
+        with self.lock:
+            previous = self.entries.get(video_id)
+            if previous and previous['file'] != os.path.basename(path):
+                self._remove(video_id)
+            self.entries[video_id] = {
+                'file': os.path.basename(path),
+                'size': os.path.getsize(path),
+                'codec': codec,
+                'duration': duration,
+                'added': time.time(),
+                'last_played': 0,
+                'play_count': 0,
+                'reduced': reduced,
+            }
+            self.notify(video_id, path)
+            self.evict(keep=video_id)
+            self.save()
+
+    def mark_played(self, video_id):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry:
+                entry['last_played'] = time.time()
+                entry['play_count'] += 1
+                self.save()
+
+    def pin(self, video_ids):
+        with self.lock:
+            self.pinned = set(video_ids)
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def _eviction_key(self, video_id):
+        entry = self.entries[video_id]
+        last_used = max(entry['last_played'], entry['added'])
+        if self.policy == 'lfu':
+            return (entry['play_count'], last_used)
+        return (last_used,)
+
+    def evict(self, keep=None):
+        with self.lock:
+            total = self.total_bytes()
+            if total <= self.max_bytes:
+                return
+            candidates = [video_id for video_id in self.entries
+                          if video_id != keep and video_id not in self.pinned]
+            candidates.sort(key=self._eviction_key)
+            for video_id in candidates:
+                if total <= self.max_bytes:
+                    break
+                total -= self.entries[video_id]['size']
+                self._remove(video_id)
+                self.evictions += 1
+            self.save()
+
+    def notify(self, video_id, path):
+        if self.on_change is not None:
+            try:
+                self.on_change(video_id, path)
+            except Exception as e:
+                print(f"Cache listener error: {str(e)}")
+
+    def paths(self):
+        with self.lock:
+            return {video_id: os.path.join(self.directory, entry['file'])
+                    for video_id, entry in self.entries.items()}
+
+    def _remove(self, video_id):
+        entry = self.entries.pop(video_id, None)
+        if entry:
+            self.notify(video_id, None)
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove cached file {entry['file']}: {e}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes(),
+                'max_bytes': self.max_bytes,
+            }
+
+def title_words(text):
+    return re.findall(r'\w+', text.casefold())
+
+def match_score(words, title):
+    # Share of the title's words that are in the query.
+    significant = [word for word in title_words(title) if word not in LIBRARY_TITLE_NOISE]
+    if not significant:
+        return 0.0
+    return sum(word in words for word in significant) / len(significant)
+
+class LocalLibrary:
+    # Every resolved track is kept in SQLite with its cache file and play
+    # count. Searches are answered here before any network backend: a match
+    # needs every word of the query in the title or channel, and cached,
+    # often played tracks rank first; find() also wants the query to cover
+    # most of the title. Uses an FTS5 index where the sqlite
+    # build has one and falls back to LIKE otherwise.
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.fts = False
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS tracks (
+                    video_id TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    channel TEXT,
+                    duration REAL,
+                    cache_path TEXT,
+                    play_count INTEGER NOT NULL DEFAULT 0,
+                    last_played REAL NOT NULL DEFAULT 0,
+                    added REAL NOT NULL
+                )""")
+            try:
+                self.conn.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts
+                    USING fts5(title, channel, content='tracks', content_rowid='rowid')""")
+            except sqlite3.OperationalError as e:
+                print(f"Full-text search unavailable, using plain matching: {str(e)}")
+            else:
+                self.fts = True
+                self.conn.executescript("""
+                    CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+                        INSERT INTO tracks_fts(rowid, title, channel) VALUES (new.rowid, new.title, new.channel);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+                        INSERT INTO tracks_fts(tracks_fts, rowid, title, channel)
+                        VALUES ('delete', old.rowid, old.title, old.channel);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, channel ON tracks BEGIN
+                        INSERT INTO tracks_fts(tracks_fts, rowid, title, channel)
+                        VALUES ('delete', old.rowid, old.title, old.channel);
+                        INSERT INTO tracks_fts(rowid, title, channel) VALUES (new.rowid, new.title, new.channel);
+                    END;
+                """)
+
+    def add_info(self, info):
+        video_id = info.get('id')
+        title = info.get('title')
+        if not video_id or not title or info.get('_type') == 'playlist':
+            return
+        url = info.get('webpage_url') or f'https://www.youtube.com/watch?v={video_id}'
+        channel = info.get('channel') or info.get('uploader')
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO tracks (video_id, url, title, channel, duration, added)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(video_id) DO UPDATE SET
+                    url = excluded.url, title = excluded.title, channel = excluded.channel,
+                    duration = COALESCE(excluded.duration, duration)""",
+                (video_id, url, title, channel, info.get('duration'), time.time()))
+
+    def set_cached(self, video_id, path):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE tracks SET cache_path = ? WHERE video_id = ?", (path, video_id))
+
+    def sync_cached(self, paths):
+        # Brings cache_path in line with the audio cache, which may have
+        # changed while the library was not listening.
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE tracks SET cache_path = NULL WHERE cache_path IS NOT NULL")
+            self.conn.executemany("UPDATE tracks SET cache_path = ? WHERE video_id = ?",
+                                  [(path, video_id) for video_id, path in paths.items()])
+
+    def mark_played(self, video_id):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE tracks SET play_count = play_count + 1, last_played = ? WHERE video_id = ?",
+                              (time.time(), video_id))
+
+    def song(self, row):
+        video_id, url, title, duration = row
+        if duration:
+            title = f"{title} ({int(duration) // 60}:{int(duration) % 60:02d})"
+        return {'url': url, 'title': title, 'id': video_id}
+
+    def get(self, video_id):
+        with self.lock:
+            row = self.conn.execute("SELECT video_id, url, title, duration FROM tracks WHERE video_id = ?",
+                                    (video_id,)).fetchone()
+        return self.song(row) if row else None
+
+    def rows(self, query, limit):
+        words = normalize_query(query).split()
+        if not words:
+            return []
+        if self.fts:
+            match = ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+            sql = """
+                SELECT t.video_id, t.url, t.title, t.duration
+                FROM tracks_fts JOIN tracks t ON t.rowid = tracks_fts.rowid
+                WHERE tracks_fts MATCH ?
+                ORDER BY t.cache_path IS NULL, bm25(tracks_fts), t.play_count DESC
+                LIMIT ?"""
+            params = (match, limit)
+        else:
+            where = ' AND '.join("(title LIKE ? OR channel LIKE ?)" for _ in words)
+            sql = f"""
+                SELECT video_id, url, title, duration FROM tracks WHERE {where}
+                ORDER BY cache_path IS NULL, play_count DESC
+                LIMIT ?"""
+            params = [pattern for word in words for pattern in (f'%{word}%',) * 2] + [limit]
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def search(self, query, limit=1):
+        return [self.song(row) for row in self.rows(query, limit)]
+
+    def find(self, query):
+        # Every word of the query matching is not enough: "hello" would
+        # pick whichever song has hello somewhere in its title.
+        key = normalize_query(query)
+        words = set(title_words(key))
+        for row in self.rows(query, LIBRARY_FIND_CANDIDATES):
+            if normalize_query(row[2]) == key or match_score(words, row[2]) >= LIBRARY_MIN_SCORE:
+                return self.song(row)
+        return None
+
+    def titles(self):
+        with self.lock:
+            return self.conn.execute("SELECT title, play_count FROM tracks").fetchall()
+
+    def stats(self):
+        with self.lock:
+            tracks, cached = self.conn.execute(
+                "SELECT COUNT(*), COUNT(cache_path) FROM tracks").fetchone()
+        return {'tracks': tracks, 'cached': cached, 'full_text': self.fts}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def crossfade_pcm(outgoing, incoming, channels):
+    numpy = lazy_import('numpy')
+    # Equal-power fade between two equally long blocks of interleaved s16 PCM.
+    fade_out = numpy.frombuffer(outgoing, dtype=numpy.int16).reshape(-1, channels).astype(numpy.float32)
+    fade_in = numpy.frombuffer(incoming, dtype=numpy.int16).reshape(-1, channels).astype(numpy.float32)
+    ramp = numpy.linspace(0.0, math.pi / 2, len(fade_out), dtype=numpy.float32)[:, None]
+    mixed = fade_out * numpy.cos(ramp) + fade_in * numpy.sin(ramp)
+    return numpy.clip(mixed, -32768, 32767).astype(numpy.int16).tobytes()
+
+class StreamingPlayback:
+    CHUNK_SECONDS = 0.5
+
+    def __init__(self, source, headers=None, cache_path=None, on_finished=None,
+                 prebuffer=STREAM_PREBUFFER_SECONDS, max_buffer=STREAM_MAX_BUFFER_SECONDS, start=0):
+        self.source = source
+        self.start_offset = start
+        self.headers = headers or {}
+        self.cache_path = cache_path
+        self.part_path = cache_path + '.part' if cache_path else None
+        self.container = CONTAINER_FORMATS.get(file_extension(cache_path)) if cache_path else None
+        self.on_finished = on_finished
+        self.on_start = None
+        self.on_end = None
+        self.on_first_sound = None
+        self.prebuffer = prebuffer
+        self.max_buffer = max_buffer
+
+        frequency, size, channels = pygame.mixer.get_init()
+        if size != -16:
+            raise RuntimeError(f"Unsupported mixer sample format: {size}")
+        self.frequency = frequency
+        self.channels = channels
+        self.frame_bytes = 2 * channels
+        self.chunk_bytes = int(frequency * self.CHUNK_SECONDS) * self.frame_bytes
+
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+        # Entries are [pcm_bytes, playback]; the playback is set on the first
+        # chunk of a chained track so its start is reported when it reaches
+        # the channel.
+        self.pending = deque()
+        self.volume = 1.0
+        self.started = False
+        self.paused = False
+        self.stopped = False
+        self.finished = False
+        self.eof = False
+        self.chunks_played = 0
+        self.process = None
+        self.thread = None
+        self.next = None
+        self.crossfade = 0.0
+        self.head = []
+        self.head_bytes = 0
+        self.successor = None
+        self.lock = threading.Lock()
+
+    def command(self):
+        cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y']
+        if self.headers:
+            cmd += ['-headers', ''.join(f'{key}: {value}\r\n' for key, value in self.headers.items())]
+        if self.start_offset:
+            cmd += ['-ss', str(self.start_offset)]
+        cmd += ['-i', self.source, '-vn']
+        if self.part_path:
+            # The cache copy keeps the source codec; only the pipe is decoded.
+            cmd += ['-map', '0:a:0', '-c:a', 'copy', '-f', self.container, self.part_path]
+        cmd += ['-map', '0:a:0', '-f', 's16le', '-ar', str(self.frequency),
+                '-ac', str(self.channels), 'pipe:1']
+        return cmd
+
+    def open(self):
+        self.process = subprocess.Popen(self.command(),
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+
+    def start(self, volume=1.0):
+        self.volume = volume
+        self.open()
+        self.thread = threading.Thread(target=self._feed, daemon=True)
+        self.thread.start()
+
+    def read_chunk(self):
+        data = self.process.stdout.read(self.chunk_bytes)
+        return data[:len(data) - len(data) % self.frame_bytes]
+
+    def chain(self, playback, crossfade=0.0):
+        # Opens the decoder for the following track now so its first seconds
+        # are ready when this one runs out, then plays on without a gap.
+        with self.lock:
+            previous, self.next = self.next, None
+            if not self.stopped and not self.eof:
+                playback.open()
+                self.next = playback
+                self.crossfade = crossfade if optional_import('numpy') is not None else 0.0
+        if previous is not None:
+            previous.abandon()
+        if self.next is not playback:
+            playback.abandon()
+
+    def unchain(self):
+        with self.lock:
+            previous, self.next = self.next, None
+        if previous is not None:
+            previous.abandon()
+
+    def read_head(self, crossfade):
+        wanted = (crossfade + self.prebuffer) * self.frequency * self.frame_bytes
+        while self.head_bytes < wanted and not self.eof:
+            data = self.read_chunk()
+            if not data:
+                self.eof = True
+                break
+            self.head.append(data)
+            self.head_bytes += len(data)
+
+    def _pump(self):
+        if self.paused or not self.pending:
+            return
+        if not self.started:
+            if len(self.pending) * self.CHUNK_SECONDS < self.prebuffer and not self.eof:
+                return
+            self.started = True
+            if self.on_first_sound:
+                self.on_first_sound()
+        if not self.channel.get_busy():
+            self.channel.play(self._sound(self.pending.popleft()))
+        if self.pending and self.channel.get_queue() is None:
+            self.channel.queue(self._sound(self.pending.popleft()))
+
+    def _sound(self, entry):
+        data, playback = entry
+        if playback is not None:
+            playback.chunks_played = 0
+            if playback.on_start:
+                playback.on_start()
+        self.chunks_played += 1
+        sound = pygame.mixer.Sound(buffer=data)
+        sound.set_volume(self.volume)
+        return sound
+
+    def _feed(self):
+        playback = self
+        while playback is not None:
+            playback = playback._feed_track()
+
+    def _feed_track(self):
+        max_pending = int(self.max_buffer / self.CHUNK_SECONDS)
+        try:
+            while not self.stopped:
+                self._pump()
+                if self.eof:
+                    with self.lock:
+                        playback, self.next = self.next, None
+                    if playback is not None:
+                        self._finish(handed_over=True)
+                        playback.adopt(self)
+                        return playback
+                    if not self.pending and not self.channel.get_busy():
+                        break
+                    time.sleep(0.05)
+                    continue
+                if len(self.pending) >= max_pending:
+                    playback = self.next
+                    if playback is not None:
+                        playback.read_head(self.crossfade)
+                    time.sleep(0.05)
+                    continue
+                data = self.read_chunk()
+                if not data:
+                    self.eof = True
+                    continue
+                self.pending.append([data, None])
+        except Exception as e:
+            print(f"Streaming error: {str(e)}")
+        self._finish()
+        return None
+
+    def adopt(self, previous):
+        # Takes over the channel and the queued tail of the previous track,
+        # overlapping up to `crossfade` seconds of that tail with our head.
+        self.read_head(previous.crossfade)
+        self.pending = previous.pending
+        self.channel = previous.channel
+        self.volume = previous.volume
+        self.paused = previous.paused
+        self.thread = previous.thread
+        self.started = True
+        previous.successor = self
+
+        head = b''.join(self.head)
+        self.head = []
+        fade_bytes = int(previous.crossfade * self.frequency) * self.frame_bytes
+        tail = []
+        tail_bytes = 0
+        while (self.pending and tail_bytes < fade_bytes
+               and self.pending[-1][1] is None):
+            data = self.pending.pop()[0]
+            tail.insert(0, data)
+            tail_bytes += len(data)
+        tail = b''.join(tail)
+        overlap = min(fade_bytes, len(tail), len(head))
+        overlap -= overlap % self.frame_bytes
+        if len(tail) > overlap:
+            self.pending.append([tail[:len(tail) - overlap], None])
+
+        mixed = crossfade_pcm(tail[len(tail) - overlap:], head[:overlap], self.channels) if overlap else b''
+        data = mixed + head[overlap:]
+        first = True
+        for offset in range(0, len(data), self.chunk_bytes):
+            self.pending.append([data[offset:offset + self.chunk_bytes], self if first else None])
+            first = False
+        if first:
+            self.pending.append([b'\0' * self.frame_bytes, self])
+
+    def _finish(self, handed_over=False):
+        completed = False
+        if self.stopped:
+            self.process.kill()
+        try:
+            completed = self.process.wait(timeout=10) == 0 and not self.stopped
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._close(completed)
+        if not handed_over:
+            self.unchain()
+            if self.on_end and not self.stopped:
+                self.on_end()
+
+    def _close(self, completed):
+        if self.part_path:
+            if completed:
+                os.replace(self.part_path, self.cache_path)
+            else:
+                try:
+                    os.remove(self.part_path)
+                except OSError:
+                    pass
+        self.finished = True
+        if self.on_finished:
+            self.on_finished(completed)
+
+    def abandon(self):
+        if self.finished:
+            return
+        if self.process is not None:
+            self.process.kill()
+            try:
+                self.process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                pass
+        self._close(False)
+
+    def active(self):
+        playback = self
+        while playback.successor is not None:
+            playback = playback.successor
+        return playback
+
+    def pause(self):
+        playback = self.active()
+        playback.paused = True
+        playback.channel.pause()
+
+    def unpause(self):
+        playback = self.active()
+        playback.paused = False
+        playback.channel.unpause()
+
+    def stop(self):
+        playback = self.active()
+        playback.stopped = True
+        self.stopped = True
+        playback.channel.stop()
+        if playback.process and playback.process.poll() is None:
+            playback.process.kill()
+        if playback.thread and playback.thread is not threading.current_thread():
+            playback.thread.join(timeout=2)
+        playback.unchain()
+
+    def set_volume(self, volume):
+        playback = self.active()
+        playback.volume = volume
+        for sound in [playback.channel.get_sound(), playback.channel.get_queue()]:
+            if sound is not None:
+                sound.set_volume(volume)
+
+    def get_busy(self):
+        playback = self.active()
+        return not playback.finished and not playback.stopped
+
+    def get_pos(self):
+        # The chunk currently playing and the one queued behind it have been
+        # counted already, so the position is the chunks fully played before them.
+        playback = self.active()
+        played = max(0, playback.chunks_played - 2) * self.CHUNK_SECONDS
+        return int((playback.start_offset + played) * 1000)
+
+class PlaybackCancelled(Exception):
+    pass
+
+class PlaybackController:
+    # One worker loads tracks for the mixer. Requests replace each other
+    # instead of queueing, and a load can check cancelled() to give up as
+    # soon as a newer request has arrived.
+    def __init__(self, load):
+        self.load = load
+        self.request = None
+        self.generation = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def play(self, url, title, start=0):
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, url, title, start)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.request = None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                generation, url, title, start = self.request
+                self.request = None
+
+            def cancelled(generation=generation):
+                return generation != self.generation
+
+            try:
+                self.load(url, title, cancelled, start)
+            except PlaybackCancelled:
+                pass
+            except Exception as e:
+                print(f"Playback controller error: {str(e)}")
+
+class ThroughputMeter:
+    ALPHA = 0.3
+    MIN_BYTES = 256 * 1024
+
+    def __init__(self):
+        self.rate = None
+        self.lock = threading.Lock()
+
+    def record(self, size, seconds):
+        # Small transfers say more about latency than bandwidth.
+        if not size or not seconds or size < self.MIN_BYTES:
+            return
+        rate = size / seconds
+        with self.lock:
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += self.ALPHA * (rate - self.rate)
+
+    def estimate(self):
+        with self.lock:
+            return self.rate
+
+class DownloadJob:
+    def __init__(self, url, priority, upgrade=False):
+        self.url = url
+        self.priority = priority
+        self.upgrade = upgrade
+        self.state = 'queued'
+        self.stop_reason = None
+        self.held = False
+        self.rate_limit = None
+        self.downloaded = 0
+        self.total = None
+        self.path = None
+        self.error = None
+        self.done = threading.Event()
+        self.reported = 0.0
+        self.on_progress = None
+
+    @property
+    def key(self):
+        return (self.url, self.upgrade)
+
+    def stopping(self):
+        return self.stop_reason is not None
+
+    def fraction(self):
+        if not self.total:
+            return None
+        return min(1.0, self.downloaded / self.total)
+
+    def update(self, status):
+        self.downloaded = status.get('downloaded_bytes') or self.downloaded
+        self.total = status.get('total_bytes') or status.get('total_bytes_estimate') or self.total
+        now = time.monotonic()
+        if self.on_progress and now - self.reported >= DOWNLOAD_PROGRESS_INTERVAL:
+            self.reported = now
+            self.on_progress(self)
+
+    def summary(self):
+        return {'url': self.url, 'state': self.state, 'priority': self.priority,
+                'upgrade': self.upgrade, 'downloaded': self.downloaded, 'total': self.total}
+
+class DownloadManager:
+    # Every fetch goes through a fixed number of workers, most urgent first.
+    # A request that outranks a running download pauses it; yt_dlp keeps the
+    # .part file, so the paused job resumes where it stopped.
+    def __init__(self, download, workers=DOWNLOAD_WORKERS, rate_limit=DOWNLOAD_RATE_LIMIT,
+                 on_change=None):
+        self.download = download
+        self.workers = workers
+        self.rate_limit = rate_limit
+        self.on_change = on_change
+        self.jobs = {}
+        self.heap = []
+        self.sequence = 0
+        self.running = set()
+        self.condition = threading.Condition()
+        for number in range(workers):
+            threading.Thread(target=self._run, daemon=True, name=f'download-{number}').start()
+
+    def _push(self, job):
+        self.sequence += 1
+        heapq.heappush(self.heap, (job.priority, self.sequence, job))
+        self.condition.notify()
+
+    def _preempt(self, priority):
+        if len(self.running) < self.workers:
+            return
+        victim = max(self.running, key=lambda job: job.priority)
+        if victim.priority > priority and victim.stop_reason is None:
+            victim.stop_reason = 'preempted'
+
+    def _schedule(self, job, priority):
+        job.priority = priority
+        if job.state != 'downloading':
+            job.state = 'queued'
+            self._push(job)
+            self._preempt(priority)
+
+    def request(self, url, priority, upgrade=False):
+        with self.condition:
+            job = self.jobs.get((url, upgrade))
+            if job is None or (job.state == 'failed' and priority == PRIORITY_CURRENT):
+                job = DownloadJob(url, priority, upgrade)
+                job.on_progress = self._changed
+                self.jobs[job.key] = job
+                self._schedule(job, priority)
+            elif job.held and priority != PRIORITY_CURRENT:
+                return job
+            elif job.state == 'downloading' and job.stop_reason == 'paused':
+                # Already being stopped; let it requeue instead of parking.
+                job.held = False
+                job.stop_reason = 'preempted'
+                job.priority = min(priority, job.priority)
+            elif job.state == 'paused':
+                job.held = False
+                self._schedule(job, priority)
+            elif job.state in ('queued', 'downloading') and priority < job.priority:
+                self._schedule(job, priority)
+            else:
+                return job
+        self._changed(job)
+        return job
+
+    def retain(self, wanted):
+        # Background jobs follow the queue: those no longer wanted are paused,
+        # the rest are re-ranked. Downloads someone is waiting on are left alone.
+        changed = []
+        with self.condition:
+            for key, job in list(self.jobs.items()):
+                url = job.url
+                if job.priority == PRIORITY_CURRENT or job.upgrade:
+                    continue
+                if url not in wanted:
+                    if job.state == 'failed' or (job.state == 'paused' and not job.held):
+                        del self.jobs[key]
+                    elif job.state != 'paused':
+                        self._pause(job)
+                        changed.append(job)
+                elif job.state == 'queued' and job.priority != wanted[url]:
+                    self._schedule(job, wanted[url])
+                elif job.state == 'downloading':
+                    job.priority = wanted[url]
+        for job in changed:
+            self._changed(job)
+        for url, priority in wanted.items():
+            self.request(url, priority)
+
+    def _pause(self, job):
+        if job.state == 'downloading':
+            job.stop_reason = 'paused'
+        elif job.state == 'queued':
+            job.state = 'paused'
+
+    def release(self, job):
+        # The caller waiting at PRIORITY_CURRENT gave up; the job is parked
+        # and left to retain() to revive or drop.
+        with self.condition:
+            if (job.priority != PRIORITY_CURRENT or self.jobs.get(job.key) is not job
+                    or job.state not in ('queued', 'downloading')):
+                return
+            job.priority = PRIORITY_BACKGROUND
+            self._pause(job)
+        self._changed(job)
+
+    def pause(self, url):
+        with self.condition:
+            job = self.jobs.get((url, False))
+            if job is None or job.state == 'failed':
+                return False
+            job.held = True
+            self._pause(job)
+        self._changed(job)
+        return True
+
+    def resume(self, url):
+        job = self.jobs.get((url, False))
+        if job is None or job.state != 'paused':
+            return False
+        with self.condition:
+            job.held = False
+        self.request(url, job.priority)
+        return True
+
+    def snapshot(self):
+        with self.condition:
+            jobs = sorted(self.jobs.values(), key=lambda job: job.priority)
+            return [job.summary() for job in jobs]
+
+    def _changed(self, job):
+        if self.on_change:
+            try:
+                self.on_change(job)
+            except Exception as e:
+                print(f"Download listener error: {str(e)}")
+
+    def _next_job(self):
+        while True:
+            while not self.heap:
+                self.condition.wait()
+            priority, _, job = heapq.heappop(self.heap)
+            if job.state == 'queued' and job.priority == priority and self.jobs.get(job.key) is job:
+                return job
+
+    def _run(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                job.state = 'downloading'
+                job.stop_reason = None
+                job.rate_limit = self.rate_limit / self.workers if self.rate_limit else None
+                self.running.add(job)
+            self._changed(job)
+            path = error = None
+            try:
+                path = self.download(job)
+            except Exception as e:
+                error = e
+            with self.condition:
+                self.running.discard(job)
+                reason, job.stop_reason = job.stop_reason, None
+                if error is not None and reason == 'preempted':
+                    job.state = 'queued'
+                    self._push(job)
+                elif error is not None and reason == 'paused':
+                    job.state = 'paused'
+                elif error is not None:
+                    job.state = 'failed'
+                    job.error = error
+                    job.done.set()
+                else:
+                    job.state = 'done'
+                    job.path = path
+                    if self.jobs.get(job.key) is job:
+                        del self.jobs[job.key]
+                    job.done.set()
+            if job.state == 'failed':
+                print(f"Download error: {str(error)}")
+            self._changed(job)
+
+def parse_import_text(text):
+    return [line.strip() for line in text.splitlines()
+            if line.strip() and not line.strip().startswith('#')]
+
+def read_import_file(path):
+    # Plain text has one query or URL per line. CSV files may name their
+    # columns (url, query, or artist + title); other rows, and files whose
+    # header names none of those, have their cells joined into one query.
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if file_extension(path) != 'csv':
+            return parse_import_text(f.read())
+        rows = [row for row in csv.reader(f) if any(cell.strip() for cell in row)]
+    if not rows:
+        return []
+    if not has_import_header(rows[0]):
+        return [' '.join(cell.strip() for cell in row if cell.strip()) for row in rows]
+    
+    header = [IMPORT_COLUMNS.get(cell.strip().lower()) for cell in rows[0]]
+    queries = []
+    for row in rows[1:]:
+        cells = [cell.strip() for cell in row]
+        fields = {name: cell for name, cell in zip(header, cells) if name and cell}
+        query = fields.get('url') or fields.get('query')
+        if not query:
+            query = ' '.join(part for part in (fields.get('artist'), fields.get('title')) if part)
+        if not query:
+            query = ' '.join(cell for cell in cells if cell)
+        if query:
+            queries.append(query)
+    return queries
+
+def has_import_header(first_row):
+    # csv.Sniffer guesses from cell lengths and types, which mistakes a
+    # plain artist,title row for a header, so only known names count.
+    columns = [IMPORT_COLUMNS.get(cell.strip().lower()) for cell in first_row if cell.strip()]
+    return bool({'url', 'query', 'artist', 'title'} & set(columns) or (columns and all(columns)))
+
+class Track:
+    __slots__ = ('id', 'url', 'title', 'playlist')
+    ids = itertools.count(1)
+
+    def __init__(self, url, title, playlist=None):
+        self.id = next(Track.ids)
+        self.url = url
+        self.title = title
+        self.playlist = playlist
+
+class QueueBlock:
+    __slots__ = ('tracks', 'start')
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.start = 0
+
+class PlayQueue:
+    # Tracks are kept in blocks of up to QUEUE_BLOCK_SIZE, so an insert,
+    # remove or move shifts one block rather than the whole queue, and block
+    # offsets are recomputed only when a position is next asked for. Track ids
+    # never change, and the cursor follows a track rather than a position, so
+    # edits around the playing track need no index fix-ups. Undo records refer
+    # to ids as well, which keeps them valid across later, unrecorded edits.
+    def __init__(self, block_size=QUEUE_BLOCK_SIZE, undo_depth=QUEUE_UNDO_DEPTH):
+        self.block_size = block_size
+        self.history = deque(maxlen=undo_depth)
+        self.current = None
+        self.lock = threading.RLock()
+        self._load([])
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __getitem__(self, index):
+        with self.lock:
+            if isinstance(index, slice):
+                return [self.get(i) for i in range(*index.indices(self.size))]
+            if index < 0:
+                index += self.size
+            return self.get(index)
+
+    def _load(self, tracks):
+        size = self.block_size
+        self.blocks = [QueueBlock(tracks[i:i + size]) for i in range(0, len(tracks), size)]
+        if not self.blocks:
+            self.blocks = [QueueBlock([])]
+        self.tracks = {}
+        self.block_of = {}
+        self.by_url = {}
+        for block in self.blocks:
+            self._add_refs(block.tracks, block)
+        self.size = len(tracks)
+        self.dirty = True
+        self._reindex()
+
+    def _add_refs(self, tracks, block):
+        for track in tracks:
+            self.tracks[track.id] = track
+            self.block_of[track.id] = block
+            if track.url is not None:
+                self.by_url.setdefault(track.url, set()).add(track.id)
+
+    def _drop_refs(self, track):
+        del self.tracks[track.id]
+        del self.block_of[track.id]
+        ids = self.by_url.get(track.url)
+        if ids is not None:
+            ids.discard(track.id)
+            if not ids:
+                del self.by_url[track.url]
+
+    def _reindex(self):
+        if not self.dirty:
+            return
+        start, starts = 0, []
+        for block in self.blocks:
+            block.start = start
+            starts.append(start)
+            start += len(block.tracks)
+        self.starts = starts
+        self.dirty = False
+
+    def _locate(self, index):
+        self._reindex()
+        if index >= self.size:
+            block = self.blocks[-1]
+            return block, len(block.tracks)
+        block = self.blocks[bisect.bisect_right(self.starts, index) - 1]
+        return block, index - block.start
+
+    def _insert(self, index, tracks):
+        block, offset = self._locate(index)
+        block.tracks[offset:offset] = tracks
+        self._add_refs(tracks, block)
+        self.size += len(tracks)
+        self.dirty = True
+        if len(block.tracks) > 2 * self.block_size:
+            self._split(block)
+
+    def _split(self, block):
+        size = self.block_size
+        chunks = [block.tracks[i:i + size] for i in range(0, len(block.tracks), size)]
+        block.tracks = chunks[0]
+        added = []
+        for chunk in chunks[1:]:
+            new_block = QueueBlock(chunk)
+            for track in chunk:
+                self.block_of[track.id] = new_block
+            added.append(new_block)
+        position = self.blocks.index(block) + 1
+        self.blocks[position:position] = added
+
+    def _remove(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        block, offset = self._locate(index)
+        track = block.tracks.pop(offset)
+        self._drop_refs(track)
+        self.size -= 1
+        self.dirty = True
+        if not block.tracks and len(self.blocks) > 1:
+            self.blocks.remove(block)
+        return track
+
+    def _anchor(self, after_id, index):
+        if after_id is None:
+            return 0
+        position = self.index_of(after_id)
+        if position is None:
+            return min(index, self.size)
+        return position + 1
+
+    def reset(self, tracks):
+        with self.lock:
+            self.history.clear()
+            self.current = None
+            self._load(list(tracks))
+
+    def get(self, index):
+        with self.lock:
+            if not 0 <= index < self.size:
+                raise IndexError(index)
+            block, offset = self._locate(index)
+            return block.tracks[offset]
+
+    def track(self, track_id):
+        return self.tracks.get(track_id)
+
+    def index_of(self, track_id):
+        with self.lock:
+            block = self.block_of.get(track_id)
+            if block is None:
+                return None
+            self._reindex()
+            return block.start + block.tracks.index(self.tracks[track_id])
+
+    def positions_of(self, url):
+        with self.lock:
+            return sorted(self.index_of(track_id) for track_id in self.by_url.get(url, ()))
+
+    def snapshot(self):
+        with self.lock:
+            return [track for block in self.blocks for track in block.tracks]
+
+    def position(self):
+        with self.lock:
+            if self.current is None:
+                return -1
+            position = self.index_of(self.current.id)
+            return -1 if position is None else position
+
+    def set_position(self, index):
+        with self.lock:
+            self.current = self.get(index) if 0 <= index < self.size else None
+
+    def upcoming(self, count, wrap=False):
+        with self.lock:
+            tracks = []
+            start = self.position()
+            for offset in range(1, count + 1):
+                index = start + offset
+                if index >= self.size:
+                    if not wrap or not self.size:
+                        break
+                    index %= self.size
+                if index == start:
+                    break
+                tracks.append(self.get(index))
+            return tracks
+
+    def insert(self, index, tracks, record=True):
+        with self.lock:
+            tracks = list(tracks)
+            index = max(0, min(index, self.size))
+            self._insert(index, tracks)
+            if record:
+                self.history.append(('remove', [track.id for track in tracks]))
+            return index
+
+    def append(self, track, record=True):
+        return self.insert(self.size, [track], record)
+
+    def remove(self, index, record=True):
+        # Removing the current track moves the cursor back to the track before
+        # it, so the next track to play is the one that followed it.
+        with self.lock:
+            track = self._remove(index)
+            before = self.get(index - 1) if index > 0 else None
+            if track is self.current:
+                self.current = before
+            if record:
+                self.history.append(('insert', before and before.id, index, [track]))
+            return track
+
+    def replace(self, index, tracks):
+        with self.lock:
+            old = self._remove(index)
+            self._insert(index, tracks)
+            if old is self.current:
+                if tracks:
+                    self.current = tracks[0]
+                else:
+                    self.current = self.get(index - 1) if index > 0 else None
+            return old
+
+    def move(self, source, target, record=True):
+        with self.lock:
+            before = self.get(source - 1) if source > 0 else None
+            track = self._remove(source)
+            target = max(0, min(target, self.size))
+            self._insert(target, [track])
+            if record:
+                self.history.append(('move', track.id, before and before.id, source))
+            return target
+
+    def shuffle(self, rng=random):
+        # Only the tracks after the cursor are shuffled; what has played and
+        # what is playing keep their places.
+        with self.lock:
+            tracks = self.snapshot()
+            start = self.position() + 1
+            upcoming = tracks[start:]
+            rng.shuffle(upcoming)
+            self.history.append(('order', tracks, ()))
+            self._load(tracks[:start] + upcoming)
+
+    def dedupe(self):
+        with self.lock:
+            tracks = self.snapshot()
+            seen, kept, removed = set(), [], []
+            for track in tracks:
+                if track.url is not None and track.url in seen and track is not self.current:
+                    removed.append(track.id)
+                    continue
+                seen.add(track.url)
+                kept.append(track)
+            if removed:
+                self.history.append(('order', tracks, removed))
+                self._load(kept)
+            return len(removed)
+
+    def undo(self):
+        with self.lock:
+            if not self.history:
+                return False
+            record = self.history.pop()
+            kind = record[0]
+            if kind == 'remove':
+                for track_id in record[1]:
+                    index = self.index_of(track_id)
+                    if index is not None:
+                        self.remove(index, record=False)
+            elif kind == 'insert':
+                _, after_id, index, tracks = record
+                self._insert(self._anchor(after_id, index), tracks)
+            elif kind == 'move':
+                _, track_id, after_id, index = record
+                source = self.index_of(track_id)
+                if source is not None:
+                    track = self._remove(source)
+                    self._insert(self._anchor(after_id, index), [track])
+            elif kind == 'order':
+                _, tracks, revive = record
+                self._load(self._restore_order(tracks, set(revive)))
+            return True
+
+    def _restore_order(self, tracks, revive):
+        # Tracks added since the snapshot stay behind whichever snapshot track
+        # they followed, and tracks removed since stay removed unless the
+        # record itself removed them.
+        known = {track.id for track in tracks}
+        following = {}
+        anchor = None
+        for track in self.snapshot():
+            if track.id in known:
+                anchor = track.id
+            else:
+                following.setdefault(anchor, []).append(track)
+        order = list(following.get(None, ()))
+        for track in tracks:
+            if track.id in self.tracks or track.id in revive:
+                order.append(track)
+                order.extend(following.get(track.id, ()))
+        return order
+
+class PlaylistCursor:
+    def __init__(self, resolver, url):
+        self.resolver = resolver
+        self.url = url
+        self.title = None
+        self.ydl = None
+        self.entries = None
+        self.offset = 0
+        self.exhausted = False
+        self.loading = False
+        self.play_when_ready = False
+        # The id of the placeholder standing in for the rest of the playlist,
+        # so a page finds its place in the queue without scanning it.
+        self.placeholder_id = None
+        self.lock = threading.Lock()
+
+    def placeholder(self, title=None):
+        if title is None and self.title is None:
+            title = "⋯ Loading playlist"
+        elif title is None:
+            title = f"⋯ More from {self.title}"
+        track = Track(None, title, self)
+        self.placeholder_id = track.id
+        return track
+
+    def next_page(self, size):
+        # Flat entries only: each is a video id and title. Streams are
+        # resolved later, when the track comes up for prefetch or playback.
+        with self.lock:
+            if self.entries is None:
+                self.ydl, info = self.resolver.open_playlist(self.url)
+                self.title = info.get('title') or self.url
+                # A restored playlist picks up after the entries it had already queued.
+                self.entries = itertools.islice(info.get('entries') or [], self.offset, None)
+            page = list(itertools.islice(self.entries, size))
+            self.offset += len(page)
+            if len(page) < size:
+                self.exhausted = True
+                self.entries = iter(())
+                self.ydl = None
+            songs = [playlist_entry_song(entry) for entry in page if entry]
+            return [song for song in songs if song]
+
+class SessionJournal:
+    # The queue is saved as a snapshot plus an append-only journal of the
+    # edits made since. Each edit is one short line, flushed as it is
+    # written, so a crash loses at most the line in progress. Restoring is a
+    # sequential read of both files; no track is searched or resolved again.
+    def __init__(self, directory, compact_events=SESSION_COMPACT_EVENTS):
+        self.snapshot_path = os.path.join(directory, 'session.json')
+        self.journal_path = os.path.join(directory, 'session.journal')
+        self.compact_events = compact_events
+        self.seq = 0
+        self.events = 0
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        state = {'seq': 0, 'tracks': [], 'index': -1, 'seconds': 0.0, 'replay': False, 'volume': None}
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                state.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Could not read session snapshot: {str(e)}")
+        self.seq = state['seq']
+        
+        good = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    # Every event is written with its newline, so a line
+                    # without one (or that does not parse) is torn by a crash;
+                    # nothing after it is trusted.
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if event['seq'] <= state['seq']:
+                        continue
+                    self.apply(state, event)
+                    self.seq = event['seq']
+                    self.events += 1
+            self.truncate(good)
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, IndexError) as e:
+            print(f"Could not read session journal: {str(e)}")
+        return state
+    
+    def truncate(self, size):
+        # Cuts a torn tail off before anything is appended, or the next event
+        # would be glued onto it and lost along with every one after it.
+        if os.path.getsize(self.journal_path) > size:
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(size)
+
+    def apply(self, state, event):
+        # Edits move the saved position the same way PlayQueue moves its
+        # cursor, so it keeps pointing at the same track.
+        op = event['op']
+        tracks = state['tracks']
+        current = state['index']
+        if op == 'insert':
+            index = event['index']
+            tracks[index:index] = event['tracks']
+            if current >= index:
+                state['index'] += len(event['tracks'])
+        elif op == 'remove':
+            index = event['index']
+            del tracks[index]
+            if current > index:
+                state['index'] -= 1
+            elif current == index:
+                state['index'], state['seconds'] = index - 1, 0.0
+        elif op == 'replace':
+            index = event['index']
+            tracks[index:index + 1] = event['tracks']
+            if current > index or (current == index and not event['tracks']):
+                state['index'] += len(event['tracks']) - 1
+        elif op == 'move':
+            source, target = event['source'], event['target']
+            tracks.insert(target, tracks.pop(source))
+            if current == source:
+                state['index'] = target
+            elif source < current <= target:
+                state['index'] -= 1
+            elif target <= current < source:
+                state['index'] += 1
+        elif op == 'position':
+            state['index'] = event['index']
+            state['seconds'] = event['seconds']
+        elif op in ('replay', 'volume'):
+            state[op] = event['value']
+
+    def append(self, op, **data):
+        self.seq += 1
+        data.update(seq=self.seq, op=op)
+        if self.file is None:
+            self.file = open(self.journal_path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(data, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.events += 1
+        return self.events >= self.compact_events
+
+    def compact(self, state):
+        # The snapshot carries the sequence number it includes, so if the
+        # journal cannot be cleared afterwards its old lines are skipped.
+        state = dict(state, seq=self.seq)
+        part_path = self.snapshot_path + '.tmp'
+        with open(part_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(part_path, self.snapshot_path)
+        self.close()
+        open(self.journal_path, 'w').close()
+        self.events = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class QueueImport:
+    def __init__(self, import_id, queries):
+        self.id = import_id
+        self.entries = [{'query': query, 'state': 'pending', 'song': None, 'error': None}
+                        for query in queries]
+        self.added = 0
+        self.resolved = 0
+        self.failed = 0
+        self.cancelled = False
+
+    def finished(self):
+        return self.cancelled or self.added == len(self.entries)
+
+    def summary(self):
+        return {'id': self.id, 'total': len(self.entries), 'resolved': self.resolved,
+                'failed': self.failed, 'added': self.added, 'cancelled': self.cancelled}
+
+def is_url(text):
+    return text.startswith(('http://', 'https://'))
+
+class PlayerEngine:
+    # Queue, playback and resolve logic with no UI attached. Methods are meant
+    # to run on one thread (the Tk loop, or run_forever() when headless);
+    # other threads hand work over with post() or call().
+    def __init__(self):
+        init_audio()
+        self.is_playing = False
+        self.current_url = None
+        self.library = None
+        if LIBRARY_SEARCH:
+            try:
+                self.library = LocalLibrary(LIBRARY_PATH)
+            except sqlite3.Error as e:
+                print(f"Local library unavailable: {str(e)}")
+        self.cache = AudioCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_POLICY,
+                                on_change=self.library and self.library.set_cached)
+        self.resolver = TrackResolver(self.ydl_options())
+        self.suggestions = SuggestionIndex()
+        self.resolver.on_resolved = self.on_resolved
+        if self.library is not None:
+            self.library.sync_cached(self.cache.paths())
+        self.tracer = LatencyTracer()
+        self.search_backends = HedgedSearch([VideosSearchBackend(),
+                                             YtDlpSearchBackend(self.resolver)],
+                                            tracer=self.tracer)
+        self.search_service = SearchService(self.find_song)
+        self.import_executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix='import')
+        self.imports = {}
+        self.import_count = 0
+        self.calls = queue.Queue()
+        # Called from whichever thread posts, so an event-driven host (the Tk
+        # window) can wake up instead of polling.
+        self.on_wakeup = None
+        self.listeners = []
+        self.queue = PlayQueue()
+        self.replay_queue = False
+        self.volume = 50
+        
+        self.streaming_mode = STREAMING_MODE
+        self.transcode_fallback = TRANSCODE_FALLBACK
+        self.crossfade_seconds = CROSSFADE_SECONDS
+        self.stream = None
+        self.music_offset = 0
+        self.prefetch_count = PREFETCH_COUNT
+        self.track_ids = {}
+        self.fetch_locks = {}
+        self.fetch_locks_guard = threading.Lock()
+        self.cache_warm_count = CACHE_WARM_COUNT
+        self.adaptive_format = ADAPTIVE_FORMAT
+        self.upgrade_reduced = ADAPTIVE_UPGRADE
+        self.throughput = ThroughputMeter()
+        self.download_reports = {}
+        self.download_reports_lock = threading.Lock()
+        self.downloads = DownloadManager(self.download_track, on_change=self.on_download_change)
+        self.controller = PlaybackController(self.play_music)
+        self.queued_next = None
+        self.chained_next = None
+        # Bumped whenever the mixer is stopped or restarted on purpose, so an
+        # end event picked up just before that is not taken for the new track.
+        self.end_generation = 0
+        self.resume_at = 0
+        self.journal = SessionJournal(SESSION_DIR) if SESSION_RESTORE else None
+        self.position_logged = 0
+        if self.journal is not None:
+            self.restore_session()
+        threading.Thread(target=self.load_suggestions, daemon=True, name='suggestions').start()
+        threading.Thread(target=self.wait_for_end_events, daemon=True, name='track-end').start()
+    
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+    
+    def emit(self, event, **data):
+        # Listeners always run on the engine thread, whichever thread emits.
+        self.post(self._dispatch, event, data)
+    
+    def _dispatch(self, event, data):
+        for listener in list(self.listeners):
+            try:
+                listener(event, data)
+            except Exception as e:
+                print(f"Listener error: {str(e)}")
+    
+    def post(self, func, *args):
+        self.calls.put((func, args, None))
+        self.wake()
+    
+    def call(self, func, *args, timeout=10):
+        future = Future()
+        self.calls.put((func, args, future))
+        self.wake()
+        return future.result(timeout=timeout)
+    
+    def wake(self):
+        if self.on_wakeup is not None:
+            self.on_wakeup()
+    
+    def process_pending(self):
+        while True:
+            try:
+                func, args, future = self.calls.get_nowait()
+            except queue.Empty:
+                break
+            self._run_call(func, args, future)
+        if self.is_playing and time.monotonic() - self.position_logged >= SESSION_POSITION_INTERVAL:
+            self.log_position()
+    
+    def _run_call(self, func, args, future):
+        try:
+            result = func(*args)
+        except Exception as e:
+            if future is not None:
+                future.set_exception(e)
+            else:
+                print(f"Engine error: {str(e)}")
+        else:
+            if future is not None:
+                future.set_result(result)
+    
+    def run_forever(self):
+        while True:
+            timeout = SESSION_POSITION_INTERVAL if self.is_playing else None
+            try:
+                func, args, future = self.calls.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                self._run_call(func, args, future)
+            self.process_pending()
+    
+    def load_suggestions(self):
+        # Search history and every title in the library, indexed off the
+        # engine thread at startup.
+        try:
+            with self.search_service.lock:
+                queries = list(self.search_service.results)
+            self.suggestions.add_many((query, 2.0) for query in queries)
+            if self.library is not None:
+                self.suggestions.add_many((title, 1.0 + plays) for title, plays in self.library.titles())
+        except Exception as e:
+            print(f"Could not load suggestions: {str(e)}")
+    
+    def suggest(self, text, limit=None):
+        return self.suggestions.lookup(text, limit)
+    
+    def on_resolved(self, info):
+        if info.get('_type') == 'playlist':
+            return
+        self.suggestions.add(info.get('title'))
+        if self.library is not None:
+            self.library.add_info(info)
+    
+    def track_record(self, track):
+        if track.url is None:
+            return [None, track.title, track.playlist.url, track.playlist.offset]
+        return [track.url, track.title]
+    
+    def record_track(self, record):
+        if record[0] is None:
+            cursor = PlaylistCursor(self.resolver, record[2])
+            cursor.offset = record[3]
+            return cursor.placeholder(record[1])
+        return Track(record[0], record[1])
+    
+    def restore_session(self):
+        try:
+            state = self.journal.load()
+            tracks = [self.record_track(record) for record in state['tracks']]
+        except Exception as e:
+            print(f"Could not restore session: {str(e)}")
+            return
+        self.queue.reset(tracks)
+        self.queue.set_position(state['index'])
+        if self.queue.current is not None:
+            self.resume_at = state['seconds']
+        self.replay_queue = bool(state['replay'])
+        if state['volume'] is not None:
+            self.volume = state['volume']
+        if tracks:
+            self.emit_queue_reset()
+            self.emit('replay', enabled=self.replay_queue)
+    
+    def log_session(self, op, **data):
+        if self.journal is None:
+            return
+        try:
+            if self.journal.append(op, **data):
+                self.save_session()
+        except Exception as e:
+            print(f"Could not write session journal: {str(e)}")
+    
+    def log_position(self, seconds=None):
+        if seconds is None:
+            seconds = self.output_pos() / 1000.0 if self.current_url else self.resume_at
+        self.position_logged = time.monotonic()
+        self.log_session('position', index=self.queue.position(), seconds=round(seconds, 1))
+    
+    def session_state(self):
+        return {
+            'tracks': [self.track_record(track) for track in self.queue],
+            'index': self.queue.position(),
+            'seconds': self.output_pos() / 1000.0 if self.current_url else self.resume_at,
+            'replay': self.replay_queue,
+            'volume': self.volume,
+        }
+    
+    def save_session(self):
+        if self.journal is None:
+            return
+        try:
+            self.journal.compact(self.session_state())
+        except Exception as e:
+            print(f"Could not save session: {str(e)}")
+    
+    def close(self):
+        self.save_session()
+        self.search_service.flush()
+        if self.journal is not None:
+            self.journal.close()
+        if self.library is not None:
+            self.library.close()
+    
+    def warm_up(self):
+        threading.Thread(target=self._warm_up, daemon=True, name='warm-up').start()
+    
+    def _warm_up(self):
+        try:
+            self.resolver.warm_up()
+        except Exception as e:
+            print(f"Could not warm up extractor: {str(e)}")
+        self.search_backends.warm_up()
+    
+    def ydl_options(self):
+        return {
+            'format': 'bestaudio[ext=m4a]/bestaudio/best',
+            'outtmpl': os.path.join(self.cache.directory, '%(id)s.%(ext)s'),
+            'quiet': True,
+            'no_warnings': True,
+            'nocheckcertificate': True,
+            'noplaylist': True,
+            'buffersize': DOWNLOAD_BUFFER_SIZE,
+            'concurrent_fragments': DOWNLOAD_FRAGMENTS,
+        }
+    
+    def find_song(self, query):
+        # The local library answers first, so songs that have been played
+        # before are found instantly, and cached ones play offline.
+        # ONLINE_SEARCH_PREFIX skips it; tracer flags stay keyed by query.
+        text = query
+        library = self.library
+        if query[:len(ONLINE_SEARCH_PREFIX)].lower() == ONLINE_SEARCH_PREFIX:
+            text = query[len(ONLINE_SEARCH_PREFIX):].strip()
+            library = None
+        if is_url(text):
+            # Resolving a playlist would extract (and later download) every
+            # entry as one song; playlists go through add_playlist() instead.
+            if playlist_id_from_url(text):
+                raise ValueError("Playlist links cannot be looked up as a song")
+            video_id = video_id_from_url(text)
+            song = library.get(video_id) if library and video_id else None
+            if song is not None:
+                self.tracer.flag(query, 'search.source', 'library')
+                return dict(song, url=text)
+            self.tracer.flag(query, 'search.source', 'network')
+            with self.tracer.span('resolve', query):
+                info = self.resolver.resolve(text)
+            return {'url': text, 'title': info.get('title', 'Unknown Title'), 'id': info.get('id')}
+        if library is not None:
+            with self.tracer.span('search.library', query):
+                song = library.find(text)
+            if song is not None:
+                self.tracer.flag(query, 'search.source', 'library')
+                return song
+        self.tracer.flag(query, 'search.source', 'network')
+        return self.search_backends(text)
+    
+    def enqueue(self, query):
+        query = query.strip()
+        if not query:
+            return
+        if playlist_id_from_url(query):
+            self.add_playlist(query)
+            return
+        
+        def on_result(song, error):
+            self.post(self.add_search_result, query, song, error)
+        
+        self.tracer.begin('search', query)
+        self.tracer.flag(query, 'search.cache', 'miss' if self.search_service.cached(query) is None else 'hit')
+        self.search_service.submit(query, on_result)
+    
+    def add_search_result(self, query, song, error):
+        self.tracer.end(query, 'error' if error is not None else 'ok' if song is not None else 'not found')
+        if error is not None:
+            print(f"Search error: {str(error)}")
+            self.emit('message', text="Could not find song")
+            return
+        if song is None:
+            self.emit('message', text="No results found")
+            return
+        if not is_url(query):
+            self.suggestions.add(query, 2.0)
+        self.add_song(song, query)
+    
+    def import_queries(self, queries):
+        # Entries resolve in any order on the import pool but join the queue
+        # in input order: each result is held until everything before it has
+        # been added or has failed.
+        queries = [query.strip() for query in queries if query and query.strip()]
+        if not queries:
+            return None
+        self.import_count += 1
+        job = QueueImport(self.import_count, queries)
+        self.imports[job.id] = job
+        self.emit('import', **job.summary())
+        for position, query in enumerate(queries):
+            self.import_executor.submit(self._import_entry, job, position, query)
+        return job.id
+    
+    def _import_entry(self, job, position, query):
+        if job.cancelled:
+            return
+        song, error = None, None
+        if playlist_id_from_url(query):
+            self.post(self.import_result, job, position, {'playlist': query, 'title': "Playlist"}, None)
+            return
+        try:
+            song = self.search_service.lookup(query)
+        except Exception as e:
+            error = e
+        self.post(self.import_result, job, position, song, error)
+    
+    def import_result(self, job, position, song, error):
+        if job.cancelled:
+            return
+        entry = job.entries[position]
+        if song is None:
+            entry['state'] = 'failed'
+            entry['error'] = str(error) if error is not None else "No results found"
+            job.failed += 1
+        else:
+            entry['state'] = 'resolved'
+            entry['song'] = song
+            job.resolved += 1
+        self.emit('import_entry', id=job.id, position=position, query=entry['query'],
+                  state=entry['state'], title=song and song['title'], error=entry['error'])
+        
+        while job.added < len(job.entries) and job.entries[job.added]['state'] != 'pending':
+            entry = job.entries[job.added]
+            job.added += 1
+            if entry['state'] == 'resolved' and 'playlist' in entry['song']:
+                self.add_playlist(entry['song']['playlist'])
+            elif entry['state'] == 'resolved':
+                self.add_song(entry['song'], entry['query'])
+        self.emit('import', **job.summary())
+        
+        if job.finished():
+            del self.imports[job.id]
+    
+    def cancel_import(self, import_id):
+        job = self.imports.pop(import_id, None)
+        if job is None:
+            return False
+        job.cancelled = True
+        self.emit('import', **job.summary())
+        return True
+    
+    def add_song(self, song, query=None):
+        url = song['url']
+        if song.get('id'):
+            self.track_ids[url] = song['id']
+        
+        track = Track(url, song['title'])
+        self.queue.append(track)
+        self.log_session('insert', index=len(self.queue) - 1, tracks=[self.track_record(track)])
+        self.emit('queue_added', index=len(self.queue) - 1, title=song['title'], query=query)
+        self.schedule_prefetch()
+        
+        if len(self.queue) == 1:
+            self.start_song(0)
+    
+    def add_playlist(self, url):
+        # The playlist joins the queue as a single placeholder that is swapped
+        # for a page of entries (plus a new placeholder) when it nears the
+        # play head, so even very long playlists cost one page at a time.
+        cursor = PlaylistCursor(self.resolver, url)
+        entry = cursor.placeholder()
+        self.queue.append(entry, record=False)
+        self.log_session('insert', index=len(self.queue) - 1, tracks=[self.track_record(entry)])
+        self.emit('queue_added', index=len(self.queue) - 1, title=entry.title, query=url)
+        if len(self.queue) == 1:
+            self.start_song(0)
+        else:
+            self.expand_playlist(cursor)
+    
+    def placeholder_index(self, cursor):
+        if cursor.placeholder_id is None:
+            return None
+        return self.queue.index_of(cursor.placeholder_id)
+    
+    def expand_playlist(self, cursor):
+        if cursor.loading:
+            return
+        cursor.loading = True
+        self.import_executor.submit(self._load_playlist_page, cursor)
+    
+    def _load_playlist_page(self, cursor):
+        songs, error = [], None
+        try:
+            songs = cursor.next_page(PLAYLIST_PAGE_SIZE)
+        except Exception as e:
+            error = e
+        self.post(self.playlist_page, cursor, songs, error)
+    
+    def playlist_page(self, cursor, songs, error):
+        cursor.loading = False
+        index = self.placeholder_index(cursor)
+        if index is None:
+            return
+        if error is not None:
+            print(f"Playlist error: {str(error)}")
+            self.emit('message', text="Could not load playlist")
+            cursor.play_when_ready = False
+            self.remove(index)
+            return
+        
+        for song in songs:
+            if song.get('id'):
+                self.track_ids[song['url']] = song['id']
+        entries = [Track(song['url'], song['title']) for song in songs]
+        if not cursor.exhausted:
+            entries.append(cursor.placeholder())
+        was_current = index == self.queue.position()
+        self.queue.replace(index, entries)
+        self.log_session('replace', index=index, tracks=[self.track_record(entry) for entry in entries])
+        self.emit('queue_removed', index=index)
+        self.emit('queue_inserted', index=index, titles=[entry.title for entry in entries])
+        
+        play, cursor.play_when_ready = cursor.play_when_ready, False
+        if was_current and play:
+            if entries:
+                self.start_song(index)
+            else:
+                self.play_next()
+        else:
+            self.schedule_prefetch()
+    
+    def expand_upcoming(self):
+        for track in self.queue.upcoming(PLAYLIST_LOOKAHEAD):
+            if track.url is None:
+                self.expand_playlist(track.playlist)
+    
+    def start_song(self, index, start=0):
+        self.queue.set_position(index)
+        self.resume_at = 0
+        self.log_position(start)
+        song = self.queue[index]
+        self.emit('track', index=index)
+        self.expand_upcoming()
+        if song.url is None:
+            # Reached a playlist placeholder: the page is fetched first and
+            # the track starts when it arrives.
+            self.controller.cancel()
+            self.stop_output()
+            self.is_playing = False
+            self.current_url = None
+            song.playlist.play_when_ready = True
+            self.expand_playlist(song.playlist)
+            self.emit('state', state='loading', title=song.title)
+            return
+        self.controller.play(song.url, song.title, start)
+    
+    def remove(self, index):
+        if 0 <= index < len(self.queue):
+            was_current = index == self.queue.position()
+            self.queue.remove(index)
+            self.log_session('remove', index=index)
+            self.emit('queue_removed', index=index)
+            
+            if was_current:
+                self.stop_music()
+                if self.queue:
+                    self.play_next()
+            
+            self.schedule_prefetch()
+    
+    def move(self, source, target):
+        if not 0 <= source < len(self.queue) or source == target:
+            return
+        target = self.queue.move(source, target)
+        self.log_session('move', source=source, target=target)
+        self.emit('queue_moved', source=source, target=target, index=self.queue.position())
+        self.after_reorder()
+    
+    def shuffle(self):
+        self.queue.shuffle()
+        self.save_session()
+        self.emit_queue_reset()
+        self.after_reorder()
+    
+    def dedupe(self):
+        removed = self.queue.dedupe()
+        if removed:
+            self.save_session()
+            self.emit_queue_reset()
+            self.schedule_prefetch()
+        return removed
+    
+    def undo(self):
+        playing = self.queue.current
+        if not self.queue.undo():
+            return False
+        self.save_session()
+        self.emit_queue_reset()
+        if playing is not None and self.queue.index_of(playing.id) is None:
+            self.stop_music()
+            if self.queue:
+                self.play_next()
+        self.after_reorder()
+        return True
+    
+    def emit_queue_reset(self):
+        self.emit('queue_reset', titles=[track.title for track in self.queue],
+                  index=self.queue.position())
+    
+    def after_reorder(self):
+        # Whatever was lined up behind the current track may no longer be
+        # next, so the gapless hand-off is redone along with prefetch.
+        self.queued_next = None
+        if self.stream is not None:
+            self.chained_next = None
+            self.stream.unchain()
+        self.expand_upcoming()
+        self.schedule_prefetch()
+    
+    def play_index(self, index):
+        if 0 <= index < len(self.queue) and index != self.queue.position():
+            self.start_song(index)
+    
+    def mark_played(self, url):
+        video_id = self.track_id(url)
+        if not video_id:
+            return
+        self.cache.mark_played(video_id)
+        if self.library is not None:
+            try:
+                self.library.mark_played(video_id)
+            except sqlite3.Error as e:
+                print(f"Could not update library: {str(e)}")
+    
+    def fetch_lock(self, url):
+        with self.fetch_locks_guard:
+            return self.fetch_locks.setdefault(url, threading.Lock())
+    
+    def track_id(self, url):
+        return self.track_ids.get(url) or video_id_from_url(url)
+    
+    def is_fetched(self, url):
+        video_id = self.track_id(url)
+        return video_id is not None and self.cache.contains(video_id)
+    
+    def fetch_track(self, url, cancelled=None):
+        video_id = self.track_id(url)
+        if video_id:
+            cached = self.cache.get(video_id)
+            if cached:
+                if self.cache.is_reduced(video_id):
+                    self.request_upgrade(url)
+                return cached
+        
+        # Playback waits on the same job as an in-flight prefetch instead of
+        # starting a second download; asking at PRIORITY_CURRENT moves it to
+        # the front.
+        job = self.downloads.request(url, PRIORITY_CURRENT)
+        while not job.done.wait(0.1):
+            if cancelled and cancelled():
+                self.downloads.release(job)
+                raise PlaybackCancelled()
+        if job.error is not None:
+            raise job.error
+        return job.path
+    
+    def download_track(self, job):
+        # Serialised per URL with open_stream, which tees into the same file.
+        url = job.url
+        lock = self.fetch_lock(url)
+        while not lock.acquire(timeout=0.1):
+            if job.stopping():
+                raise PlaybackCancelled()
+        try:
+            video_id = self.track_id(url)
+            cached = self.cache.path(video_id) if video_id else None
+            if cached and not (job.upgrade and self.cache.is_reduced(video_id)):
+                return cached
+            
+            with self.tracer.span('resolve', url):
+                info = self.resolver.resolve(url)
+            video_id = info['id']
+            self.track_ids[url] = video_id
+            cached = self.cache.path(video_id)
+            if cached and not (job.upgrade and self.cache.is_reduced(video_id)):
+                return cached
+            if job.stopping():
+                raise PlaybackCancelled()
+            
+            # Only a track someone is waiting for is worth a lower bitrate;
+            # prefetches have the rest of the current song to finish.
+            fmt = None
+            if job.priority == PRIORITY_CURRENT and not job.upgrade:
+                fmt = self.adaptive_choice(info, info.get('duration') or 0)
+            
+            def progress(status):
+                job.update(status)
+                if status.get('status') == 'finished':
+                    self.throughput.record(status.get('downloaded_bytes') or status.get('total_bytes'),
+                                           status.get('elapsed'))
+            
+            # A stopped download leaves its .part file behind, so yt_dlp
+            # resumes it when the job runs again.
+            if fmt is not None:
+                with self.tracer.span('download', url):
+                    temp_file = (self.resolver.download(info, job.stopping, progress, job.rate_limit,
+                                                        fmt['format_id'], self.reduced_outtmpl())
+                                 or self.cache.path_for(video_id, fmt['ext'], fmt['format_id']))
+                self.cache.add(video_id, temp_file, audio_codec(fmt), info.get('duration'), reduced=True)
+                self.request_upgrade(url)
+            else:
+                with self.tracer.span('download', url):
+                    temp_file = (self.resolver.download(info, job.stopping, progress, job.rate_limit)
+                                 or self.cache.path_for(video_id, info['ext']))
+                self.cache.add(video_id, temp_file, audio_codec(info), info.get('duration'))
+            return temp_file
+        finally:
+            lock.release()
+    
+    def reduced_outtmpl(self):
+        return os.path.join(self.cache.directory, '%(id)s.%(format_id)s.%(ext)s')
+    
+    def adaptive_choice(self, info, buffer_seconds):
+        if not self.adaptive_format:
+            return None
+        return choose_audio_format(info.get('formats'), self.throughput.estimate(),
+                                   ADAPTIVE_TARGET_SECONDS, buffer_seconds)
+    
+    def request_upgrade(self, url):
+        if self.upgrade_reduced:
+            self.downloads.request(url, PRIORITY_BACKGROUND, upgrade=True)
+    
+    def on_download_change(self, job):
+        if job.upgrade:
+            return
+        # One report per track is in flight at a time; progress that arrives
+        # before it runs just updates it, so busy downloads cannot flood the
+        # engine queue.
+        with self.download_reports_lock:
+            pending = job.url in self.download_reports
+            self.download_reports[job.url] = (job.state, job.fraction())
+        if not pending:
+            self.post(self.report_download, job.url)
+        if job.state == 'done':
+            self.post(self.queue_next_track)
+    
+    def report_download(self, url):
+        with self.download_reports_lock:
+            state, progress = self.download_reports.pop(url)
+        for index in self.queue.positions_of(url):
+            self.emit('download', index=index, state=state, progress=progress)
+    
+    def transcode_to_mp3(self, url, video_id, path):
+        mp3_file = self.cache.path_for(video_id, 'mp3')
+        part_file = mp3_file + '.part'
+        with self.tracer.span('transcode', url):
+            subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', path,
+                            '-vn', '-c:a', 'libmp3lame', '-b:a', '192k', '-f', 'mp3', part_file],
+                           check=True, stdin=subprocess.DEVNULL)
+        os.replace(part_file, mp3_file)
+        self.cache.add(video_id, mp3_file, 'mp3')
+        return mp3_file
+    
+    def upcoming_urls(self, count):
+        urls = []
+        for track in self.queue.upcoming(max(0, count), self.replay_queue):
+            if track.url is not None and track.url not in urls:
+                urls.append(track.url)
+        return urls
+    
+    def schedule_prefetch(self):
+        try:
+            upcoming = self.upcoming_urls(max(0, self.prefetch_count) + self.cache_warm_count)
+            pinned = [self.track_id(url) for url in upcoming]
+            if self.current_url:
+                pinned.append(self.track_id(self.current_url))
+            self.cache.pin(video_id for video_id in pinned if video_id)
+            
+            wanted = {}
+            for position, url in enumerate(upcoming):
+                if self.is_fetched(url):
+                    continue
+                if position == 0 and self.prefetch_count > 0:
+                    wanted[url] = PRIORITY_NEXT
+                elif position < self.prefetch_count:
+                    wanted[url] = PRIORITY_PREFETCH
+                else:
+                    wanted[url] = PRIORITY_BACKGROUND
+            self.downloads.retain(wanted)
+            self.queue_next_track()
+        except Exception as e:
+            print(f"Could not schedule prefetch: {str(e)}")
+    
+    def open_stream(self, url, start=0):
+        if not shutil.which('ffmpeg'):
+            return None
+        if start:
+            return self.open_stream_at(url, start)
+        
+        lock = self.fetch_lock(url)
+        if not lock.acquire(blocking=False):
+            return None
+        
+        stream = None
+        try:
+            video_id = self.track_id(url)
+            if video_id and self.cache.contains(video_id):
+                return None
+            
+            with self.tracer.span('resolve', url):
+                info = self.resolver.resolve(url)
+            video_id = info['id']
+            self.track_ids[url] = video_id
+            if self.cache.contains(video_id) or not info.get('url'):
+                return None
+            fmt = self.adaptive_choice(info, STREAM_PREBUFFER_SECONDS)
+            source = fmt or info
+            if source.get('ext') not in CONTAINER_FORMATS:
+                return None
+            
+            self.cache.note_miss()
+            cache_path = self.cache.path_for(video_id, source['ext'], fmt and fmt['format_id'])
+            codec = audio_codec(source)
+            duration = info.get('duration')
+            
+            def on_finished(completed):
+                try:
+                    if completed:
+                        self.cache.add(video_id, cache_path, codec, duration, reduced=fmt is not None)
+                        if fmt is not None:
+                            self.request_upgrade(url)
+                finally:
+                    lock.release()
+            
+            stream = StreamingPlayback(source['url'], source.get('http_headers') or info.get('http_headers'),
+                                       cache_path, on_finished)
+            return stream
+        finally:
+            if stream is None:
+                lock.release()
+    
+    def open_stream_at(self, url, start):
+        # Seeking into a track that is not cached yet reads the remote stream
+        # from the offset without teeing it, since the copy would be partial.
+        video_id = self.track_id(url)
+        if video_id and self.cache.contains(video_id):
+            return None
+        info = self.resolver.resolve(url)
+        self.track_ids[url] = info['id']
+        if self.cache.contains(info['id']) or not info.get('url'):
+            return None
+        return StreamingPlayback(info['url'], info.get('http_headers'), start=start)
+    
+    def open_local(self, url, path, start=0):
+        # Files the mixer cannot load (m4a, webm/opus) are decoded on the fly
+        # rather than re-encoded; mp3 transcoding is only an opt-in fallback.
+        if file_extension(path) in MIXER_NATIVE_EXTENSIONS and self.crossfade_seconds <= 0:
+            return None, path
+        # Without FFmpeg there is neither a decoder nor a transcoder, so that
+        # is reported as it is rather than through the mp3 fallback.
+        if not shutil.which('ffmpeg'):
+            if file_extension(path) in MIXER_NATIVE_EXTENSIONS:
+                return None, path
+            raise RuntimeError("FFmpeg is required to play " + os.path.basename(path))
+        try:
+            return StreamingPlayback(path, prebuffer=StreamingPlayback.CHUNK_SECONDS, start=start), path
+        except RuntimeError:
+            # The mixer's sample format cannot take the decoded audio.
+            if not self.transcode_fallback:
+                raise
+            return None, self.transcode_to_mp3(url, self.track_id(url), path)
+    
+    
+    def stop_output(self):
+        self.queued_next = None
+        self.chained_next = None
+        if self.stream:
+            self.stream.stop()
+            self.stream = None
+        pygame.mixer.music.stop()
+        pygame.mixer.music.unload()
+        # Stopping deliberately still fires the end event; drop it so it is
+        # not mistaken for the track finishing.
+        pygame.event.clear(TRACK_END_EVENT)
+        self.end_generation += 1
+    
+    def pause_output(self):
+        if self.stream:
+            self.stream.pause()
+        else:
+            pygame.mixer.music.pause()
+    
+    def unpause_output(self):
+        if self.stream:
+            self.stream.unpause()
+        else:
+            pygame.mixer.music.unpause()
+    
+    def output_busy(self):
+        if self.stream:
+            return self.stream.get_busy()
+        return pygame.mixer.music.get_busy()
+    
+    def output_pos(self):
+        if self.stream:
+            return self.stream.get_pos()
+        return self.music_offset + pygame.mixer.music.get_pos()
+    
+    def current_title(self):
+        track = self.queue.current
+        return track.title if track is not None else None
+    
+    def restart_current(self):
+        self.seek(0)
+    
+    def seek(self, seconds):
+        song = self.queue.current
+        if not self.current_url or song is None:
+            return
+        seconds = max(0.0, float(seconds))
+        if self.stream:
+            self.stop_output()
+            self.controller.play(song.url, song.title, seconds)
+            self.log_position(seconds)
+            return
+        try:
+            pygame.mixer.music.play(start=seconds)
+        except Exception as e:
+            print(f"Seek error: {str(e)}")
+            return
+        self.music_offset = int(seconds * 1000)
+        self.log_position(seconds)
+        pygame.event.clear(TRACK_END_EVENT)
+        self.end_generation += 1
+        self.queued_next = None
+        self.queue_next_track()
+        self.is_playing = True
+        self.emit('state', state='playing', title=song.title)
+    
+    def play_music(self, url, title, cancelled=lambda: False, start=0):
+        # Traced from here to the first sound: for the mixer that is play(),
+        # for a stream it is when the prebuffer has filled and the first chunk
+        # reaches the channel.
+        stream = None
+        temp_file = None
+        self.tracer.begin('play', url, title=title)
+        self.tracer.flag(url, 'play.cache', 'hit' if self.is_fetched(url) else 'miss')
+        try:
+            if self.streaming_mode:
+                if self.call(self.restarting_stream, url):
+                    self.call(self.stop_output)
+                with self.tracer.span('play.stream', url):
+                    stream = self.open_stream(url, start)
+            if stream is None:
+                with self.tracer.span('play.fetch', url):
+                    temp_file = self.fetch_track(url, cancelled)
+                with self.tracer.span('play.decode', url):
+                    stream, temp_file = self.open_local(url, temp_file, start)
+            if cancelled():
+                raise PlaybackCancelled()
+            # The output is switched on the engine thread, where stop_music()
+            # and newer requests run, so nothing can cancel this track between
+            # the last check and the mixer starting.
+            if not self.call(self.start_output, url, title, stream, temp_file, start, cancelled):
+                raise PlaybackCancelled()
+        
+        except Exception as e:
+            if stream is not None:
+                self.post(self.abandon_stream, stream)
+            if cancelled() or isinstance(e, PlaybackCancelled):
+                self.tracer.end(url, 'cancelled')
+                return
+            self.tracer.end(url, 'error')
+            print(f"Playback error: {str(e)}")
+            self.post(self.playback_failed, title, cancelled)
+    
+    def restarting_stream(self, url):
+        return self.stream is not None and self.current_url == url
+    
+    def start_output(self, url, title, stream, path, start, cancelled):
+        if cancelled():
+            return False
+        self.stop_output()
+        volume = self.volume / 100.0
+        if stream is not None:
+            self.stream = stream
+            stream.on_end = lambda: self.post(self.on_stream_end, stream)
+            output_started = time.perf_counter()
+            stream.on_first_sound = lambda: self.on_first_sound(url, output_started)
+            with self.tracer.span('play.output', url):
+                stream.start(volume)
+        else:
+            with self.tracer.span('play.output', url):
+                pygame.mixer.music.load(path)
+                pygame.mixer.music.set_volume(volume)
+                pygame.mixer.music.play(start=start)
+            self.tracer.end(url)
+        self.music_offset = int(start * 1000)
+        
+        self.is_playing = True
+        self.current_url = url
+        self.emit('state', state='playing', title=title)
+        
+        self.mark_played(url)
+        self.schedule_prefetch()
+        return True
+    
+    def abandon_stream(self, stream):
+        if stream is not self.stream:
+            stream.abandon()
+    
+    def playback_failed(self, title, cancelled):
+        if cancelled():
+            return
+        self.is_playing = False
+        self.emit('state', state='error', title=title)
+        if self.queue.position() < len(self.queue) - 1:
+            threading.Timer(1.0, self.post, (self.play_next,)).start()
+    
+    def on_first_sound(self, url, started):
+        # Runs on the stream's feed thread.
+        self.tracer.record('play.prebuffer', time.perf_counter() - started, url)
+        self.tracer.end(url)
+    
+    def pause(self):
+        if self.is_playing:
+            self.pause_output()
+            self.is_playing = False
+            self.log_position()
+            self.emit('state', state='paused', title=self.current_title())
+    
+    def resume(self):
+        if self.is_playing:
+            return
+        if self.current_url:
+            self.unpause_output()
+            self.is_playing = True
+            self.emit('state', state='playing', title=self.current_title())
+        elif self.queue:
+            self.start_song(max(self.queue.position(), 0), self.resume_at)
+    
+    def toggle_play(self):
+        if self.is_playing:
+            self.pause()
+        else:
+            self.resume()
+    
+    def stop_music(self):
+        self.controller.cancel()
+        self.stop_output()
+        self.is_playing = False
+        self.current_url = None
+        self.emit('state', state='stopped', title=None)
+    
+    def play_next(self):
+        index = self.next_index()
+        if index is None:
+            self.stop_music()
+            self.emit('state', state='ended', title=None)
+            return
+        self.start_song(index)
+    
+    def play_previous(self):
+        index = self.queue.position()
+        if self.current_url and index >= 0:
+            if self.output_pos() > 3000:
+                self.restart_current()
+                return
+            
+            if index > 0:
+                self.start_song(index - 1)
+            else:
+                self.restart_current()
+    
+    def set_volume(self, value, log=True):
+        # A dragged slider passes log=False for every step and calls
+        # log_volume() once it settles, so the journal gets one entry.
+        self.volume = max(0, min(100, int(float(value))))
+        volume = self.volume / 100.0
+        pygame.mixer.music.set_volume(volume)
+        if self.stream:
+            self.stream.set_volume(volume)
+        if log:
+            self.log_volume()
+        self.emit('volume', value=self.volume)
+    
+    def log_volume(self):
+        self.log_session('volume', value=self.volume)
+    
+    def set_replay(self, enabled):
+        self.replay_queue = bool(enabled)
+        self.log_session('replay', value=self.replay_queue)
+        self.emit('replay', enabled=self.replay_queue)
+        self.schedule_prefetch()
+    
+    def toggle_replay(self):
+        self.set_replay(not self.replay_queue)
+    
+    def next_index(self):
+        index = self.queue.position()
+        if index < len(self.queue) - 1:
+            return index + 1
+        if self.replay_queue and self.queue:
+            return 0
+        return None
+    
+    def queue_next_track(self):
+        # Hands the next cached track to pygame.mixer.music.queue so the mixer
+        # switches to it without waiting for the end event to be handled.
+        if not self.current_url:
+            return
+        index = self.next_index()
+        if self.stream is not None:
+            self.chain_next_track(index)
+            return
+        if index is None or self.queue[index].url is None:
+            # pygame cannot take back a queued file; forgetting it makes
+            # on_music_end stop whatever the mixer switches to.
+            self.queued_next = None
+            return
+        song = self.queue[index]
+        if self.queued_next and self.queued_next[0] == song.id:
+            return
+        video_id = self.track_id(song.url)
+        path = self.cache.path(video_id) if video_id else None
+        if path and file_extension(path) in MIXER_NATIVE_EXTENSIONS:
+            try:
+                pygame.mixer.music.queue(path)
+                self.queued_next = (song.id, song.url, song.title)
+            except Exception as e:
+                print(f"Could not queue next track: {str(e)}")
+    
+    def chain_next_track(self, index):
+        # Decoded playback gets the next track through the stream itself, which
+        # joins the two at the sample boundary (or crossfades them).
+        stream = self.stream
+        if stream is None:
+            return
+        if index is None or self.queue[index].url is None:
+            self.chained_next = None
+            stream.unchain()
+            return
+        song = self.queue[index]
+        if self.chained_next and self.chained_next[0] == song.id and stream.active().next:
+            return
+        video_id = self.track_id(song.url)
+        path = self.cache.path(video_id) if video_id else None
+        if not path or not shutil.which('ffmpeg'):
+            self.chained_next = None
+            stream.unchain()
+            return
+        try:
+            next_stream = StreamingPlayback(path, prebuffer=StreamingPlayback.CHUNK_SECONDS)
+        except RuntimeError as e:
+            print(f"Could not chain next track: {str(e)}")
+            return
+        track_id, url, title = song.id, song.url, song.title
+        next_stream.on_start = lambda: self.post(self.on_stream_handoff, next_stream, track_id, url, title)
+        next_stream.on_end = lambda: self.post(self.on_stream_end, next_stream)
+        self.chained_next = (track_id, url, title)
+        stream.active().chain(next_stream, self.crossfade_seconds)
+    
+    def advance_to(self, index, url, title):
+        self.queue.set_position(index)
+        self.log_position(0)
+        self.current_url = url
+        self.music_offset = 0
+        self.emit('track', index=index)
+        self.emit('state', state='playing', title=title)
+        self.mark_played(url)
+        self.expand_upcoming()
+        self.schedule_prefetch()
+    
+    def on_stream_handoff(self, stream, track_id, url, title):
+        if self.stream is None or self.stream.active() is not stream:
+            return
+        self.stream = stream
+        self.chained_next = None
+        index = self.queue.index_of(track_id)
+        if index is not None:
+            self.advance_to(index, url, title)
+        else:
+            self.on_track_end()
+    
+    def wait_for_end_events(self):
+        # Runs on its own thread, blocked on pygame's event queue, where the
+        # track end event is the only one allowed. Each event is handed to the
+        # engine thread, which wakes the window through post().
+        while True:
+            try:
+                event = pygame.event.wait()
+            except Exception as e:
+                print(f"Track end watcher stopped: {str(e)}")
+                return
+            if event.type == TRACK_END_EVENT:
+                self.post(self.on_end_event, self.end_generation)
+    
+    def on_end_event(self, generation):
+        if generation == self.end_generation:
+            self.on_music_end()
+    
+    def on_music_end(self):
+        if not self.is_playing or self.stream is not None:
+            return
+        queued, self.queued_next = self.queued_next, None
+        if queued and pygame.mixer.music.get_busy():
+            # The mixer has already switched to the queued file. It is kept
+            # only if that is still the track that comes next; otherwise
+            # on_track_end() stops it or starts the right one.
+            track_id, url, title = queued
+            index = self.queue.index_of(track_id)
+            if index is not None and index == self.next_index():
+                self.advance_to(index, url, title)
+                return
+        self.on_track_end()
+    
+    def on_stream_end(self, stream):
+        if self.stream is not None and stream is self.stream.active() and self.is_playing:
+            self.on_track_end()
+    
+    def on_track_end(self):
+        self.play_next()
+    
+    def status(self):
+        if self.is_playing:
+            state = 'playing'
+        elif self.current_url:
+            state = 'paused'
+        else:
+            state = 'stopped'
+        return {
+            'state': state,
+            'index': self.queue.position(),
+            'title': self.current_title() if self.current_url else None,
+            'position': self.output_pos() / 1000.0 if self.current_url else 0.0,
+            'volume': self.volume,
+            'replay': self.replay_queue,
+            'length': len(self.queue),
+        }
+    
+    def queue_items(self):
+        current = self.queue.current
+        return [{'index': i, 'id': track.id, 'title': track.title, 'url': track.url,
+                 'current': track is current, 'placeholder': track.url is None}
+                for i, track in enumerate(self.queue)]
+    
+    def storage_stats(self):
+        return {'cache': self.cache.stats(),
+                'library': self.library.stats() if self.library is not None else None}
+    
+    def handle_command(self, command):
+        name = command.get('cmd')
+        if name == 'status':
+            return self.status()
+        if name == 'queue':
+            return {'queue': self.queue_items()}
+        if name == 'downloads':
+            return {'downloads': self.downloads.snapshot()}
+        if name == 'stats':
+            return dict(self.storage_stats(), stats=self.tracer.summary())
+        if name == 'cache':
+            return {'cache': self.cache.stats()}
+        if name == 'library':
+            if self.library is None:
+                return {'library': None}
+            if command.get('query'):
+                return {'library': self.library.search(command['query'], limit=20)}
+            return {'library': self.library.stats()}
+        if name == 'import':
+            return {'import': self.import_queries(list(command['queries']))}
+        if name == 'imports':
+            return {'imports': [job.summary() for job in self.imports.values()]}
+        if name == 'cancel-import':
+            return {'changed': self.cancel_import(int(command['id']))}
+        if name in ('pause-download', 'resume-download'):
+            url = self.queue[int(command['index'])].url
+            if name == 'pause-download':
+                changed = self.downloads.pause(url)
+            else:
+                changed = self.downloads.resume(url)
+            return {'changed': changed}
+        if name == 'enqueue':
+            self.enqueue(str(command['query']))
+        elif name == 'play':
+            if command.get('index') is not None:
+                self.play_index(int(command['index']))
+            else:
+                self.resume()
+        elif name == 'pause':
+            self.pause()
+        elif name == 'resume':
+            self.resume()
+        elif name == 'toggle':
+            self.toggle_play()
+        elif name == 'stop':
+            self.stop_music()
+        elif name in ('next', 'skip'):
+            self.play_next()
+        elif name == 'previous':
+            self.play_previous()
+        elif name == 'seek':
+            self.seek(command['position'])
+        elif name == 'volume':
+            self.set_volume(command['value'])
+        elif name == 'remove':
+            self.remove(int(command['index']))
+        elif name == 'move':
+            self.move(int(command['index']), int(command['to']))
+        elif name == 'shuffle':
+            self.shuffle()
+        elif name == 'dedupe':
+            return {'removed': self.dedupe()}
+        elif name == 'undo':
+            return {'changed': self.undo()}
+        elif name == 'replay':
+            if command.get('enabled') is None:
+                self.toggle_replay()
+            else:
+                self.set_replay(command['enabled'])
+        else:
+            raise ValueError(f"Unknown command: {name}")
+        return self.status()
+
+def write_control_token(path):
+    token = secrets.token_hex(32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    # On Windows the mode is ignored, but the profile directory is already
+    # private to the user.
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(token)
+    os.replace(tmp_path, path)
+    return token
+
+def read_control_token(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+class ControlServer:
+    # Newline-delimited JSON over a Unix socket (TCP on localhost where Unix
+    # sockets are unavailable). Each request is run on the engine thread.
+    # Any local program, including a web page posting to the TCP port, can
+    # connect, so a connection is dropped at its first line that is not a
+    # JSON object carrying the token from CONTROL_TOKEN_PATH.
+    def __init__(self, engine, path=CONTROL_SOCKET_PATH, port=CONTROL_PORT, token_path=CONTROL_TOKEN_PATH):
+        self.engine = engine
+        self.path = path
+        self.port = port
+        self.token_path = token_path
+        self.token = None
+        self.sock = None
+    
+    def start(self):
+        if hasattr(socket, 'AF_UNIX'):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if os.path.exists(self.path):
+                if self.probe():
+                    raise RuntimeError("Another player is listening on " + self.path)
+                os.remove(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+            os.chmod(self.path, 0o600)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.bind(('127.0.0.1', self.port))
+        self.token = write_control_token(self.token_path)
+        self.sock.listen(4)
+        threading.Thread(target=self._accept, daemon=True).start()
+    
+    def probe(self):
+        try:
+            send_command({'cmd': 'status'}, self.path, self.port, timeout=1, token_path=self.token_path)
+            return True
+        except OSError:
+            return False
+    
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if hasattr(socket, 'AF_UNIX') and os.path.exists(self.path):
+                os.remove(self.path)
+    
+    def _accept(self):
+        while self.sock is not None:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+    
+    def authorized(self, command):
+        token = command.get('token') if isinstance(command, dict) else None
+        return isinstance(token, str) and hmac.compare_digest(token, self.token)
+    
+    def _serve(self, conn):
+        with conn, conn.makefile('rw', encoding='utf-8', newline='\n') as stream:
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    command = json.loads(line)
+                except ValueError:
+                    command = None
+                if not self.authorized(command):
+                    stream.write(json.dumps({'ok': False, 'error': "Not authorized"}) + '\n')
+                    stream.flush()
+                    break
+                del command['token']
+                try:
+                    result = self.engine.call(self.engine.handle_command, command)
+                    reply = dict(result, ok=True)
+                except Exception as e:
+                    reply = {'ok': False, 'error': str(e)}
+                stream.write(json.dumps(reply) + '\n')
+                stream.flush()
+
+def send_command(command, path=CONTROL_SOCKET_PATH, port=CONTROL_PORT, timeout=10,
+                 token_path=CONTROL_TOKEN_PATH):
+    command = dict(command, token=read_control_token(token_path))
+    if hasattr(socket, 'AF_UNIX'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = path
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = ('127.0.0.1', port)
+    with sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        with sock.makefile('rw', encoding='utf-8', newline='\n') as stream:
+            stream.write(json.dumps(command) + '\n')
+            stream.flush()
+            return json.loads(stream.readline())
+
+def parse_command(args):
+    name = args[0]
+    command = {'cmd': name}
+    value = ' '.join(args[1:])
+    if name in ('enqueue', 'library'):
+        command['query'] = value
+    elif name in ('play', 'remove', 'pause-download', 'resume-download') and value:
+        command['index'] = int(value)
+    elif name == 'move':
+        command['index'], command['to'] = (int(part) for part in args[1:3])
+    elif name == 'seek':
+        command['position'] = float(value)
+    elif name == 'volume':
+        command['value'] = float(value)
+    elif name == 'import':
+        command['queries'] = read_import_file(value) if os.path.isfile(value) else parse_import_text(value)
+    elif name == 'cancel-import':
+        command['id'] = int(value)
+    elif name == 'replay' and value:
+        command['enabled'] = value.lower() in ('1', 'on', 'true', 'yes')
+    return command
+
+def main(argv):
+    path = CONTROL_SOCKET_PATH
+    if '--socket' in argv:
+        i = argv.index('--socket')
+        path = argv[i + 1]
+        argv = argv[:i] + argv[i + 2:]
+    
+    if argv and argv[0] == '--daemon':
+        engine = PlayerEngine()
+        engine.subscribe(lambda event, data: print(json.dumps(dict(data, event=event)), flush=True))
+        server = ControlServer(engine, path)
+        server.start()
+        if WARM_UP_ON_START:
+            engine.warm_up()
+        try:
+            engine.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            engine.close()
+            pygame.mixer.quit()
+        return 0
+    
+    if argv:
+        try:
+            reply = send_command(parse_command(argv), path)
+            if argv[0] == 'stats' and reply.get('ok') and '--json' not in argv:
+                print(format_latency_stats(reply['stats']))
+                print()
+                print(format_storage_stats(reply['cache'], reply['library']))
+            else:
+                print(json.dumps(reply, indent=2))
+        except OSError as e:
+            print(f"Could not reach player: {str(e)}")
+            return 1
+        return 0
+    
+    print("Usage: playerengine.py --daemon [--socket PATH]")
+    print("       playerengine.py [--socket PATH] COMMAND [ARGS]")
+    print("Commands: status, queue, enqueue QUERY, play [INDEX], pause, resume, toggle,")
+    print("          stop, next, previous, seek SECONDS, volume PERCENT, remove INDEX, replay [on|off],")
+    print("          move INDEX TO, shuffle, dedupe, undo,")
+    print("          downloads, pause-download INDEX, resume-download INDEX, library [QUERY],")
+    print("          import FILE, imports, cancel-import ID, stats [--json], cache")
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,64 @@
+import os
+import sys
+import types
+import atexit
+import threading
+import shutil
+import tempfile
+
+# Shared by the test modules. The engine keeps its cache, library and session
+# under ~/.audivine, so the tests run against a throwaway home. pygame is
+# replaced by a silent mixer; yt_dlp and the search client are only imported
+# when a track is resolved, and the tests that do so install their own fakes.
+HOME = tempfile.mkdtemp(prefix='audivine-tests-')
+os.environ['HOME'] = HOME
+os.environ['USERPROFILE'] = HOME
+atexit.register(shutil.rmtree, HOME, True)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import playerengine as pe
+
+def silent_pygame():
+    music = types.SimpleNamespace(
+        load=lambda path, *args: None, unload=lambda: None, play=lambda *args, **kwargs: None,
+        stop=lambda: None, pause=lambda: None, unpause=lambda: None, queue=lambda path, *args: None,
+        set_volume=lambda value: None, get_busy=lambda: False, get_pos=lambda: 0,
+        set_endevent=lambda event=0: None)
+    return types.SimpleNamespace(
+        USEREVENT=24,
+        mixer=types.SimpleNamespace(init=lambda *args, **kwargs: None, quit=lambda: None, music=music),
+        display=types.SimpleNamespace(init=lambda: None),
+        event=types.SimpleNamespace(set_blocked=lambda kinds: None, set_allowed=lambda kinds: None,
+                                    get=lambda kind=None: [], clear=lambda kind=None: None,
+                                    wait=lambda *args: threading.Event().wait()))
+
+pe.pygame = silent_pygame()
+pe.TRACK_END_EVENT = pe.pygame.USEREVENT + 1
+
+def temp_dir():
+    return tempfile.mkdtemp(dir=HOME)
+
+class EngineHome:
+    # Points the engine's cache, library and session at a fresh directory
+    # and builds engines that never resolve, download or play anything.
+    def __init__(self):
+        self.home = temp_dir()
+        self.saved = pe.CACHE_DIR, pe.LIBRARY_PATH, pe.SESSION_DIR
+        pe.CACHE_DIR = os.path.join(self.home, 'cache')
+        pe.LIBRARY_PATH = os.path.join(self.home, 'library.db')
+        pe.SESSION_DIR = os.path.join(self.home, 'session')
+
+    def new_engine(self):
+        engine = pe.PlayerEngine()
+        engine.prefetch_count = 0
+        engine.cache_warm_count = 0
+        engine.controller.play = lambda url, title, start=0: None
+        return engine
+
+    def restore(self):
+        pe.CACHE_DIR, pe.LIBRARY_PATH, pe.SESSION_DIR = self.saved
+
+def add_songs(engine, count, prefix='song'):
+    for index in range(count):
+        engine.add_song({'url': f'https://www.youtube.com/watch?v={prefix}{index}',
+                         'title': f'{prefix} {index}'})
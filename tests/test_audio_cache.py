@@ -0,0 +1,92 @@
+import os
+import time
+import unittest
+
+from support import pe, temp_dir, EngineHome
+
+class AudioCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temp_dir()
+
+    def write(self, name, size):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        return path
+
+    def add(self, cache, video_id, size, added):
+        cache.add(video_id, self.write(f'{video_id}.m4a', size), 'aac')
+        cache.entries[video_id]['added'] = added
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = pe.AudioCache(self.directory, 300)
+        self.add(cache, 'a', 100, 1)
+        self.add(cache, 'b', 100, 2)
+        self.add(cache, 'c', 100, 3)
+        cache.entries['a']['last_played'] = 4
+        self.add(cache, 'd', 100, 5)
+        self.assertEqual(sorted(cache.entries), ['a', 'c', 'd'])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'b.m4a')))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lfu_evicts_least_played(self):
+        cache = pe.AudioCache(self.directory, 300, policy='lfu')
+        self.add(cache, 'a', 100, 1)
+        self.add(cache, 'b', 100, 2)
+        self.add(cache, 'c', 100, 3)
+        cache.entries['a']['play_count'] = 3
+        cache.entries['c']['play_count'] = 1
+        self.add(cache, 'd', 100, 4)
+        self.assertEqual(sorted(cache.entries), ['a', 'c', 'd'])
+
+    def test_pinned_and_new_tracks_are_kept(self):
+        cache = pe.AudioCache(self.directory, 250)
+        self.add(cache, 'a', 100, 1)
+        self.add(cache, 'b', 100, 2)
+        cache.pin(['a'])
+        self.add(cache, 'c', 100, 3)
+        self.assertEqual(sorted(cache.entries), ['a', 'c'])
+        # Nothing else may go, so an oversized file is still kept.
+        self.add(cache, 'd', 1000, 4)
+        self.assertIn('d', cache.entries)
+
+    def test_verify_drops_partial_orphaned_and_truncated_files(self):
+        cache = pe.AudioCache(self.directory, 10000)
+        self.add(cache, 'a', 100, 1)
+        self.add(cache, 'b', 100, 2)
+        self.write('c.m4a.part', 50)
+        self.write('orphan.webm', 50)
+        self.write('b.m4a', 40)
+        cache = pe.AudioCache(self.directory, 10000)
+        self.assertEqual(sorted(cache.entries), ['a'])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.m4a', pe.AudioCache.INDEX_NAME])
+
+    def test_stats_survive_a_restart(self):
+        cache = pe.AudioCache(self.directory, 10000)
+        self.add(cache, 'a', 100, time.time())
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('missing'))
+        cache.save()
+        stats = pe.AudioCache(self.directory, 10000).stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+        self.assertEqual((stats['entries'], stats['bytes']), (1, 100))
+
+class CacheStatsCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.home = EngineHome()
+        self.engine = self.home.new_engine()
+
+    def tearDown(self):
+        self.engine.close()
+        self.home.restore()
+
+    def test_cache_and_stats_commands(self):
+        self.assertEqual(self.engine.handle_command({'cmd': 'cache'})['cache'], self.engine.cache.stats())
+        reply = self.engine.handle_command({'cmd': 'stats'})
+        self.assertIn('stages', reply['stats'])
+        self.assertEqual(reply['cache']['entries'], 0)
+        text = pe.format_storage_stats(reply['cache'], reply['library'])
+        self.assertTrue(text.startswith('cache: 0 files'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from support import pe
+
+def audio(format_id, ext, abr):
+    return {'format_id': format_id, 'ext': ext, 'abr': abr, 'acodec': 'opus' if ext == 'webm' else 'mp4a.40.2',
+            'vcodec': 'none', 'url': f'https://example.com/{format_id}'}
+
+FORMATS = [
+    audio('139', 'm4a', 48),
+    audio('249', 'webm', 50),
+    audio('140', 'm4a', 129),
+    audio('251', 'webm', 160),
+    {'format_id': '18', 'ext': 'mp4', 'tbr': 500, 'acodec': 'mp4a.40.2', 'vcodec': 'avc1',
+     'url': 'https://example.com/18'},
+]
+
+class ChooseAudioFormatTest(unittest.TestCase):
+    def choose(self, throughput, seconds=200):
+        fmt = pe.choose_audio_format(FORMATS, throughput, 3.0, seconds)
+        return fmt and fmt['format_id']
+
+    def test_default_is_best_m4a(self):
+        self.assertEqual(pe.default_audio_format(FORMATS)['format_id'], '140')
+        self.assertEqual(pe.default_audio_format([audio('251', 'webm', 160)])['format_id'], '251')
+        self.assertIsNone(pe.default_audio_format(FORMATS[-1:]))
+
+    def test_fast_connection_keeps_default(self):
+        self.assertIsNone(self.choose(10 * 1024 * 1024))
+
+    def test_pick_matching_default_is_not_reduced(self):
+        # 140 arrives in time but 251 does not; 140 is what the default
+        # selector downloads, so there is nothing to upgrade later.
+        self.assertIsNone(self.choose(1.2 * 1000 * 1000))
+
+    def test_slow_connection_reduces(self):
+        self.assertEqual(self.choose(500 * 1000), '249')
+        self.assertEqual(self.choose(50 * 1000), '139')
+
+    def test_nothing_fits_takes_smallest(self):
+        self.assertEqual(self.choose(1000), '139')
+
+    def test_unknown_throughput(self):
+        self.assertIsNone(self.choose(0))
+        self.assertIsNone(pe.choose_audio_format([], 1000, 3.0, 10))
+
+if __name__ == '__main__':
+    unittest.main()
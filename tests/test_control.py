@@ -0,0 +1,72 @@
+import os
+import json
+import stat
+import types
+import socket
+import unittest
+
+from support import pe, temp_dir
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "needs Unix sockets")
+class ControlServerTest(unittest.TestCase):
+    def setUp(self):
+        directory = temp_dir()
+        self.path = os.path.join(directory, 'control.sock')
+        self.token_path = os.path.join(directory, 'control.token')
+        self.commands = []
+        engine = types.SimpleNamespace(call=lambda function, *args: function(*args),
+                                       handle_command=self.handle_command)
+        self.server = pe.ControlServer(engine, path=self.path, token_path=self.token_path)
+        self.server.start()
+        self.addCleanup(self.server.close)
+
+    def handle_command(self, command):
+        if command['cmd'] == 'fail':
+            raise ValueError("Unknown command: fail")
+        self.commands.append(command)
+        return {'state': 'idle'}
+
+    def send(self, command):
+        return pe.send_command(command, self.path, timeout=5, token_path=self.token_path)
+
+    def raw(self, *lines):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(self.path)
+            with sock.makefile('rw', encoding='utf-8', newline='\n') as stream:
+                for line in lines:
+                    stream.write(line + '\n')
+                stream.flush()
+                return [json.loads(reply) for reply in stream]
+
+    def test_token_file_is_private(self):
+        mode = stat.S_IMODE(os.stat(self.token_path).st_mode)
+        self.assertEqual(mode, 0o600)
+        self.assertEqual(pe.read_control_token(self.token_path), self.server.token)
+        self.assertEqual(len(self.server.token), 64)
+        self.assertNotEqual(pe.write_control_token(self.token_path), self.server.token)
+
+    def test_command_with_token_runs(self):
+        self.assertEqual(self.send({'cmd': 'status'}), {'state': 'idle', 'ok': True})
+        self.assertEqual(self.commands, [{'cmd': 'status'}])
+        self.assertEqual(self.send({'cmd': 'fail'}), {'ok': False, 'error': "Unknown command: fail"})
+
+    def test_rejected_lines_close_the_connection(self):
+        status = json.dumps({'cmd': 'status', 'token': self.server.token})
+        for line in (json.dumps({'cmd': 'status'}),
+                     json.dumps({'cmd': 'status', 'token': 'x' * 64}),
+                     json.dumps({'cmd': 'status', 'token': 12}),
+                     'POST / HTTP/1.1',
+                     json.dumps([self.server.token]),
+                     json.dumps(self.server.token)):
+            replies = self.raw(line, status)
+            self.assertEqual(replies, [{'ok': False, 'error': "Not authorized"}])
+        self.assertEqual(self.commands, [])
+
+    def test_second_server_on_the_same_socket_fails(self):
+        engine = types.SimpleNamespace()
+        with self.assertRaises(RuntimeError):
+            pe.ControlServer(engine, path=self.path, token_path=self.token_path).start()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import sys
+import time
+import types
+import threading
+import unittest
+
+from support import pe
+
+class FakeYoutubeDL:
+    # Reports progress from a separate thread, like yt_dlp's fragment
+    # workers on DASH downloads.
+    def __init__(self, options):
+        self.params = dict(options, outtmpl={'default': options['outtmpl']})
+        self.hooks = options['progress_hooks']
+        self.format_selector = None
+
+    def process_ie_result(self, info, download=True):
+        errors = []
+
+        def fragments():
+            try:
+                for done in range(1, 6):
+                    for hook in self.hooks:
+                        hook({'status': 'downloading', 'downloaded_bytes': done * 100, 'total_bytes': 500})
+            except Exception as e:
+                errors.append(e)
+
+        worker = threading.Thread(target=fragments)
+        worker.start()
+        worker.join()
+        if errors:
+            raise errors[0]
+        return {'requested_downloads': [{'filepath': f"/downloads/{info['id']}.m4a"}]}
+
+class ResolverDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = sys.modules.get('yt_dlp')
+        sys.modules['yt_dlp'] = types.SimpleNamespace(
+            YoutubeDL=FakeYoutubeDL,
+            utils=types.SimpleNamespace(DownloadCancelled=type('DownloadCancelled', (Exception,), {})))
+        self.resolver = pe.TrackResolver({'outtmpl': '%(id)s.%(ext)s', 'format': 'bestaudio'}, pool_size=1)
+
+    def tearDown(self):
+        if self.saved is None:
+            del sys.modules['yt_dlp']
+        else:
+            sys.modules['yt_dlp'] = self.saved
+
+    def test_progress_from_fragment_threads(self):
+        seen = []
+        path = self.resolver.download({'id': 'abc'}, progress=lambda status: seen.append(status['downloaded_bytes']))
+        self.assertEqual(path, '/downloads/abc.m4a')
+        self.assertEqual(seen, [100, 200, 300, 400, 500])
+
+    def test_cancel_from_fragment_threads(self):
+        seen = []
+        with self.assertRaises(sys.modules['yt_dlp'].utils.DownloadCancelled):
+            self.resolver.download({'id': 'abc'}, progress=lambda status: seen.append(status),
+                                   cancelled=lambda: len(seen) >= 2)
+        self.assertEqual(len(seen), 2)
+        # The next download on the same pooled instance starts clean.
+        self.assertEqual(self.resolver.download({'id': 'def'}), '/downloads/def.m4a')
+
+class DownloadManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.release = threading.Event()
+        self.manager = pe.DownloadManager(self.download, workers=1)
+
+    def tearDown(self):
+        self.release.set()
+
+    def download(self, job):
+        # Runs until released, or until the manager asks the job to stop.
+        self.started.append(job.url)
+        while not self.release.is_set():
+            if job.stopping():
+                raise RuntimeError("stopped")
+            time.sleep(0.005)
+        return f'/downloads/{job.url}'
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertTrue(condition())
+
+    def test_urgent_request_preempts_and_requeues(self):
+        background = self.manager.request('a', pe.PRIORITY_BACKGROUND)
+        self.wait_for(lambda: background.state == 'downloading')
+        current = self.manager.request('b', pe.PRIORITY_CURRENT)
+        self.wait_for(lambda: self.started == ['a', 'b'])
+        self.assertEqual(background.state, 'queued')
+        self.release.set()
+        self.assertTrue(current.done.wait(5))
+        self.assertTrue(background.done.wait(5))
+        self.assertEqual(self.started, ['a', 'b', 'a'])
+        self.assertEqual((current.path, background.path), ('/downloads/b', '/downloads/a'))
+
+    def test_lower_priority_waits(self):
+        first = self.manager.request('a', pe.PRIORITY_NEXT)
+        self.wait_for(lambda: first.state == 'downloading')
+        second = self.manager.request('b', pe.PRIORITY_BACKGROUND)
+        time.sleep(0.05)
+        self.assertEqual((first.state, second.state), ('downloading', 'queued'))
+
+    def test_retain_pauses_unwanted_and_resume_requeues(self):
+        job = self.manager.request('a', pe.PRIORITY_PREFETCH)
+        self.wait_for(lambda: job.state == 'downloading')
+        self.manager.retain({})
+        self.wait_for(lambda: job.state == 'paused')
+        self.assertTrue(self.manager.pause('a'))
+        self.assertTrue(self.manager.resume('a'))
+        self.wait_for(lambda: job.state == 'downloading')
+        self.release.set()
+        self.assertTrue(job.done.wait(5))
+
+if __name__ == '__main__':
+    unittest.main()
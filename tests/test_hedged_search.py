@@ -0,0 +1,72 @@
+import time
+import threading
+import unittest
+
+from support import pe
+
+class FakeBackend(pe.SearchBackend):
+    def __init__(self, name, result=None, error=None, gate=None):
+        self.name = name
+        self.result = result
+        self.error = error
+        self.gate = gate
+        self.calls = []
+
+    def search(self, query):
+        self.calls.append(query)
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class HedgedSearchTest(unittest.TestCase):
+    def hedged(self, backends, hedge_delay=5.0):
+        search = pe.HedgedSearch(backends, hedge_delay=hedge_delay)
+        self.addCleanup(search.executor.shutdown, False)
+        return search
+
+    def test_fast_backend_answers_alone(self):
+        first = FakeBackend('first', {'title': 'a'})
+        second = FakeBackend('second', {'title': 'b'})
+        self.assertEqual(self.hedged([first, second])('q'), {'title': 'a'})
+        self.assertEqual(second.calls, [])
+
+    def test_slow_backend_is_hedged(self):
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        slow = FakeBackend('slow', {'title': 'slow'}, gate=gate)
+        fast = FakeBackend('fast', {'title': 'fast'})
+        started = time.monotonic()
+        self.assertEqual(self.hedged([slow, fast], hedge_delay=0.05)('q'), {'title': 'fast'})
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual((slow.calls, fast.calls), (['q'], ['q']))
+
+    def test_failure_or_no_result_starts_the_next_backend_at_once(self):
+        for first in (FakeBackend('first', error=RuntimeError('down')), FakeBackend('first')):
+            second = FakeBackend('second', {'title': 'b'})
+            started = time.monotonic()
+            self.assertEqual(self.hedged([first, second])('q'), {'title': 'b'})
+            self.assertLess(time.monotonic() - started, 2)
+
+    def test_all_failing_raises(self):
+        search = self.hedged([FakeBackend('first', error=RuntimeError('one')),
+                              FakeBackend('second', error=ValueError('two'))])
+        with self.assertRaises((RuntimeError, ValueError)):
+            search('q')
+        search = self.hedged([FakeBackend('first'), FakeBackend('second', error=ValueError('two'))])
+        self.assertIsNone(search('q'))
+
+    def test_failing_backend_moves_down_the_order(self):
+        flaky = FakeBackend('flaky', error=RuntimeError('down'))
+        steady = FakeBackend('steady', {'title': 'b'})
+        search = self.hedged([flaky, steady])
+        self.assertEqual([backend.name for backend in search.ordered_backends()], ['flaky', 'steady'])
+        search('q')
+        self.assertEqual([backend.name for backend in search.ordered_backends()], ['steady', 'flaky'])
+        self.assertEqual(search.stats['flaky'].errors, 1)
+        search('q')
+        self.assertEqual(flaky.calls, ['q'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import unittest
+
+from support import pe, temp_dir
+
+class ReadImportFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temp_dir()
+
+    def read(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return pe.read_import_file(path)
+
+    def test_text_file(self):
+        text = '﻿Song one\n\n# a comment\n  https://youtu.be/abc  \n'
+        self.assertEqual(self.read('list.txt', text), ['Song one', 'https://youtu.be/abc'])
+
+    def test_csv_url_and_query_columns(self):
+        text = 'url,query,notes\nhttps://youtu.be/abc,,x\n,Some song,y\n'
+        self.assertEqual(self.read('list.csv', text), ['https://youtu.be/abc', 'Some song'])
+
+    def test_csv_artist_and_title(self):
+        text = 'Title,Artist\nHey Jude,The Beatles\n"Hello, Goodbye",The Beatles\n'
+        self.assertEqual(self.read('list.csv', text),
+                         ['The Beatles Hey Jude', 'The Beatles Hello, Goodbye'])
+
+    def test_csv_header_with_other_names_is_skipped(self):
+        text = 'artist,song\nQueen,Bohemian Rhapsody\nABBA,Waterloo\n'
+        self.assertEqual(self.read('list.csv', text), ['Queen Bohemian Rhapsody', 'ABBA Waterloo'])
+
+    def test_csv_header_with_extra_columns(self):
+        text = 'Artist,Album,Year\nQueen,A Night at the Opera,1975\n'
+        self.assertEqual(self.read('list.csv', text), ['Queen'])
+        text = 'Track Name,Plays\nWaterloo,7\n'
+        self.assertEqual(self.read('list.csv', text), ['Waterloo'])
+
+    def test_headerless_csv(self):
+        text = 'Queen,Bohemian Rhapsody\nABBA,Waterloo\n\n'
+        self.assertEqual(self.read('list.csv', text), ['Queen Bohemian Rhapsody', 'ABBA Waterloo'])
+        text = 'Queen,Bohemian Rhapsody\nABBA,Waterloo\nToto,Africa\n'
+        self.assertEqual(self.read('list.csv', text),
+                         ['Queen Bohemian Rhapsody', 'ABBA Waterloo', 'Toto Africa'])
+
+    def test_empty_csv(self):
+        self.assertEqual(self.read('list.csv', ''), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import json
+import unittest
+
+from support import pe, temp_dir
+
+class LatencyTracerTest(unittest.TestCase):
+    def setUp(self):
+        self.log_path = os.path.join(temp_dir(), 'trace.log')
+        self.tracer = pe.LatencyTracer(self.log_path, window=100, max_log_bytes=10000)
+
+    def read_log(self, path=None):
+        with open(path or self.log_path, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_summary_percentiles(self):
+        for ms in range(1, 101):
+            self.tracer.record('download', ms / 1000)
+        row = self.tracer.summary()['stages']['download']
+        self.assertEqual(row, {'count': 100, 'p50': 50.0, 'p95': 95.0, 'p99': 99.0, 'max': 100.0})
+
+    def test_window_keeps_latest_samples(self):
+        tracer = pe.LatencyTracer(self.log_path, window=3)
+        for ms in (900, 1, 2, 3):
+            tracer.record('resolve', ms / 1000)
+        self.assertEqual(tracer.summary()['stages']['resolve']['max'], 3.0)
+
+    def test_trace_collects_spans_and_flags(self):
+        self.tracer.begin('play', 'url', title='Song')
+        self.tracer.flag('url', 'cache', 'hit')
+        self.tracer.flag('other', 'cache', 'miss')
+        with self.tracer.span('resolve', 'url'):
+            pass
+        with self.assertRaises(KeyError):
+            with self.tracer.span('download', 'url'):
+                raise KeyError('gone')
+        self.tracer.end('url')
+        trace, = self.read_log()
+        self.assertEqual((trace['kind'], trace['key'], trace['title']), ('play', 'url', 'Song'))
+        self.assertEqual((trace['cache'], trace['outcome']), ('hit', 'ok'))
+        self.assertEqual([span['stage'] for span in trace['spans']], ['resolve', 'download'])
+        self.assertEqual(trace['spans'][1]['error'], 'KeyError')
+        summary = self.tracer.summary()
+        self.assertEqual(summary['flags'], {'cache': {'hit': 1, 'miss': 1}})
+        self.assertEqual(sorted(summary['stages']), ['download', 'play', 'resolve'])
+
+    def test_unfinished_runs_are_logged_but_not_timed(self):
+        self.tracer.begin('play', 'url')
+        self.tracer.end('url', 'stopped')
+        self.tracer.end('url')
+        self.assertEqual([trace['outcome'] for trace in self.read_log()], ['stopped'])
+        self.assertNotIn('play', self.tracer.summary()['stages'])
+
+    def test_open_traces_are_capped(self):
+        for index in range(pe.TRACE_OPEN_LIMIT + 10):
+            self.tracer.begin('search', index)
+        self.assertEqual(len(self.tracer.traces), pe.TRACE_OPEN_LIMIT)
+        self.assertNotIn(0, self.tracer.traces)
+
+    def test_log_rotates_at_its_size_cap(self):
+        tracer = pe.LatencyTracer(self.log_path, max_log_bytes=300)
+        for index in range(10):
+            tracer.begin('search', index, query='x' * 50)
+            tracer.end(index)
+        self.assertLessEqual(os.path.getsize(self.log_path), 300)
+        self.assertLessEqual(os.path.getsize(self.log_path + '.1'), 300)
+        self.assertEqual(self.read_log()[-1]['key'], 9)
+
+    def test_format_latency_stats(self):
+        self.assertIn("(nothing timed yet)", pe.format_latency_stats(self.tracer.summary()))
+        self.tracer.record('search', 0.0125)
+        self.tracer.flag(None, 'search.source', 'library')
+        lines = pe.format_latency_stats(self.tracer.summary()).split('\n')
+        self.assertEqual(lines[0].split(), ['stage', 'count', 'p50', 'p95', 'p99', 'max'])
+        self.assertEqual(lines[1].split(), ['search', '1', '12.5ms', '12.5ms', '12.5ms', '12.5ms'])
+        self.assertEqual(lines[2], "search.source: library 1")
+
+if __name__ == '__main__':
+    unittest.main()
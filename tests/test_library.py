@@ -0,0 +1,76 @@
+import os
+import unittest
+
+from support import pe, temp_dir, EngineHome
+
+def info(video_id, title, channel='Someone', duration=None):
+    return {'id': video_id, 'title': title, 'channel': channel, 'duration': duration,
+            'webpage_url': f'https://www.youtube.com/watch?v={video_id}'}
+
+class LocalLibraryTest(unittest.TestCase):
+    def setUp(self):
+        self.library = pe.LocalLibrary(os.path.join(temp_dir(), 'library.db'))
+        self.library.add_info(info('bohemian', 'Queen - Bohemian Rhapsody (Official Video Remastered)', 'Queen Official', 355))
+        self.library.add_info(info('kitty', 'Hello Kitty theme song full version', 'Sanrio'))
+        self.library.add_info(info('hello', 'Hello', 'Adele'))
+
+    def tearDown(self):
+        self.library.close()
+
+    def test_find_needs_most_of_the_title(self):
+        for fts in (self.library.fts, False):
+            self.library.fts = fts
+            self.assertEqual(self.library.find('queen bohemian rhapsody')['id'], 'bohemian')
+            self.assertEqual(self.library.find('Bohemian Rhapsody')['id'], 'bohemian')
+            self.assertIsNone(self.library.find('kitty'))
+            self.assertIsNone(self.library.find('queen'))
+            self.assertIsNone(self.library.find('not in the library'))
+
+    def test_find_exact_title_and_channel_words(self):
+        self.assertEqual(self.library.find('hello')['id'], 'hello')
+        self.assertEqual(self.library.find('adele hello')['id'], 'hello')
+
+    def test_find_prefers_cached_and_played(self):
+        self.library.add_info(info('hello2', 'Hello', 'Lionel Richie'))
+        self.library.set_cached('hello2', '/cache/hello2.m4a')
+        self.assertEqual(self.library.find('hello')['id'], 'hello2')
+
+    def test_song_title_shows_duration(self):
+        self.assertEqual(self.library.get('bohemian')['title'],
+                         'Queen - Bohemian Rhapsody (Official Video Remastered) (5:55)')
+        self.assertEqual(len(self.library.search('hello', limit=5)), 2)
+
+    def test_sync_cached_and_stats(self):
+        self.library.set_cached('kitty', '/cache/kitty.m4a')
+        self.library.sync_cached({'hello': '/cache/hello.m4a'})
+        self.assertEqual(self.library.stats()['cached'], 1)
+        self.assertEqual(self.library.find('hello')['id'], 'hello')
+
+class FindSongTest(unittest.TestCase):
+    def setUp(self):
+        self.home = EngineHome()
+        self.engine = self.home.new_engine()
+        self.engine.library.add_info(info('hello', 'Hello', 'Adele'))
+        self.searched = []
+        self.engine.search_backends = lambda query: self.searched.append(query) or {'url': 'net', 'title': query}
+
+    def tearDown(self):
+        self.engine.close()
+        self.home.restore()
+
+    def test_library_answers_matching_title(self):
+        self.assertEqual(self.engine.find_song('Hello')['id'], 'hello')
+        self.assertEqual(self.searched, [])
+
+    def test_partial_match_searches_online(self):
+        self.engine.library.add_info(info('long', 'Hello from the other side of the world', 'Someone'))
+        self.assertEqual(self.engine.find_song('world')['url'], 'net')
+        self.assertEqual(self.searched, ['world'])
+
+    def test_online_prefix_skips_library(self):
+        self.assertEqual(self.engine.find_song('web: Hello')['url'], 'net')
+        self.assertEqual(self.engine.find_song('WEB:hello')['url'], 'net')
+        self.assertEqual(self.searched, ['Hello', 'hello'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import random
+import unittest
+
+from support import pe
+
+def make_tracks(count, prefix='song'):
+    return [pe.Track(f'https://www.youtube.com/watch?v={prefix}{index}', f'{prefix} {index}')
+            for index in range(count)]
+
+def ids(queue):
+    return [track.id for track in queue]
+
+class PlayQueueUndoTest(unittest.TestCase):
+    def setUp(self):
+        # Small blocks, so edits split, empty and rebuild blocks.
+        self.queue = pe.PlayQueue(block_size=4)
+        self.tracks = make_tracks(20)
+        self.queue.reset(self.tracks)
+        self.queue.set_position(5)
+
+    def assertUndone(self, before):
+        self.assertTrue(self.queue.undo())
+        self.assertEqual(ids(self.queue), before)
+        self.assertConsistent()
+
+    def assertConsistent(self):
+        for index, track in enumerate(self.queue):
+            self.assertEqual(self.queue.index_of(track.id), index)
+            self.assertIs(self.queue[index], track)
+        self.assertEqual(len(self.queue), len(self.queue.snapshot()))
+
+    def test_insert(self):
+        before = ids(self.queue)
+        self.queue.insert(3, make_tracks(9, 'new'))
+        self.assertEqual(len(self.queue), 29)
+        self.assertConsistent()
+        self.assertUndone(before)
+
+    def test_remove(self):
+        before = ids(self.queue)
+        removed = self.queue.remove(8)
+        self.assertIsNone(self.queue.index_of(removed.id))
+        self.assertUndone(before)
+
+    def test_remove_current_moves_cursor_back(self):
+        before = ids(self.queue)
+        self.queue.remove(5)
+        self.assertEqual(self.queue.position(), 4)
+        self.assertUndone(before)
+
+    def test_move(self):
+        before = ids(self.queue)
+        self.queue.move(2, 17)
+        self.assertEqual(self.queue[17].id, before[2])
+        self.assertEqual(self.queue.position(), 4)
+        self.assertUndone(before)
+
+    def test_shuffle_keeps_played_tracks(self):
+        before = ids(self.queue)
+        self.queue.shuffle(random.Random(1))
+        after = ids(self.queue)
+        self.assertEqual(after[:6], before[:6])
+        self.assertEqual(sorted(after), sorted(before))
+        self.assertEqual(self.queue.position(), 5)
+        self.assertUndone(before)
+
+    def test_dedupe(self):
+        duplicates = [pe.Track(track.url, track.title) for track in self.tracks[:3]]
+        self.queue.insert(10, duplicates, record=False)
+        before = ids(self.queue)
+        self.assertEqual(self.queue.dedupe(), 3)
+        self.assertEqual(ids(self.queue), [track.id for track in self.tracks])
+        self.assertUndone(before)
+
+    def test_undo_keeps_later_unrecorded_edits(self):
+        before = ids(self.queue)
+        self.queue.shuffle(random.Random(2))
+        extra = make_tracks(2, 'extra')
+        self.queue.insert(0, extra, record=False)
+        self.assertTrue(self.queue.undo())
+        self.assertEqual(ids(self.queue), [track.id for track in extra] + before)
+        self.assertConsistent()
+
+    def test_random_edits_undo_to_start(self):
+        rng = random.Random(3)
+        before = ids(self.queue)
+        for step in range(40):
+            size = len(self.queue)
+            op = rng.choice(('insert', 'remove', 'move', 'shuffle', 'dedupe'))
+            if op == 'insert':
+                self.queue.insert(rng.randrange(size + 1), make_tracks(rng.randint(1, 6), f's{step}-'))
+            elif op == 'remove' and size > 1:
+                self.queue.remove(rng.randrange(size))
+            elif op == 'move':
+                self.queue.move(rng.randrange(size), rng.randrange(size))
+            elif op == 'shuffle':
+                self.queue.shuffle(rng)
+            else:
+                self.queue.dedupe()
+            self.assertConsistent()
+        while self.queue.undo():
+            pass
+        self.assertEqual(ids(self.queue), before)
+        self.assertConsistent()
+
+    def test_nothing_to_undo(self):
+        self.assertFalse(self.queue.undo())
+
+if __name__ == '__main__':
+    unittest.main()
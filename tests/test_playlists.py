@@ -0,0 +1,88 @@
+import time
+import unittest
+
+from support import pe, EngineHome, add_songs
+
+PLAYLIST_URL = 'https://www.youtube.com/playlist?list=PLtest'
+
+class PlaylistPagingTest(unittest.TestCase):
+    def setUp(self):
+        self.home = EngineHome()
+        self.engine = self.home.new_engine()
+        self.opened = 0
+        self.engine.resolver.open_playlist = self.open_playlist
+        self.saved_page_size = pe.PLAYLIST_PAGE_SIZE
+        pe.PLAYLIST_PAGE_SIZE = 10
+
+    def tearDown(self):
+        pe.PLAYLIST_PAGE_SIZE = self.saved_page_size
+        self.engine.close()
+        self.home.restore()
+
+    def open_playlist(self, url):
+        self.opened += 1
+        entries = ({'id': f'p{index}', 'title': f'Entry {index}'} for index in range(25))
+        return None, {'title': 'Test mix', 'entries': entries}
+
+    def settle(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            self.engine.process_pending()
+            time.sleep(0.005)
+        self.engine.process_pending()
+        self.assertTrue(condition())
+
+    def titles(self):
+        return [track.title for track in self.engine.queue]
+
+    def test_pages_replace_the_placeholder(self):
+        add_songs(self.engine, 2)
+        self.engine.add_playlist(PLAYLIST_URL)
+        self.settle(lambda: len(self.engine.queue) == 13)
+        self.assertEqual(self.titles()[2:4], ['Entry 0', 'Entry 1'])
+        self.assertEqual(self.titles()[-1], '⋯ More from Test mix')
+        self.assertIsNone(self.engine.queue[-1].url)
+
+        # The next page is loaded once the placeholder comes within
+        # PLAYLIST_LOOKAHEAD of the play head.
+        self.engine.play_index(10)
+        self.settle(lambda: len(self.engine.queue) == 23)
+        self.engine.play_index(20)
+        self.settle(lambda: len(self.engine.queue) == 27)
+        self.assertEqual(self.titles()[-1], 'Entry 24')
+        self.assertEqual(self.opened, 1)
+        self.assertEqual([track.url for track in self.engine.queue][2],
+                         'https://www.youtube.com/watch?v=p0')
+
+    def test_placeholder_found_after_edits(self):
+        add_songs(self.engine, 3)
+        self.engine.add_playlist(PLAYLIST_URL)
+        cursor = self.engine.queue[3].playlist
+        self.engine.move(3, 0)
+        self.engine.remove(1)
+        self.assertEqual(self.engine.placeholder_index(cursor), 0)
+        self.settle(lambda: len(self.engine.queue) == 13)
+        self.assertEqual(self.titles()[0], 'Entry 0')
+
+    def test_restored_placeholder_resumes_after_queued_entries(self):
+        self.engine.add_playlist(PLAYLIST_URL)
+        self.settle(lambda: len(self.engine.queue) == 11)
+        self.engine.close()
+        self.engine = self.home.new_engine()
+        self.engine.resolver.open_playlist = self.open_playlist
+        cursor = self.engine.queue[10].playlist
+        self.assertEqual(self.engine.placeholder_index(cursor), 10)
+        self.engine.play_index(9)
+        self.settle(lambda: len(self.engine.queue) == 21)
+        self.assertEqual(self.titles()[10], 'Entry 10')
+
+    def test_failed_page_removes_placeholder(self):
+        def fail(url):
+            raise RuntimeError("gone")
+        self.engine.resolver.open_playlist = fail
+        add_songs(self.engine, 1)
+        self.engine.add_playlist(PLAYLIST_URL)
+        self.settle(lambda: len(self.engine.queue) == 1)
+
+if __name__ == '__main__':
+    unittest.main()
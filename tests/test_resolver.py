@@ -0,0 +1,38 @@
+import functools
+import unittest
+
+from support import pe
+
+class FakeYoutubeDL:
+    @functools.cached_property
+    def cookiejar(self):
+        return object()
+
+    @functools.cached_property
+    def _request_director(self):
+        return object()
+
+class ChangedYoutubeDL:
+    @property
+    def cookiejar(self):
+        return object()
+
+class SessionSharingTest(unittest.TestCase):
+    def test_instances_share_the_first_session(self):
+        resolver = pe.TrackResolver({})
+        first = resolver._share_session(FakeYoutubeDL())
+        second = resolver._share_session(FakeYoutubeDL())
+        self.assertTrue(resolver.sharing)
+        self.assertIs(second.cookiejar, first.cookiejar)
+        self.assertIs(second._request_director, first._request_director)
+
+    def test_unknown_internals_fall_back_to_own_sessions(self):
+        resolver = pe.TrackResolver({})
+        ydl = ChangedYoutubeDL()
+        self.assertIs(resolver._share_session(ydl), ydl)
+        self.assertIs(resolver._share_session(ChangedYoutubeDL()).__class__, ChangedYoutubeDL)
+        self.assertFalse(resolver.sharing)
+        self.assertIsNone(resolver.session)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import json
+import threading
+import unittest
+
+from support import pe, temp_dir
+
+class SearchServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(temp_dir(), 'search_cache.json')
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def search(self, query):
+        self.calls.append(query)
+        self.release.wait(5)
+        if query == 'broken':
+            raise RuntimeError('backend down')
+        return {'url': f'https://www.youtube.com/watch?v={query}', 'title': query}
+
+    def service(self, **options):
+        service = pe.SearchService(self.search, cache_path=self.path, workers=2,
+                                   save_delay=options.pop('save_delay', 60), **options)
+        self.addCleanup(service.executor.shutdown)
+        self.addCleanup(service.flush)
+        return service
+
+    def submit(self, service, query):
+        done = threading.Event()
+        answers = []
+
+        def callback(result, error):
+            answers.append((result, error))
+            done.set()
+
+        service.submit(query, callback)
+        return done, answers
+
+    def test_identical_queries_share_one_search(self):
+        service = self.service()
+        self.release.clear()
+        first, first_answers = self.submit(service, 'hello')
+        second, second_answers = self.submit(service, '  Hello ')
+        self.release.set()
+        self.assertTrue(first.wait(5) and second.wait(5))
+        self.assertEqual(self.calls, ['hello'])
+        self.assertEqual(first_answers, second_answers)
+        self.assertEqual(first_answers[0][0]['title'], 'hello')
+
+    def test_cached_result_answers_without_searching(self):
+        service = self.service()
+        self.assertTrue(self.submit(service, 'hello')[0].wait(5))
+        done, answers = self.submit(service, 'HELLO')
+        self.assertTrue(done.is_set())
+        self.assertEqual(self.calls, ['hello'])
+        self.assertEqual(service.cached('hello')['title'], 'hello')
+
+    def test_errors_are_reported_and_not_cached(self):
+        service = self.service()
+        done, answers = self.submit(service, 'broken')
+        self.assertTrue(done.wait(5))
+        self.assertIsNone(answers[0][0])
+        self.assertIsInstance(answers[0][1], RuntimeError)
+        self.assertIsNone(service.cached('broken'))
+
+    def test_expired_results_are_searched_again(self):
+        service = self.service(ttl=0)
+        service.lookup('hello')
+        service.lookup('hello')
+        self.assertEqual(self.calls, ['hello', 'hello'])
+
+    def test_cache_keeps_newest_entries(self):
+        service = self.service(max_entries=2)
+        for query in ('a', 'b', 'c'):
+            service.lookup(query)
+        self.assertEqual(list(service.results), ['b', 'c'])
+        self.assertIsNone(service.cached('a'))
+
+    def test_saves_once_after_a_burst(self):
+        service = self.service()
+        for query in ('a', 'b', 'c'):
+            service.lookup(query)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNotNone(service.save_timer)
+        service.flush()
+        self.assertIsNone(service.save_timer)
+        with open(self.path, 'r', encoding='utf-8') as f:
+            self.assertEqual(sorted(json.load(f)), ['a', 'b', 'c'])
+
+    def test_load_drops_expired_and_caps_entries(self):
+        data = {'old': {'result': {'title': 'old'}, 'expires': 1},
+                'a': {'result': {'title': 'a'}, 'expires': 2e10},
+                'b': {'result': {'title': 'b'}, 'expires': 3e10},
+                'c': {'result': {'title': 'c'}, 'expires': 4e10}}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        service = self.service(max_entries=2)
+        self.assertEqual(list(service.results), ['b', 'c'])
+        self.assertEqual(service.lookup('c'), {'title': 'c'})
+        self.assertEqual(self.calls, [])
+
+    def test_unreadable_cache_starts_empty(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('{not json')
+        self.assertEqual(self.service().results, {})
+
+if __name__ == '__main__':
+    unittest.main()
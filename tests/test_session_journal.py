@@ -0,0 +1,74 @@
+import os
+import unittest
+
+from support import pe, EngineHome, add_songs
+
+class SessionJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.home = EngineHome()
+        self.engine = self.home.new_engine()
+
+    def tearDown(self):
+        self.engine.close()
+        self.home.restore()
+
+    def replayed(self):
+        state = pe.SessionJournal(pe.SESSION_DIR).load()
+        return {key: state[key] for key in ('tracks', 'index', 'replay', 'volume')}
+
+    def expected(self):
+        state = self.engine.session_state()
+        return {key: state[key] for key in ('tracks', 'index', 'replay', 'volume')}
+
+    def test_replay_matches_session_state(self):
+        add_songs(self.engine, 8)
+        self.engine.play_index(3)
+        self.engine.move(1, 6)
+        self.engine.move(3, 0)
+        self.engine.remove(5)
+        self.engine.remove(0)
+        self.engine.set_replay(True)
+        self.engine.set_volume(35)
+        self.assertEqual(self.replayed(), self.expected())
+
+    def test_replay_after_compacting_edits(self):
+        add_songs(self.engine, 6)
+        self.engine.play_index(2)
+        self.engine.shuffle()
+        add_songs(self.engine, 2, 'more')
+        self.engine.undo()
+        self.engine.move(4, 1)
+        self.assertEqual(self.replayed(), self.expected())
+
+    def test_restored_engine_has_same_queue(self):
+        add_songs(self.engine, 5)
+        self.engine.play_index(4)
+        self.engine.move(4, 2)
+        expected = self.expected()
+        self.engine.close()
+        self.engine = self.home.new_engine()
+        self.assertEqual(self.expected(), expected)
+        self.assertEqual(self.engine.queue.position(), 2)
+
+    def test_slider_volume_is_journaled_once(self):
+        for value in range(10, 60):
+            self.engine.set_volume(value, log=False)
+        self.engine.log_volume()
+        with open(self.engine.journal.journal_path, encoding='utf-8') as f:
+            volumes = [line for line in f if '"volume"' in line]
+        self.assertEqual(len(volumes), 1)
+        self.assertEqual(self.replayed()['volume'], 59)
+
+    def test_events_after_a_torn_tail_are_kept(self):
+        add_songs(self.engine, 1)
+        self.engine.close()
+        with open(os.path.join(pe.SESSION_DIR, 'session.journal'), 'a', encoding='utf-8') as f:
+            f.write('{"index":1,"tracks":[["https://www.youtube.com/wat')
+        self.engine = self.home.new_engine()
+        self.assertEqual(len(self.engine.queue), 1)
+        add_songs(self.engine, 2, 'after')
+        self.assertEqual(self.replayed(), self.expected())
+        self.assertEqual(len(self.replayed()['tracks']), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import random
+import unittest
+
+from support import pe
+
+class SuggestionIndexTest(unittest.TestCase):
+    def brute_force(self, index, text):
+        prefix = pe.normalize_query(text)
+        ranked = []
+        for key, (display, weight) in index.entries.items():
+            words = key.split(' ')
+            starts = [' '.join(words[start:]) for start in range(min(len(words), pe.SUGGEST_WORD_STARTS))]
+            if any(start.startswith(prefix) for start in starts):
+                ranked.append((not key.startswith(prefix), -weight, key, display))
+        return [display for _, _, _, display in sorted(ranked)[:index.limit]]
+
+    def test_word_starts_and_ranking(self):
+        index = pe.SuggestionIndex(limit=3)
+        index.add('Never Gonna Give You Up', 5)
+        index.add('Give It Away', 1)
+        index.add('Give Me Everything', 2)
+        self.assertEqual(index.lookup('give'), ['Give Me Everything', 'Give It Away', 'Never Gonna Give You Up'])
+        self.assertEqual(index.lookup('gonna'), ['Never Gonna Give You Up'])
+        self.assertEqual(index.lookup('  NEVER  gonna'), ['Never Gonna Give You Up'])
+        self.assertEqual(index.lookup('nothing'), [])
+
+    def test_repeat_adds_raise_weight(self):
+        index = pe.SuggestionIndex(limit=2)
+        index.add('Song A', 1)
+        index.add('Song B', 2)
+        index.add('song a', 2)
+        self.assertEqual(index.lookup('song'), ['Song A', 'Song B'])
+        self.assertEqual(len(index), 2)
+
+    def test_matches_brute_force(self):
+        rng = random.Random(4)
+        words = ['love', 'lost', 'night', 'nights', 'light', 'day', 'dancing', 'dance', 'dreams', 'rain']
+        for bulk in (False, True):
+            index = pe.SuggestionIndex(block_size=4)
+            titles = [(' '.join(rng.choice(words) for _ in range(rng.randint(1, 5))), rng.randint(1, 9))
+                      for _ in range(600)]
+            if bulk:
+                index.add_many(titles)
+            else:
+                for title, weight in titles:
+                    index.add(title, weight)
+            for prefix in ['l', 'lo', 'love', 'n', 'night', 'nights l', 'd', 'dan', 'rain d', 'x']:
+                self.assertEqual(index.lookup(prefix), self.brute_force(index, prefix), prefix)
+
+if __name__ == '__main__':
+    unittest.main()
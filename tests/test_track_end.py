@@ -0,0 +1,84 @@
+import queue
+import types
+import unittest
+
+from support import pe, EngineHome, add_songs
+
+class TrackEndTest(unittest.TestCase):
+    # The mixer plays every track from the cache, so each next track is
+    # handed to pygame.mixer.music.queue and the end event switches to it.
+    def setUp(self):
+        self.events = queue.Queue()
+        self.saved_wait = pe.pygame.event.wait
+        pe.pygame.event.wait = self.events.get
+        self.home = EngineHome()
+        self.engine = self.home.new_engine()
+        self.engine.cache.path = lambda video_id: f'/cache/{video_id}.mp3'
+        self.music = pe.pygame.mixer.music
+        self.saved = self.music.queue, self.music.get_busy
+        self.queued = []
+        self.music.queue = lambda path, *args: self.queued.append(path)
+        self.music.get_busy = lambda: True
+        add_songs(self.engine, 3)
+
+    def tearDown(self):
+        self.music.queue, self.music.get_busy = self.saved
+        pe.pygame.event.wait = self.saved_wait
+        self.engine.close()
+        self.home.restore()
+
+    def play(self, index):
+        # What start_output does once the controller has the file.
+        self.engine.stop_output()
+        self.engine.start_song(index)
+        self.engine.current_url = self.engine.queue[index].url
+        self.engine.is_playing = True
+        self.engine.schedule_prefetch()
+
+    def test_end_event_advances_to_queued_track(self):
+        self.play(0)
+        self.assertEqual(self.queued, ['/cache/song1.mp3'])
+        self.engine.on_music_end()
+        self.assertEqual(self.engine.queue.position(), 1)
+        self.assertEqual(self.engine.current_url, self.engine.queue[1].url)
+
+    def test_replay_turned_off_on_last_track(self):
+        self.play(2)
+        self.engine.set_replay(True)
+        self.assertEqual(self.queued, ['/cache/song0.mp3'])
+        self.engine.set_replay(False)
+        self.assertIsNone(self.engine.queued_next)
+        self.engine.on_music_end()
+        self.assertEqual(self.engine.queue.position(), 2)
+        self.assertFalse(self.engine.is_playing)
+
+    def test_queued_track_moved_away(self):
+        self.play(0)
+        self.engine.move(1, 2)
+        self.assertEqual(self.queued[-1], '/cache/song2.mp3')
+        # A stale hand-off that is no longer next is replaced, not kept.
+        self.engine.queued_next = (self.engine.queue[2].id, self.engine.queue[2].url, 'song 1')
+        started = []
+        self.engine.start_song = lambda index, start=0: started.append(index)
+        self.engine.on_music_end()
+        self.assertEqual(started, [1])
+
+    def test_end_event_is_posted_to_engine_thread(self):
+        self.play(0)
+        self.events.put(types.SimpleNamespace(type=pe.TRACK_END_EVENT))
+        func, args, future = self.engine.calls.get(timeout=5)
+        while func != self.engine.on_end_event:
+            func, args, future = self.engine.calls.get(timeout=5)
+        func(*args)
+        self.assertEqual(self.engine.queue.position(), 1)
+
+    def test_end_event_from_before_a_restart_is_ignored(self):
+        self.play(0)
+        stale = self.engine.end_generation
+        self.play(2)
+        self.engine.on_end_event(stale)
+        self.assertEqual(self.engine.queue.position(), 2)
+        self.assertTrue(self.engine.is_playing)
+
+if __name__ == '__main__':
+    unittest.main()